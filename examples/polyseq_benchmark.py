@@ -1,32 +1,16 @@
-import polyseq as pseq
-import timeit
+'''
+Times every stage of the pipeline (io, QC, normalization, regression, PCA,
+clustering, embedding and differential expression) on synthetic data of
+10k, 100k and 1M cells, and compares against an earlier run, e.g.:
 
-def run_analysis():
-    # load data
-    data_dir = "/path/to/data"
-    data = pseq.io.read_cellranger(data_dir)
+    python polyseq_benchmark.py --sizes 10000 100000 --out baseline.json
+    python polyseq_benchmark.py --sizes 10000 100000 --baseline baseline.json
 
-    # remove rarely expressed genes
-    dropped = data.drop_genes(num_cells=1)
+See polyseq.benchmark for the options.
+'''
+import sys
 
-    # normalize
-    normed = dropped.log_normalize()
+from polyseq.benchmark import main
 
-    # regress out total UMIs
-    total = normed.sum(axis=1)
-    regressed = pseq.regress(normed, total)
-
-    # dimensionaity reduction
-    reduced = pseq.dim.pca(regressed, k=15)
-
-    # clustering
-    clusters = pseq.clustering.graph_cluster(reduced, n_neighbors=15)
-    reduced.clusters = clusters
-
-    # tsne
-    tsne = pseq.dim.multicore_tsne(reduced)
-
-setup = "from __main__ import run_analysis"
-cmd = "run_analysis()"
-results = timeit.repeat(cmd, setup=setup, number=1, repeat=3)
-print(results)
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,42 @@
-from . import io
-from .clustering import graph_cluster
-from .dim import pca
-from .summary import summarize
-from .regression import regress
-from .differential_expression import upregulated
-from .functions import *
+'''
+scRNAseq data analysis in Python
+
+Submodules and the functions re-exported here are imported on first
+access, so `import polyseq` stays cheap and heavy dependencies (umap,
+sklearn, matplotlib, PyTables, ...) load only when a stage that needs
+them is used.
+'''
+import importlib
+
+_SUBMODULES = ("benchmark", "cache", "clustering", "density", "differential_expression", "dim",
+               "expression_matrix", "functions", "instrument", "io", "lazy", "linalg", "neighbors",
+               "raster", "regression", "summary", "utils", "viz")
+
+_EXPORTS = {
+    "graph_cluster": "clustering",
+    "pca": "dim",
+    "summarize": "summary",
+    "regress": "regression",
+    "upregulated": "differential_expression",
+    "concat": "functions",
+    "ExpressionMatrix": "expression_matrix",
+}
+
+# what `from polyseq import *` has always provided
+__all__ = ["io", "graph_cluster", "pca", "summarize", "regress", "upregulated", "concat",
+           "ExpressionMatrix"]
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        value = getattr(importlib.import_module("." + _EXPORTS[name], __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module("." + name, __name__)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES) | set(_EXPORTS))
@@ -0,0 +1,371 @@
+'''
+Benchmarks of the analysis pipeline on synthetic data
+
+Run as a script to time every stage at several data sizes, write the
+results as JSON and compare them against a stored baseline:
+
+    python -m polyseq.benchmark --sizes 10000 100000 --out results.json \
+        --baseline baseline.json
+'''
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import tables
+from scipy.sparse import csr_matrix
+
+import polyseq as pseq
+from polyseq import cache
+from polyseq.expression_matrix import SparseExpressionMatrix
+
+SIZES = (10000, 100000, 1000000)
+STAGES = ("io", "qc", "normalize", "regress", "pca", "cluster", "embed", "de")
+
+
+def synthetic_counts(n_cells, n_genes=2000, n_clusters=10, n_markers=50, fold_change=4.0,
+                     dispersion=0.2, library_size=2000, chunk_size=10000, random_state=0):
+    '''
+    negative binomial counts with planted clusters
+
+    Every cluster shares a log-normal baseline expression profile in which
+    `n_markers` randomly chosen genes are `fold_change` times higher. Cells
+    get a log-normal library size, and counts are drawn as a gamma-Poisson
+    mixture (negative binomial with variance mu + dispersion * mu^2) in
+    blocks of cells, so only the sparse result is held in memory.
+
+    Parameters:
+    -----------
+    n_cells: int
+        Number of cells
+    n_genes: int, default=2000
+        Number of genes
+    n_clusters: int, default=10
+        Number of planted clusters
+    n_markers: int, default=50
+        Upregulated genes per cluster
+    fold_change: float, default=4.0
+        Expression ratio of marker genes
+    dispersion: float, default=0.2
+        Negative binomial dispersion
+    library_size: float, default=2000
+        Median UMIs per cell
+    chunk_size: int, default=10000
+        Cells drawn at a time
+    random_state: int, default=0
+        Seed; the counts drawn for a given seed also depend on chunk_size
+
+    Returns:
+    --------
+    data: SparseExpressionMatrix of float32 counts
+    labels: ndarray of the planted cluster of every cell
+    '''
+    rng = np.random.default_rng(random_state)
+    base = rng.lognormal(0, 1.5, size=n_genes)
+    profiles = np.tile(base, (n_clusters, 1))
+    for profile in profiles:
+        profile[rng.choice(n_genes, min(n_markers, n_genes), replace=False)] *= fold_change
+    profiles /= profiles.sum(axis=1, keepdims=True)
+    labels = rng.integers(n_clusters, size=n_cells)
+    sizes = rng.lognormal(np.log(library_size), 0.5, size=n_cells)
+
+    data, indices, indptr = [], [], [np.zeros(1, dtype=np.int64)]
+    for start in range(0, n_cells, chunk_size):
+        stop = min(start + chunk_size, n_cells)
+        mu = sizes[start:stop, np.newaxis] * profiles[labels[start:stop]]
+        block = rng.poisson(rng.gamma(1 / dispersion, mu * dispersion))
+        rows, cols = np.nonzero(block)
+        data.append(block[rows, cols].astype(np.float32))
+        indices.append(cols.astype(np.int32))
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows, minlength=stop - start)))
+
+    matrix = csr_matrix((np.concatenate(data), np.concatenate(indices), np.concatenate(indptr)),
+                        shape=(n_cells, n_genes))
+    index = pd.Index(["cell-{}".format(i) for i in range(n_cells)], name="cell")
+    columns = pd.Index(["gene-{}".format(i) for i in range(n_genes)])
+    return SparseExpressionMatrix(matrix, index=index, columns=columns), labels
+
+
+def write_cellranger_h5(data, path):
+    '''
+    writes a SparseExpressionMatrix in the cellranger 3 .h5 layout
+    '''
+    # CSR rows of cells are the CSC columns of the (genes, cells) matrix on disk
+    matrix = data.matrix
+    with tables.open_file(path, 'w') as f:
+        group = f.create_group(f.root, "matrix")
+        f.create_array(group, "data", matrix.data.astype(np.int32))
+        f.create_array(group, "indices", matrix.indices.astype(np.int64))
+        f.create_array(group, "indptr", matrix.indptr.astype(np.int64))
+        f.create_array(group, "shape", np.array(matrix.shape[::-1], dtype=np.int32))
+        f.create_array(group, "barcodes", np.asarray(data.index).astype("S"))
+        features = f.create_group(group, "features")
+        f.create_array(features, "name", np.asarray(data.columns).astype("S"))
+    return path
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak over the life of the process, in kB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSS(object):
+    '''
+    context manager sampling the resident set size of the process in a
+    background thread; `peak` holds the largest value seen, in bytes
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, _rss_bytes())
+
+    def __enter__(self):
+        self.start = self.peak = _rss_bytes()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+
+def _pipeline(path, n_jobs):
+    '''
+    list of (stage, function) pairs; each function works on the state left
+    by the previous ones
+    '''
+    state = {}
+
+    def io():
+        state["data"] = pseq.io.read_cellranger(path, sparse=True)
+
+    def qc():
+        state["data"] = state["data"].qc_filter(num_genes=10, num_cells=10)
+
+    def normalize():
+        state["normed"] = state["data"].log_normalize()
+
+    def regress():
+        normed = state["normed"]
+        state["regressed"] = pseq.regress(normed, normed.sum(axis=1), n_processes=n_jobs)
+
+    def pca():
+        state["reduced"] = pseq.dim.pca(state["regressed"], k=20)
+
+    def cluster():
+        state["clusters"] = pseq.graph_cluster(state["reduced"], n_neighbors=15, n_jobs=n_jobs)
+
+    def embed():
+        state["embedding"] = pseq.dim.umap(state["reduced"], random_state=0)
+
+    def de():
+        normed = state["normed"]
+        normed.clusters = state["clusters"]
+        state["markers"] = pseq.upregulated(normed, n_jobs=n_jobs)
+
+    return [("io", io), ("qc", qc), ("normalize", normalize), ("regress", regress),
+            ("pca", pca), ("cluster", cluster), ("embed", embed), ("de", de)]
+
+
+def run_benchmark(sizes=SIZES, stages=STAGES, n_genes=2000, repeat=1, n_jobs=1, workdir=None):
+    '''
+    times every stage of the pipeline on synthetic data of each size
+
+    Stages run in order on the output of the previous ones; stages that are
+    not selected still run, untimed, when a selected one depends on them.
+    The on-disk result cache is turned off for the duration. The first run
+    also pays one-off costs such as the numba compilation behind "embed";
+    with repeat > 1 only the fastest run counts.
+
+    Parameters:
+    -----------
+    sizes: list of int, default=(10000, 100000, 1000000)
+        Numbers of cells
+    stages: list of str, default=STAGES
+        Stages to time: any of "io", "qc", "normalize", "regress", "pca",
+        "cluster", "embed" and "de"
+    n_genes: int, default=2000
+        Number of genes
+    repeat: int, default=1
+        Runs per size; the fastest time and the largest peak are kept
+    n_jobs: int, default=1
+        Threads for the stages that use them
+    workdir: str, default=None
+        Directory for the synthetic input files; a temporary one by default
+
+    Returns:
+    --------
+    dict with an "environment" description, the "import_seconds" of
+    polyseq and its io module (see import_time) and a list of "results",
+    one per size and stage, holding "seconds", "peak_rss_mb" (the largest
+    resident set size during the stage) and "delta_rss_mb" (its growth over
+    the RSS at the start of the stage)
+    '''
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("unknown stages: {}".format(", ".join(sorted(unknown))))
+    last = max(STAGES.index(stage) for stage in stages)
+
+    directory = workdir or tempfile.mkdtemp(prefix="polyseq-benchmark-")
+    enabled, cache._cache = cache._cache, None
+    results = []
+    try:
+        for n_cells in sizes:
+            data, _ = synthetic_counts(n_cells, n_genes)
+            path = write_cellranger_h5(data, os.path.join(directory, "synthetic-{}.h5".format(n_cells)))
+            del data
+            timings = {}
+            for _ in range(repeat):
+                for stage, run in _pipeline(path, n_jobs)[:last + 1]:
+                    with PeakRSS() as rss:
+                        start = time.perf_counter()
+                        run()
+                        seconds = time.perf_counter() - start
+                    if stage in stages:
+                        best = timings.setdefault(stage, [np.inf, 0, 0])
+                        best[0] = min(best[0], seconds)
+                        best[1] = max(best[1], rss.peak)
+                        best[2] = max(best[2], rss.peak - rss.start)
+            os.remove(path)
+            for stage in STAGES:
+                if stage in timings:
+                    seconds, peak, delta = timings[stage]
+                    results.append({"n_cells": n_cells, "n_genes": n_genes, "stage": stage,
+                                    "seconds": seconds, "peak_rss_mb": peak / 2.0**20,
+                                    "delta_rss_mb": delta / 2.0**20})
+    finally:
+        cache._cache = enabled
+        if workdir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {"environment": environment(), "import_seconds": import_time(), "results": results}
+
+
+def import_time(statement="import polyseq; polyseq.io.read_cellranger", repeat=5):
+    '''
+    fastest wall time, in seconds, of running `statement` in a fresh
+    interpreter, e.g. the import cost a batch worker pays before loading data
+    '''
+    code = "import time; t = time.perf_counter(); {}; print(time.perf_counter() - t)".format(statement)
+    times = [float(subprocess.check_output([sys.executable, "-c", code]).decode().split()[-1])
+             for _ in range(repeat)]
+    return min(times)
+
+
+def environment():
+    import scipy
+    import sklearn
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__, "scipy": scipy.__version__,
+            "pandas": pd.__version__, "sklearn": sklearn.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05):
+    '''
+    stages that got slower or use more memory than in a baseline run
+
+    Parameters:
+    -----------
+    results, baseline: dict
+        Outputs of run_benchmark (e.g. loaded from JSON)
+    tolerance: float, default=0.25
+        Allowed relative increase
+    min_seconds: float, default=0.05
+        Stages faster than this in both runs are not compared on time, since
+        their timings are mostly noise
+
+    Returns:
+    --------
+    list of dicts with the size, stage, metric, baseline and current values
+    and their ratio, for every metric above the tolerance
+    '''
+    reference = {(r["n_cells"], r["stage"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        old = reference.get((r["n_cells"], r["stage"]))
+        if old is None:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            if metric == "seconds" and max(r[metric], old[metric]) < min_seconds:
+                continue
+            ratio = r[metric] / max(old[metric], 1e-12)
+            if ratio > 1 + tolerance:
+                regressions.append({"n_cells": r["n_cells"], "stage": r["stage"], "metric": metric,
+                                    "baseline": old[metric], "current": r[metric], "ratio": ratio})
+    if "import_seconds" in results and "import_seconds" in baseline:
+        ratio = results["import_seconds"] / max(baseline["import_seconds"], 1e-12)
+        if ratio > 1 + tolerance:
+            regressions.append({"n_cells": 0, "stage": "import", "metric": "seconds",
+                                "baseline": baseline["import_seconds"],
+                                "current": results["import_seconds"], "ratio": ratio})
+    return regressions
+
+
+def report(results, baseline=None):
+    '''
+    table of the results, with ratios to a baseline run if one is given
+    '''
+    table = pd.DataFrame(results["results"]).set_index(["n_cells", "stage"])
+    table = table[["seconds", "peak_rss_mb", "delta_rss_mb"]]
+    if baseline is not None:
+        old = pd.DataFrame(baseline["results"]).set_index(["n_cells", "stage"])
+        table["seconds_ratio"] = table["seconds"] / old["seconds"].reindex(table.index)
+        table["peak_ratio"] = table["peak_rss_mb"] / old["peak_rss_mb"].reindex(table.index)
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the polyseq pipeline on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--genes", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.sizes, args.stages, args.genes, args.repeat, args.jobs)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    with pd.option_context("display.width", 120, "display.max_rows", None):
+        print(report(results, baseline).round(3))
+    print("import polyseq + io: {:.3f} s".format(results["import_seconds"]))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print("regression: {n_cells} cells, {stage}, {metric}: {baseline:.3g} -> {current:.3g} "
+                  "({ratio:.2f}x)".format(**r))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
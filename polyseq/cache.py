@@ -0,0 +1,306 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+
+from polyseq import instrument
+
+# arrays are hashed in chunks of about this many bytes, in parallel, and
+# the chunk digests combined; hashlib releases the GIL on large updates
+CHUNK_BYTES = 2**24
+# objects in object arrays (e.g. string indices) joined per chunk
+CHUNK_OBJECTS = 2**16
+
+
+class Unhashable(TypeError):
+    pass
+
+
+def _chunk_digest(arr, start, stop):
+    chunk = arr[start:stop]
+    if arr.dtype == object:
+        data = "\x00".join(map(str, chunk.reshape(-1))).encode()
+    else:
+        data = np.ascontiguousarray(chunk).view(np.uint8).reshape(-1)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _hash_array(h, arr):
+    arr = np.asarray(arr)
+    h.update(repr((arr.shape, arr.dtype.str)).encode())
+    if arr.size == 0:
+        return
+    # every element is hashed, one chunk of leading-axis rows at a time
+    row_size = arr.size // arr.shape[0]
+    if arr.dtype == object:
+        rows = max(1, CHUNK_OBJECTS // max(row_size, 1))
+    else:
+        rows = max(1, CHUNK_BYTES // max(row_size * arr.itemsize, 1))
+    starts = range(0, arr.shape[0], rows)
+    if len(starts) == 1:
+        h.update(_chunk_digest(arr, 0, arr.shape[0]))
+        return
+    with ThreadPoolExecutor(min(len(starts), os.cpu_count() or 1)) as pool:
+        for digest in pool.map(lambda start: _chunk_digest(arr, start, start + rows), starts):
+            h.update(digest)
+
+
+def _hash_index(h, index):
+    if isinstance(index, pd.MultiIndex):
+        h.update(repr(("multi", list(index.names))).encode())
+        for level, codes in zip(index.levels, index.codes):
+            _hash_array(h, np.asarray(level))
+            _hash_array(h, codes)
+    elif isinstance(index, pd.RangeIndex):
+        h.update(repr(("range", index.start, index.stop, index.step, index.name)).encode())
+    else:
+        h.update(repr(("index", index.name)).encode())
+        _hash_array(h, np.asarray(index))
+
+
+def _hash_path(h, path):
+    '''
+    a path is identified by the names, sizes and modification times of the
+    file or the files directly inside the directory, not by their contents
+    '''
+    path = os.path.abspath(os.path.expanduser(path))
+    if os.path.isdir(path):
+        entries = sorted(os.listdir(path))
+        stats = [(name, os.stat(os.path.join(path, name))) for name in entries]
+    else:
+        stats = [("", os.stat(path))]
+    h.update(repr((path, [(name, st.st_size, st.st_mtime_ns) for name, st in stats])).encode())
+
+
+def _is_dtype(obj):
+    try:
+        np.dtype(obj)
+    except TypeError:
+        return False
+    return True
+
+
+def _update(h, obj):
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(repr((type(obj).__name__, obj)).encode())
+    elif isinstance(obj, (type, np.dtype)):
+        h.update(repr(("dtype", np.dtype(obj).str if _is_dtype(obj) else obj.__qualname__)).encode())
+    elif isinstance(obj, (list, tuple)):
+        h.update(repr((type(obj).__name__, len(obj))).encode())
+        for item in obj:
+            _update(h, item)
+    elif isinstance(obj, dict):
+        h.update(repr(("dict", len(obj))).encode())
+        for key in sorted(obj, key=repr):
+            _update(h, key)
+            _update(h, obj[key])
+    elif isinstance(obj, np.ndarray):
+        _hash_array(h, obj)
+    elif issparse(obj):
+        obj = obj.tocsr()
+        h.update(repr(("csr", obj.shape)).encode())
+        for arr in (obj.data, obj.indices, obj.indptr):
+            _hash_array(h, arr)
+    elif isinstance(obj, pd.Index):
+        _hash_index(h, obj)
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(type(obj).__name__.encode())
+        _hash_array(h, obj.values)
+        _hash_index(h, obj.index)
+        if isinstance(obj, pd.DataFrame):
+            _hash_index(h, obj.columns)
+    elif hasattr(obj, "matrix") and hasattr(obj, "index") and hasattr(obj, "columns"):
+        # SparseExpressionMatrix
+        h.update(type(obj).__name__.encode())
+        _update(h, obj.matrix)
+        _hash_index(h, obj.index)
+        _hash_index(h, obj.columns)
+    else:
+        raise Unhashable("cannot fingerprint {}".format(type(obj).__name__))
+
+
+def fingerprint(*objs):
+    '''
+    short hex digest identifying arrays, matrices, indices and plain values
+
+    Every element of an array is hashed, in chunks of CHUNK_BYTES spread
+    over threads, so any edit changes the digest. Raises Unhashable for
+    objects it does not know how to identify.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for obj in objs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    '''
+    Directory of pickled results with a total size limit
+
+    Entries are files named by their key. Reading an entry refreshes its
+    modification time, and storing one evicts the least recently used
+    entries until the directory fits in `max_bytes`.
+
+    Parameters:
+    -----------
+    directory: str
+        Where entries are kept; created if needed
+    max_bytes: int, default=2**32
+        Size limit of the directory
+    '''
+
+    def __init__(self, directory, max_bytes=2**32):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pkl")
+
+    def get(self, key):
+        '''
+        returns (True, value) for a stored key and (False, None) otherwise
+        '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        os.utime(path)
+        return True, value
+
+    def put(self, key, value):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pkl"):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, name))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for _, _, name in self._entries():
+            os.unlink(os.path.join(self.directory, name))
+
+
+_cache = None
+
+
+def enable(directory="~/.cache/polyseq", max_bytes=2**32):
+    '''
+    turns on memoization of the decorated pipeline stages (read_cellranger,
+    regress, dim.pca, graph_cluster) in an on-disk cache
+
+    Parameters:
+    -----------
+    directory: str, default="~/.cache/polyseq"
+        Cache directory
+    max_bytes: int, default=2**32
+        Size limit; least recently used results are evicted beyond it
+    '''
+    global _cache
+    _cache = DiskCache(directory, max_bytes)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def memoize(func=None, paths=(), ignore=(), uncached_if=None):
+    '''
+    decorator that looks results up in the cache turned on with `enable`
+
+    The key combines the function's qualified name with a fingerprint of
+    its bound arguments, defaults included. Calls whose arguments cannot be
+    fingerprinted, or for which `uncached_if(arguments)` is true (e.g. when
+    they have side effects), run directly, as does everything while the
+    cache is off.
+
+    Parameters:
+    -----------
+    paths: tuple of str, default=()
+        Names of arguments that are file or directory paths; they are
+        identified by file sizes and modification times
+    ignore: tuple of str, default=()
+        Names of arguments that do not change the result (e.g. numbers of
+        threads or block sizes) and are left out of the key
+    uncached_if: callable, default=None
+        Receives the dict of bound arguments
+    '''
+    if func is None:
+        return functools.partial(memoize, paths=paths, ignore=ignore, uncached_if=uncached_if)
+    signature = inspect.signature(func)
+    name = "{}.{}".format(func.__module__, func.__qualname__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _cache is None:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = dict(bound.arguments)
+        if uncached_if is not None and uncached_if(arguments):
+            return func(*args, **kwargs)
+        try:
+            h = hashlib.blake2b(digest_size=16)
+            h.update(name.encode())
+            for key, value in arguments.items():
+                if key in ignore:
+                    continue
+                _update(h, key)
+                if key in paths and value is not None:
+                    _hash_path(h, value)
+                else:
+                    _update(h, value)
+            key = h.hexdigest()
+        except (Unhashable, OSError):
+            return func(*args, **kwargs)
+
+        hit, value = _cache.get(key)
+        instrument.count("cache_hits" if hit else "cache_misses")
+        if hit:
+            return value
+        value = func(*args, **kwargs)
+        _cache.put(key, value)
+        return value
+
+    return wrapper
@@ -1,266 +1,705 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
-from phenograph.cluster import cluster
+from scipy.sparse import csr_matrix, vstack
+
+from polyseq import instrument
+from polyseq.cache import memoize
+from polyseq.linalg import BLOCK_ENTRIES
+from polyseq.neighbors import nearest_neighbors
+from polyseq.utils import get_pool
+
+
+class NeighborGraph(object):
+    '''
+    k-nearest-neighbor graph of a data set
+
+    Holds the neighbor lists of every cell and caches the graphs derived from
+    them, so that one neighbor search can serve several clusterings.
+
+    Parameters:
+    -----------
+    indices: 2D array of ints
+        Neighbors of each cell, shape (cells, n_neighbors)
+    distances: 2D array
+        Matching distances, each row sorted in increasing order
+    '''
+
+    def __init__(self, indices, distances):
+        self.indices = np.asarray(indices)
+        self.distances = np.asarray(distances)
+        self._cache = {}
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __repr__(self):
+        return "NeighborGraph(cells={}, n_neighbors={})".format(len(self), self.n_neighbors)
+
+    @property
+    def n_neighbors(self):
+        return self.indices.shape[1]
+
+    def truncate(self, n_neighbors):
+        '''
+        graph of the n_neighbors nearest neighbors, derived from this one
+        without a new search; truncated graphs are cached
+        '''
+        if n_neighbors == self.n_neighbors:
+            return self
+        if n_neighbors > self.n_neighbors:
+            raise ValueError("can only truncate to fewer than {} neighbors".format(self.n_neighbors))
+        key = ("truncate", n_neighbors)
+        if key not in self._cache:
+            self._cache[key] = NeighborGraph(self.indices[:, :n_neighbors],
+                                             self.distances[:, :n_neighbors])
+        return self._cache[key]
+
+    def knn(self):
+        '''
+        sparse (cells, cells) adjacency matrix of the neighbor lists
+        '''
+        if "knn" not in self._cache:
+            n, k = self.indices.shape
+            self._cache["knn"] = csr_matrix(
+                (np.ones(n * k, dtype=np.float32), self.indices.ravel(), np.arange(0, n * k + 1, k)),
+                shape=(n, n))
+        return self._cache["knn"]
+
+    def snn(self):
+        '''
+        shared-nearest-neighbor graph: kNN edges weighted by the Jaccard index
+        of the two cells' neighbor lists, symmetrized
+        '''
+        if "snn" not in self._cache:
+            self._cache["snn"] = snn_graph(self.knn())
+        return self._cache["snn"]
+
+
+@instrument.instrumented
+def neighbor_graph(data, n_neighbors=30, method="auto", random_state=None, n_jobs=1):
+    '''
+    build a reusable NeighborGraph
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data of shape (cells, features), typically a PCA projection
+    n_neighbors: int, default=30
+        Number of neighbors per cell
+    method: str, default="auto"
+        Neighbor search, see `polyseq.neighbors.nearest_neighbors`
+    random_state: int, default=None
+        Seed for the approximate search
+    n_jobs: int, default=1
+        Number of threads
+    '''
+    indices, distances = nearest_neighbors(data, n_neighbors, method=method,
+                                           random_state=random_state, n_jobs=n_jobs)
+    return NeighborGraph(indices, distances)
+
+
+@instrument.instrumented
+def snn_graph(knn, chunk_size=None, n_jobs=1):
+    '''
+    shared-nearest-neighbor graph: each kNN edge (i, j) weighted by the
+    Jaccard index of the neighbor lists of i and j, then symmetrized
+
+    Shared-neighbor counts come from the sparse product knn @ knn.T, computed
+    for blocks of rows and immediately restricted to the kNN edges of the
+    block, so memory stays bounded by the block size.
+
+    Parameters:
+    -----------
+    knn: sparse matrix or NeighborGraph
+        kNN graph; only its sparsity pattern is used
+    chunk_size: int, default=None
+        Rows per block
+    n_jobs: int, default=1
+        Number of threads working on blocks
+    '''
+    if isinstance(knn, NeighborGraph):
+        knn = knn.knn()
+    knn = csr_matrix(knn)
+    n = knn.shape[0]
+    pattern = csr_matrix((np.ones(knn.nnz, dtype=np.float32), knn.indices, knn.indptr),
+                         shape=knn.shape)
+    pattern.sum_duplicates()
+    pattern.data[:] = 1
+    transposed = pattern.T.tocsr()
+    degree = np.diff(pattern.indptr)
+    chunk_size = chunk_size or max(1, BLOCK_ENTRIES // max(1, degree.max()**2))
+
+    def block(start):
+        rows = pattern[start:start + chunk_size]
+        shared = rows.multiply(rows @ transposed).tocoo()
+        row = shared.row + start
+        return row, shared.col, shared.data / (degree[row] + degree[shared.col] - shared.data)
+
+    starts = range(0, n, chunk_size)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            blocks = list(executor.map(block, starts))
+    else:
+        blocks = [block(start) for start in starts]
+    row, col, weight = (np.concatenate(parts) for parts in zip(*blocks))
+    jaccard = csr_matrix((weight, (row, col)), shape=(n, n))
+    return ((jaccard + jaccard.T) / 2).tocsr()
+
+
+def modularity(adjacency, labels, resolution=1.0):
+    '''
+    modularity of a partition of a weighted, symmetric graph
+
+    Parameters:
+    -----------
+    adjacency: sparse matrix
+        Symmetric adjacency matrix
+    labels: 1D array of ints
+        Community of each node
+    resolution: float, default=1.0
+        Weight of the null model; larger values favour smaller communities
+    '''
+    adjacency = csr_matrix(adjacency)
+    labels = np.asarray(labels)
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    total = degree.sum()
+    rows = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    internal = adjacency.data[labels[rows] == labels[adjacency.indices]].sum()
+    community_degree = np.bincount(labels, weights=degree)
+    return internal / total - resolution * np.sum((community_degree / total)**2)
+
+
+def _matmul(a, b, n_jobs):
+    if n_jobs <= 1 or a.shape[0] < 2 * n_jobs:
+        return (a @ b).tocsr()
+    # scipy releases the GIL in sparse products, so row blocks run in parallel
+    bounds = np.linspace(0, a.shape[0], n_jobs + 1).astype(int)
+    with ThreadPoolExecutor(n_jobs) as executor:
+        blocks = executor.map(lambda i: a[bounds[i]:bounds[i + 1]] @ b, range(n_jobs))
+        return vstack(list(blocks)).tocsr()
+
+
+def _indicator(labels, n_labels):
+    n = labels.shape[0]
+    return csr_matrix((np.ones(n), labels, np.arange(n + 1)), shape=(n, n_labels))
+
+
+def _move_nodes(adjacency, resolution, rng, n_jobs, max_sweeps=100):
+    '''
+    local moving phase of Louvain, vectorized: every sweep proposes the best
+    move for all nodes at once and applies a random subset of them, keeping
+    the sweep only if modularity increases
+    '''
+    n = adjacency.shape[0]
+    labels = np.arange(n)
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    total = degree.sum()
+    self_loops = adjacency.diagonal()
+    quality = modularity(adjacency, labels, resolution)
+    p_move = 0.5
+
+    for _ in range(max_sweeps):
+        community_degree = np.bincount(labels, weights=degree, minlength=n)
+        # weight from every node to each community it touches
+        links = _matmul(adjacency, _indicator(labels, n), n_jobs)
+        rows = np.repeat(np.arange(n), np.diff(links.indptr))
+        own = links.indices == labels[rows]
+
+        internal = np.zeros(n)
+        internal[rows[own]] = links.data[own]
+        internal -= self_loops
+        stay = internal - resolution * degree * (community_degree[labels] - degree) / total
+
+        gain = links.data - resolution * degree[rows] * community_degree[links.indices] / total
+        gain[own] = -np.inf
+        best = np.full(n, -np.inf)
+        nonempty = np.diff(links.indptr) > 0
+        best[nonempty] = np.maximum.reduceat(gain, links.indptr[:-1][nonempty])
+        candidates = np.flatnonzero(gain == best[rows])
+        first = np.ones(candidates.shape[0], dtype=bool)
+        first[1:] = rows[candidates[1:]] != rows[candidates[:-1]]
+        candidates = candidates[first]
+
+        movers = rows[candidates]
+        improves = best[movers] - stay[movers] > 1e-12 * total
+        candidates, movers = candidates[improves], movers[improves]
+        if movers.shape[0] == 0:
+            break
+
+        chosen = rng.random(movers.shape[0]) < p_move
+        new_labels = labels.copy()
+        new_labels[movers[chosen]] = links.indices[candidates[chosen]]
+        new_quality = modularity(adjacency, new_labels, resolution)
+        if new_quality > quality:
+            labels, quality = new_labels, new_quality
+        else:
+            # simultaneous moves conflicted; move fewer nodes at a time
+            p_move /= 2
+            if p_move * movers.shape[0] < 0.5:
+                break
+    return np.unique(labels, return_inverse=True)[1], quality
+
+
+@instrument.instrumented
+def louvain(adjacency, resolution=1.0, random_state=None, n_jobs=1):
+    '''
+    Louvain community detection on a weighted, symmetric graph
 
-def graph_cluster(data, n_neighbors):
-    clusters, graph, q = cluster(data, k=n_neighbors)
+    Alternates a vectorized local moving phase with aggregation of the
+    communities into nodes until no move improves modularity.
+
+    Parameters:
+    -----------
+    adjacency: sparse matrix
+        Symmetric adjacency matrix
+    resolution: float, default=1.0
+        Weight of the null model; larger values give more communities
+    random_state: int, default=None
+        Seed
+    n_jobs: int, default=1
+        Number of threads for the sparse products
+
+    Returns (labels, modularity), with communities numbered from largest to
+    smallest.
+    '''
+    rng = np.random.default_rng(random_state)
+    graph = csr_matrix(adjacency, dtype=np.float64)
+    labels = np.arange(graph.shape[0])
+    quality = modularity(graph, labels, resolution)
+    while True:
+        communities, level_quality = _move_nodes(graph, resolution, rng, n_jobs)
+        n_communities = communities.max() + 1
+        if n_communities == graph.shape[0]:
+            break
+        labels, quality = communities[labels], level_quality
+        indicator = _indicator(communities, n_communities)
+        graph = _matmul(indicator.T.tocsr(), _matmul(graph, indicator, n_jobs), n_jobs)
+
+    sizes = np.bincount(labels)
+    rank = np.empty_like(sizes)
+    rank[np.argsort(-sizes, kind='stable')] = np.arange(sizes.shape[0])
+    return rank[labels], quality
+
+
+@instrument.instrumented
+@memoize(ignore=("n_jobs",), uncached_if=lambda args: args["return_graph"])
+def graph_cluster(data, n_neighbors=30, resolution=1.0, method="louvain", graph=None,
+                  return_graph=False, random_state=0, n_jobs=1):
+    '''
+    cluster cells by community detection on their shared-nearest-neighbor graph
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data of shape (cells, features), typically a PCA projection
+    n_neighbors: int, default=30
+        Number of neighbors per cell
+    resolution: float, default=1.0
+        Louvain resolution; larger values give more clusters
+    method: str, default="louvain"
+        "louvain", or "phenograph" to run the phenograph package instead
+    graph: NeighborGraph, default=None
+        Neighbor graph from an earlier call; data is then not searched again
+    return_graph: bool, default=False
+        Whether to also return the NeighborGraph for reuse
+    random_state: int, default=0
+        Seed for the neighbor search and Louvain
+    n_jobs: int, default=1
+        Number of threads
+    '''
+    if method == "phenograph":
+        from phenograph.cluster import cluster
+        clusters, _, _ = cluster(data, k=n_neighbors)
+        return clusters
+    if method != "louvain":
+        raise ValueError("unknown clustering method: {}".format(method))
+
+    if graph is None:
+        graph = neighbor_graph(data, n_neighbors, random_state=random_state, n_jobs=n_jobs)
+    key = ("louvain", resolution, random_state)
+    if key not in graph._cache:
+        graph._cache[key] = louvain(graph.snn(), resolution, random_state=random_state,
+                                    n_jobs=n_jobs)
+    clusters, _ = graph._cache[key]
+    if return_graph:
+        return clusters, graph
     return clusters
 
-# import numpy as np
-# import matplotlib.pyplot as plt
-#
-# n = 100
-# s = 0.5
-# a = np.array([[1, 1]]) + s*np.random.randn(n, 2)
-# b = np.array([[-1, -1]]) + s*np.random.randn(n, 2)
-#
-# x = np.vstack([a, b])
-# #x = x[np.random.permutation(np.arange(x.shape[0])), :]
-# plt.scatter(x[:, 0], x[:, 1], s=10)
-#
-#
-#
-# plt.figure(figsize=(12, 5))
-#
-# plt.subplot(1, 2, 1)
-# g = nx.Graph(graph)
-# nx.draw(g, pos=x, node_size=20)
-#
-# plt.subplot(1, 2, 2)
-# plt.scatter(x[:, 0], x[:, 1], c=clusters, cmap='tab20')
-#
-# from itertools import product
-#
-# from sklearn.neighbors import kneighbors_graph
-# import networkx as nx
-# import community
-#
-#
-# def get_communities(graph, resolution):
-#     partition = community.best_partition(graph, resolution=resolution, randomize=True)
-#     res = np.array(list(partition.items()))
-#     clusters = res[:, 1][res[:, 0]]
-#     return clusters
-#
-#
-# def jaccard_index(set_1, set_2):
-#     return len(set_1.intersection(set_2)) / len(set_1.union(set_2))
-#
-#
-# def jaccard(knn):
-#     neighbors = [set(np.where(row)[0]) for row in knn.toarray()]
-#     jacc_inds = (
-#         (i, j, jaccard_index(x, y))
-#         for (i, x), (j, y) in product(enumerate(neighbors), enumerate(neighbors))
-#         if i < j
-#         # if i < j and (knn[i, j] or knn[j, i])
-#     )
-#     return [
-#         (i, j, {"wieght": jacc}) for i, j, jacc in jacc_inds if jacc > 0
-#     ]
-#
-#
-# def graph_cluster(x, n_neighbors):
-#     knn = kneighbors_graph(x, n_neighbors=n_neighbors, include_self=False)
-#     g_nn = nx.from_scipy_sparse_matrix(knn)
-#
-#     knn = kneighbors_graph(x, n_neighbors=n_neighbors, include_self=False)
-#     jaccard_inds = jaccard(knn)
-#     g_jacc = nx.Graph(jaccard_inds)
-#
-#     return knn, g_nn, g_jacc
-#
-# n_neighbors = 20
-# resolution = 20.0
-#
-# knn, g_nn, g_jacc = graph_cluster(x, n_neighbors)
-#
-# plt.figure(figsize=(12, 5))
-#
-# plt.subplot(1, 2, 1)
-# clusters_nn = get_communities(g_nn, resolution=resolution)
-# print(np.unique(clusters_nn).shape[0])
-# plt.scatter(x[:, 0], x[:, 1], c=clusters_nn, cmap='tab20')
-#
-#
-# plt.subplot(1, 2, 2)
-# clusters_jacc = get_communities(g_jacc, resolution=resolution)
-# print(np.unique(clusters_jacc).shape[0])
-# plt.scatter(x[:, 0], x[:, 1], c=clusters_jacc, cmap='tab20')
-#
-#
-# plt.figure(figsize=(12, 5))
-# plt.subplot(1, 2, 1)
-# nx.draw(g_nn, pos=x, node_size=20)
-# plt.subplot(1, 2, 2)
-# nx.draw(g_jacc, pos=x, node_size=20)
-
-# import numpy as np
-# import multiprocessing as mp
-# import pandas as pd
-
-# def getLogW(data, Algorithm, k, algKwargs):
-#     '''
-#     Compute log(sum of squared distances from cluster)
-#     '''
-#     alg = Algorithm(n_clusters=k, **algKwargs)
-#     distsToCenters = alg.fit_transform(data)
-#     labels = alg.labels_
-#     logW = np.log(np.sum(np.choose(labels, distsToCenters.T)**2))
-#     return logW, labels
-#
-# def generateSample(bounds, mean, pca, n):
-#     '''
-#     Generate a sample from the null distribution
-#     '''
-#     proj = [np.random.uniform(low=l, high=h, size=n) for (l, h) in bounds]
-#     proj = np.array(proj).T
-#     orig = pca.inverse_transform(proj)
-#     return mean + orig
-#
-# def getSampleStat(args):
-#     '''
-#     Get the logW statistic for a sample from the null distribution
-#
-#     Needed because multiprocessing.Pool.map only works with functions that
-#     take a single argument.
-#     '''
-#     seed, bounds, mean, pca, n, Algorithm, k, algKwargs = args
-#     np.random.seed(seed)
-#     sample = generateSample(bounds, mean, pca, n)
-#     stat, _ = getLogW(sample, Algorithm, k, algKwargs)
-#     return stat
-#
-# def gapStatistic(data, Algorithm, nSamples, nProcesses=1, cutoff=None,
-#                  algKwargs={}):
-#     '''
-#     Determine the number of clusters via the gap statistic method
-#
-#     Tibsharani, Walther, & Hastie; J.R. Statist. Soc. B, 2001
-#
-#     Parameters:
-#     -----------
-#     data: 2D array-like
-#         Data maxtrix of shape (samples, features)
-#
-#     Algorithm: scikit-learn style clustering algorithm class
-#         e.g. sklearn.cluster.KMeans
-#
-#     nSamples: int
-#         Number of samples from null distribution to use when computing
-#         reference statistics
-#
-#     nProcesses: int, default=1
-#         Number of processes to use for parallel processing of samples from null
-#         distribution. Note: each process will require memory equal to the size
-#         of the original dataset to store the random sample.
-#
-#     cutoff: int, default=None
-#         Maximum number of clusters to try before exiting with an error code (k
-#         = -1)
-#
-#     cutoff: int, default=None
-#         Maximum number of clusters to try before exiting with an error code (k
-#         = -1). If None, then the number of clusters can be artibrarily large,
-#         if supported by the data.
-#
-#     algKwargs: dictionary, default={}
-#        Optional keyword arguments to pass to the clustering algorithm
-#        constructor.
-#
-#     Returns:
-#     --------
-#     k: int
-#         The optimal number of clusters
-#     labels:
-#         Cluster labels when fitting with k clusters
-#     '''
-#     n, k = data.shape
-#
-#     # compute parameters of null distribution
-#     from sklearn.decomposition import PCA
-#     mean = data.mean(axis=0).__array__()
-#     centered = data - mean
-#     pca = PCA(n_components=k).fit(centered)
-#     proj = pca.transform(centered)
-#
-#     bounds = [(v.min(), v.max()) for v in proj.T]
-#     k=1
-#     gapLast = 0
-#     labels = []
-#     p = mp.Pool(processes=nProcesses)
-#     while True:
-#         # cluster true data
-#         labelsLast = labels
-#         logW, labels = getLogW(data, Algorithm, k, algKwargs)
-#         # create and cluster data from null distribution
-#         args = (bounds, mean, pca, n, Algorithm, k, algKwargs)
-#         seedStart = np.random.randint(low=0, high=2*8-1)
-#         args = [(s + seedStart,) + args for s in range(nSamples)]
-#         stats = p.map(getSampleStat, args)
-#         # compute statistics
-#         logWStar = np.mean(stats)
-#         error = np.sqrt(1-1.0/nSamples) * np.std(stats)
-#         gap = logWStar - logW
-#         deltaGap = gap - gapLast
-#         gapLast = gap
-#         k += 1
-#         if k == 2:
-#             continue
-#         if deltaGap < error:
-#             return k - 2, labelsLast
-#         if cutoff is not None and k > cutoff:
-#             print("exiting early")
-#             return -1, labels
-#
-# def hCluster(data, DimAlg, ClustAlg, nSamples=1000, nProcesses=1, cutoff=None,
-#              algKwargs={}):
-#     '''
-#     Top-down hierarchical clustering.
-#
-#     Parameters:
-#     -----------
-#     data: 2D array-like
-#         Data maxtrix of shape (samples, features)
-#
-#     Algorithm: scikit-learn style clustering algorithm class
-#         e.g. sklearn.cluster.KMeans
-#
-#     nSamples: int, default=1000
-#         Number of samples from null distribution to use when using the gap
-#         statistic to determine depth of clustering.
-#
-#     nProcesses: int, default=1
-#         Number of processes to use for parallel processing of samples from null
-#         distribution. Note: each process will require memory equal to the size
-#         of the original dataset to store the random sample.
-#
-#     cutoff: int, default=None
-#         Maximum number of clusters to try before exiting with an error code (k
-#         = -1). If None, then the number of clusters can be artibrarily large,
-#         if supported by the data.
-#
-#     algKwargs: dictionary, default={}
-#        Optional keyword arguments to pass to the clustering algorithm
-#        constructor.
-#
-#     Returns:
-#     --------
-#     '''
-#
-#     args = (ClustAlg, nSamples, nProcesses, cutoff, algKwargs)
-#     reduced = pd.DataFrame(DimAlg(data.__array__()))
-#     reduced.index = data.index
-#     k, labels = gapStatistic(data, *args)
-#
-#     if k == 1:
-#         return {'k': 1}
-#
-#     else:
-#         clusters = [data.index[labels == i].__array__() for i in range(k)]
-#         subclusters = [hCluster(data.loc[inds], DimAlg, *args) for inds in clusters]
-#         return {'k': k, 'clusters': clusters, 'subclusters': subclusters}
-#
+
+def _louvain_job(snn, shape, resolution, random_state):
+    adjacency = csr_matrix((snn["data"], snn["indices"], snn["indptr"]), shape=shape, copy=False)
+    return louvain(adjacency, resolution, random_state=random_state)
+
+
+@instrument.instrumented
+def cluster_sweep(data, resolutions=(1.0,), n_neighbors=(30,), graph=None, random_state=0,
+                  n_processes=1, n_jobs=1):
+    '''
+    graph clustering over a grid of resolutions and neighbor counts
+
+    The neighbor search runs once, for the largest n_neighbors; graphs for
+    smaller values are truncations of it. Settings are clustered in parallel
+    on the shared worker pool and results are memoized on the graph, so
+    repeated or extended sweeps only cluster new settings.
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data of shape (cells, features), typically a PCA projection
+    resolutions: list of floats, default=(1.0,)
+        Louvain resolutions
+    n_neighbors: list of ints, default=(30,)
+        Neighbor counts
+    graph: NeighborGraph, default=None
+        Graph from an earlier call with at least max(n_neighbors) neighbors
+    random_state: int, default=0
+        Seed for the neighbor search and Louvain
+    n_processes: int, default=1
+        Number of worker processes clustering settings in parallel
+    n_jobs: int, default=1
+        Number of threads for the neighbor search
+
+    Returns (clusters, summary, graph). clusters has one column of labels per
+    (n_neighbors, resolution) setting, and summary, indexed the same way,
+    holds the number of clusters and the modularity of each.
+    '''
+    n_neighbors, resolutions = sorted(set(n_neighbors)), sorted(set(resolutions))
+    if graph is None:
+        graph = neighbor_graph(data, max(n_neighbors), random_state=random_state, n_jobs=n_jobs)
+    settings = [(k, r) for k in n_neighbors for r in resolutions]
+    graphs = {k: graph.truncate(k) for k in n_neighbors}
+    key = lambda r: ("louvain", r, random_state)
+    todo = [(k, r) for k, r in settings if key(r) not in graphs[k]._cache]
+
+    pool = get_pool(n_processes)
+    shared = {}
+    try:
+        for k in set(k for k, _ in todo):
+            snn = graphs[k].snn()
+            shared[k] = {name: pool.share(getattr(snn, name))
+                         for name in ("data", "indices", "indptr")}
+        results = pool.map(_louvain_job, [(shared[k], graphs[k].snn().shape, r, random_state)
+                                          for k, r in todo])
+    finally:
+        for arrays in shared.values():
+            pool.release(*arrays.values())
+    for (k, r), result in zip(todo, results):
+        graphs[k]._cache[key(r)] = result
+
+    columns = pd.MultiIndex.from_tuples(settings, names=["n_neighbors", "resolution"])
+    labels = [graphs[k]._cache[key(r)][0] for k, r in settings]
+    clusters = pd.DataFrame(np.column_stack(labels), columns=columns,
+                            index=getattr(data, "index", None))
+    summary = pd.DataFrame({
+        "n_clusters": [setting.max() + 1 for setting in labels],
+        "modularity": [graphs[k]._cache[key(r)][1] for k, r in settings],
+    }, index=columns)
+    return clusters, summary, graph
+
+def _kmeans_plus_plus(X, n_centers, n_problems, rng):
+    '''
+    k-means++ seeding of n_problems independent fits on each sample of X,
+    shape (samples, points, features); returns (samples, problems, centers,
+    features)
+    '''
+    B, n, d = X.shape
+    batch = np.arange(B)[:, None]
+    first = rng.integers(0, n, size=(B, n_problems))
+    centers = np.empty((B, n_problems, n_centers, d), dtype=X.dtype)
+    centers[:, :, 0] = X[batch, first]
+    closest = ((X[:, :, None, :] - centers[:, None, :, 0])**2).sum(axis=-1)
+    for j in range(1, n_centers):
+        cumulative = np.cumsum(closest, axis=1)
+        target = rng.random((B, n_problems)) * cumulative[:, -1]
+        chosen = np.minimum((cumulative < target[:, None]).sum(axis=1), n - 1)
+        centers[:, :, j] = X[batch, chosen]
+        new = ((X[:, :, None, :] - centers[:, None, :, j])**2).sum(axis=-1)
+        np.minimum(closest, new, out=closest)
+    return centers
+
+
+def _assign(X_t, centers, invalid):
+    '''
+    nearest center of every point for stacked fits; X_t has shape (samples,
+    features, points) and centers (samples, K, problems, features). Returns
+    labels and squared distances minus the squared norm of the point, both of
+    shape (samples, problems, points).
+    '''
+    B, K, Q, d = centers.shape
+    center_norms = (centers**2).sum(axis=-1)
+    center_norms[:, invalid] = np.inf
+    dist = (-2 * centers.reshape(B, K * Q, d)) @ X_t
+    dist += center_norms.reshape(B, K * Q, 1)
+    dist = dist.reshape(B, K, Q, -1)
+    # running minimum over the few center slots beats argmin on a short axis
+    best = dist[:, 0].copy()
+    labels = np.zeros(best.shape, dtype=np.intp)
+    better = np.empty(best.shape, dtype=bool)
+    for j in range(1, K):
+        np.less(dist[:, j], best, out=better)
+        np.minimum(best, dist[:, j], out=best)
+        labels += better * (j - labels)
+    return labels, best
+
+
+@instrument.instrumented
+def batched_kmeans(X, ks, n_init=1, max_iter=300, tol=1e-4, random_state=None):
+    '''
+    Lloyd's k-means fitted for several k values, several initializations and
+    several samples at once
+
+    The fits on a sample share one batched matrix product per iteration:
+    their centers are stacked, and unused center slots (beyond k) are masked
+    out. Samples whose fits have all converged drop out of the batch.
+
+    Parameters:
+    -----------
+    X: 3D array
+        Samples of shape (samples, points, features)
+    ks: list of ints
+        Numbers of clusters
+    n_init: int, default=1
+        Initializations per k; the best fit is kept
+    max_iter: int, default=300
+        Maximum number of Lloyd iterations
+    tol: float, default=1e-4
+        Convergence threshold on the squared shift of the centers, relative
+        to the mean feature variance, as in sklearn
+    random_state: int or Generator, default=None
+        Seed
+
+    Returns (inertia, labels), of shapes (samples, len(ks)) and
+    (samples, len(ks), points).
+    '''
+    rng = np.random.default_rng(random_state)
+    X = np.asarray(X, dtype=np.float64)
+    B, n, d = X.shape
+    X_t = np.ascontiguousarray(X.transpose(0, 2, 1))
+    ks = np.asarray(ks)
+    k_of = np.repeat(ks, n_init)
+    Q, K = k_of.shape[0], ks.max()
+    invalid = np.arange(K)[:, None] >= k_of[None, :]
+    threshold = tol * X.var(axis=1).mean(axis=1)
+
+    centers = np.ascontiguousarray(_kmeans_plus_plus(X, K, Q, rng).transpose(0, 2, 1, 3))
+    active = np.arange(B)
+    for _ in range(max_iter):
+        Xa, old = X[active], centers[active]
+        labels, _ = _assign(X_t[active], old, invalid)
+        new = old.copy()
+        for j in range(K):
+            members = (labels == j).astype(np.float64)
+            counts = members.sum(axis=-1)
+            # empty clusters keep their center
+            filled = counts > 0
+            new[:, j][filled] = (members @ Xa)[filled] / counts[filled][:, None]
+        centers[active] = new
+        shift = ((new - old)**2).sum(axis=-1).max(axis=(1, 2))
+        active = active[shift > threshold[active]]
+        if active.shape[0] == 0:
+            break
+
+    labels, dist = _assign(X_t, centers, invalid)
+    inertia = np.maximum(dist + np.einsum('bnd,bnd->bn', X, X)[:, None, :], 0).sum(axis=-1)
+    # best initialization per k
+    inertia = inertia.reshape(B, len(ks), n_init)
+    best = inertia.argmin(axis=-1)
+    labels = labels.reshape(B, len(ks), n_init, n)
+    labels = np.take_along_axis(labels, best[:, :, None, None], axis=2)[:, :, 0]
+    return np.take_along_axis(inertia, best[..., None], axis=-1)[..., 0], labels
+
+
+def _null_dispersion(bounds, n, seeds, ks, max_iter):
+    '''
+    log within-cluster dispersion of uniform reference samples, one per seed
+    '''
+    low, high = bounds
+    samples = np.stack([np.random.default_rng(seed).uniform(low, high, size=(n, low.shape[0]))
+                        for seed in seeds])
+    inertia, _ = batched_kmeans(samples, ks, max_iter=max_iter, random_state=seeds[0])
+    return np.log(inertia)
+
+
+def _data_dispersion(proj, ks, n_init, max_iter, seed):
+    inertia, labels = batched_kmeans(proj[None], ks, n_init=n_init, max_iter=max_iter,
+                                     random_state=seed)
+    return np.log(inertia[0]), labels[0]
+
+
+@instrument.instrumented
+def gap_statistic(data, n_samples=100, cutoff=None, window=4, n_init=4, max_iter=300,
+                  n_processes=1, random_state=0, return_stats=False):
+    '''
+    Determine the number of clusters via the gap statistic method
+
+    Tibshirani, Walther, & Hastie; J.R. Statist. Soc. B, 2001
+
+    Reference samples are drawn uniformly from the bounding box of the data in
+    its principal-component frame. The dispersion is rotation invariant, so
+    they are clustered there directly. Values of k are tried in windows, and
+    each window is one batched k-means fit per group of reference samples.
+    Fits stop at the first window containing the smallest k with
+    gap(k) >= gap(k+1) - s(k+1). Reference samples are regenerated from
+    their seeds in the workers, and the data is published to them once in
+    shared memory.
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data matrix of shape (samples, features), typically a PCA projection
+    n_samples: int, default=100
+        Number of reference samples
+    cutoff: int, default=None
+        Maximum number of clusters to try before exiting with k = -1. If None,
+        the number of clusters is only bounded by the number of samples.
+    window: int, default=4
+        Number of k values fitted together
+    n_init: int, default=4
+        k-means initializations on the data
+    n_processes: int, default=1
+        Number of worker processes
+    random_state: int, default=0
+        Seed
+    return_stats: bool, default=False
+        Whether to also return a DataFrame of gap and s(k) for every k tried
+
+    Returns:
+    --------
+    k: int
+        The optimal number of clusters
+    labels:
+        Cluster labels when fitting with k clusters
+    '''
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+    centered = data - data.mean(axis=0)
+    _, axes = np.linalg.eigh(centered.T @ centered)
+    proj = centered @ axes
+    bounds = (proj.min(axis=0), proj.max(axis=0))
+    k_max = n if cutoff is None else min(n, cutoff + 1)
+
+    seeds = [[random_state, 1 + s] for s in range(n_samples)]
+
+    pool = get_pool(n_processes)
+    shared = pool.share(proj)
+    log_w, log_w_null, labels = {}, {}, {}
+    k, chosen = 1, None
+    try:
+        while chosen is None and k <= k_max:
+            ks = list(range(k, min(k + window, k_max + 1)))
+            # reference samples per job, so that each fit stays near BLOCK_ENTRIES
+            batch_size = max(1, BLOCK_ENTRIES // (n * (data.shape[1] + len(ks) * ks[-1])))
+            batches = [seeds[i:i + batch_size] for i in range(0, n_samples, batch_size)]
+            jobs = [(_data_dispersion, (shared, ks, n_init, max_iter, [random_state, 0]))]
+            jobs += [(_null_dispersion, (bounds, n, batch, ks, max_iter)) for batch in batches]
+            results = pool.map(_run_job, jobs)
+            data_log_w, data_labels = results[0]
+            null = np.concatenate(results[1:])
+            for i, kk in enumerate(ks):
+                log_w[kk], log_w_null[kk], labels[kk] = data_log_w[i], null[:, i], data_labels[i]
+            for kk in range(max(1, k - 1), ks[-1]):
+                if _gap(log_w, log_w_null, kk) >= _gap(log_w, log_w_null, kk + 1) - _spread(log_w_null, kk + 1):
+                    chosen = kk
+                    break
+            k = ks[-1] + 1
+    finally:
+        pool.release(shared)
+
+    if chosen is None:
+        chosen, result_labels = -1, labels[max(labels)]
+    else:
+        result_labels = labels[chosen]
+    if return_stats:
+        stats = pd.DataFrame({
+            "gap": [_gap(log_w, log_w_null, kk) for kk in sorted(log_w)],
+            "s": [_spread(log_w_null, kk) for kk in sorted(log_w)],
+        }, index=pd.Index(sorted(log_w), name="k"))
+        return chosen, result_labels, stats
+    return chosen, result_labels
+
+
+def _run_job(func, args):
+    return func(*args)
+
+
+def _gap(log_w, log_w_null, k):
+    return log_w_null[k].mean() - log_w[k]
+
+
+def _spread(log_w_null, k):
+    null = log_w_null[k]
+    return null.std() * np.sqrt(1 + 1.0 / null.shape[0])
+
+
+def hCluster(data, DimAlg, ClustAlg=None, nSamples=1000, nProcesses=1, cutoff=None,
+             algKwargs={}):
+    '''
+    Top-down hierarchical clustering.
+
+    Each level reduces its cells with DimAlg, picks the number of clusters
+    with `gap_statistic` and recurses into every cluster.
+
+    Parameters:
+    -----------
+    data: pd.DataFrame
+        Data maxtrix of shape (samples, features)
+
+    DimAlg: function
+        Dimensionality reduction, e.g. polyseq.dim.pca; for functions that
+        return a tuple, the first element is the projection
+
+    ClustAlg: scikit-learn style clustering algorithm class, default=None
+        e.g. sklearn.cluster.KMeans, used to label the cells once k is chosen.
+        If None, the labels of the gap statistic's own k-means are used.
+
+    nSamples: int, default=1000
+        Number of samples from null distribution to use when using the gap
+        statistic to determine depth of clustering.
+
+    nProcesses: int, default=1
+        Number of processes to use for the gap statistic
+
+    cutoff: int, default=None
+        Maximum number of clusters to try before exiting with an error code (k
+        = -1). If None, then the number of clusters can be artibrarily large,
+        if supported by the data.
+
+    algKwargs: dictionary, default={}
+       Optional keyword arguments to pass to the clustering algorithm
+       constructor.
+
+    Returns:
+    --------
+    Nested dictionaries with the number of clusters 'k' and, when k > 1, the
+    cell labels of each cluster under 'clusters' and their own trees under
+    'subclusters'.
+    '''
+    data = pd.DataFrame(data)
+    if data.shape[0] < 3:
+        return {'k': 1}
+    reduced = DimAlg(data.__array__())
+    if isinstance(reduced, tuple):
+        reduced = reduced[0]
+    reduced = np.asarray(reduced)
+    if reduced.ndim != 2 or reduced.shape[1] == 0:
+        return {'k': 1}
+
+    k, labels = gap_statistic(reduced, n_samples=nSamples, cutoff=cutoff,
+                              n_processes=nProcesses)
+    if k == 1:
+        return {'k': 1}
+    if k == -1:
+        return {'k': -1}
+    if ClustAlg is not None:
+        labels = ClustAlg(n_clusters=k, **algKwargs).fit_predict(reduced)
+
+    args = (DimAlg, ClustAlg, nSamples, nProcesses, cutoff, algKwargs)
+    clusters = [data.index[labels == i].__array__() for i in range(k)]
+    subclusters = [hCluster(data.loc[inds], *args) for inds in clusters]
+    return {'k': k, 'clusters': clusters, 'subclusters': subclusters}
+
 # def _factor_error(data, k, alpha, beta, frac, seed):
 #     from rpy2 import robjects as ro
 #     from rpy2.robjects.packages import importr
@@ -1,32 +1,229 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sklearn.svm import LinearSVC
+import pandas as pd
+from scipy.sparse import csc_matrix, csr_matrix, issparse
+from scipy.stats import norm
+from scipy.stats import t as t_dist
+
+from polyseq import instrument
+from polyseq.linalg import BLOCK_ENTRIES
+
+
+def benjamini_hochberg(pvalues):
+    '''
+    Benjamini-Hochberg adjusted p-values along the last axis
+    '''
+    pvalues = np.asarray(pvalues, dtype=np.float64)
+    m = pvalues.shape[-1]
+    order = np.argsort(pvalues, axis=-1)
+    ranked = np.take_along_axis(pvalues, order, axis=-1) * m / np.arange(1, m + 1)
+    ranked = np.minimum.accumulate(ranked[..., ::-1], axis=-1)[..., ::-1]
+    adjusted = np.empty_like(ranked)
+    np.put_along_axis(adjusted, order, np.minimum(ranked, 1), axis=-1)
+    return adjusted
+
+
+def welch_t(mean_a, var_a, n_a, mean_b, var_b, n_b):
+    '''
+    Welch's t statistic and two-sided p-value from group means, variances
+    and sizes; arguments broadcast
+    '''
+    se2_a = np.maximum(var_a, 0) / np.maximum(n_a, 1)
+    se2_b = np.maximum(var_b, 0) / np.maximum(n_b, 1)
+    se = np.sqrt(se2_a + se2_b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(se > 0, (mean_a - mean_b) / se, 0.0)
+        df = (se2_a + se2_b)**2 / (se2_a**2 / np.maximum(n_a - 1, 1) + se2_b**2 / np.maximum(n_b - 1, 1))
+    pvalue = np.where(se > 0, 2 * t_dist.sf(np.abs(t), np.nan_to_num(df, nan=1.0)), 1.0)
+    return t, pvalue
 
-def upregulated(data, n=20):
+
+def _column_ranks(block):
+    '''
+    average ranks of the nonzero entries of a CSC block within their column,
+    counting the column's implicit zeros, plus each column's rank of zero and
+    tie term sum(t**3 - t)
+    '''
+    n_cells, n_genes = block.shape
+    nnz = np.diff(block.indptr)
+    n_zeros = n_cells - nnz
+    column = np.repeat(np.arange(n_genes), nnz)
+    order = np.lexsort((block.data, column))
+    values, column = block.data[order], column[order]
+
+    # runs of tied values within a column
+    starts = np.ones(values.shape[0], dtype=bool)
+    starts[1:] = (values[1:] != values[:-1]) | (column[1:] != column[:-1])
+    run = np.cumsum(starts) - 1
+    run_start = np.flatnonzero(starts)
+    run_length = np.diff(np.append(run_start, values.shape[0]))
+    position = np.arange(values.shape[0]) - block.indptr[column]
+    average = (position[run_start] + (run_length + 1) / 2.0)[run]
+
+    negative = np.bincount(column, weights=values < 0, minlength=n_genes)
+    ranks = np.empty(values.shape[0])
+    ranks[order] = average + np.where(values > 0, n_zeros[column], 0)
+    zero_rank = negative + (n_zeros + 1) / 2.0
+    ties = np.bincount(column[run_start], weights=run_length**3.0 - run_length, minlength=n_genes)
+    ties += n_zeros**3.0 - n_zeros
+    return ranks, zero_rank, ties
+
+
+def _marker_block(block, indicator, sizes):
+    '''
+    one-vs-rest statistics of every cluster for a CSC block of genes
     '''
-    computes top features that differentiate each cluster from others using SVM
+    n_cells = block.shape[0]
+    n_rest = n_cells - sizes[:, None]
+    sums = np.asarray((indicator @ block).todense())
+    sq_sums = np.asarray((indicator @ block.multiply(block)).todense())
+    expressing = np.asarray((indicator @ (block != 0).astype(np.float64)).todense())
+
+    mean_in = sums / sizes[:, None]
+    mean_out = (sums.sum(axis=0) - sums) / np.maximum(n_rest, 1)
+    var_in = (sq_sums - sizes[:, None] * mean_in**2) / np.maximum(sizes[:, None] - 1, 1)
+    var_out = ((sq_sums.sum(axis=0) - sq_sums) - n_rest * mean_out**2) / np.maximum(n_rest - 1, 1)
+    t, t_pvalue = welch_t(mean_in, var_in, sizes[:, None], mean_out, var_out, n_rest)
+
+    # Wilcoxon rank-sum from one ranking per gene: clusters add up the ranks
+    # of their nonzero entries and the shared rank of their zeros
+    ranks, zero_rank, ties = _column_ranks(block)
+    ranked = csc_matrix((ranks, block.indices, block.indptr), shape=block.shape)
+    rank_sums = np.asarray((indicator @ ranked).todense())
+    rank_sums += (sizes[:, None] - expressing) * zero_rank
+    u = rank_sums - sizes[:, None] * (sizes[:, None] + 1) / 2.0
+    sigma = np.sqrt(sizes[:, None] * n_rest / 12.0
+                    * ((n_cells + 1) - ties / (n_cells * (n_cells - 1.0))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(sigma > 0, (u - sizes[:, None] * n_rest / 2.0) / sigma, 0.0)
+
+    return {
+        "mean_in": mean_in,
+        "mean_out": mean_out,
+        "logfoldchange": np.log2((mean_in + 1e-9) / (mean_out + 1e-9)),
+        "frac_in": expressing / sizes[:, None],
+        "frac_out": (expressing.sum(axis=0) - expressing) / np.maximum(n_rest, 1),
+        "wilcoxon_z": z,
+        "wilcoxon_pvalue": 2 * norm.sf(np.abs(z)),
+        "t": t,
+        "t_pvalue": t_pvalue,
+    }
+
+
+@instrument.instrumented
+def markers(data, clusters=None, chunk_size=None, n_jobs=1):
+    '''
+    one-vs-rest marker statistics for every cluster and every gene
+
+    A single pass over blocks of genes computes, for all clusters at once,
+    the Wilcoxon rank-sum test (genes are ranked once and the ranks are summed
+    per cluster), Welch's t-test and the log2 fold change of means. Sparse
+    input is ranked from its nonzero entries only. p-values are corrected per
+    cluster with Benjamini-Hochberg.
+
+    Parameters:
+    -----------
+    data: ExpressionMatrix, SparseExpressionMatrix or 2D array-like
+        Data of shape (cells, genes)
+    clusters: 1D array-like, default=None
+        Cluster of each cell. Defaults to data.clusters.
+    chunk_size: int, default=None
+        Genes per block
+    n_jobs: int, default=1
+        Number of threads working on blocks
+
+    Returns:
+    --------
+    DataFrame indexed by (cluster, gene) with the means, fractions of cells
+    expressing, log fold change, Wilcoxon z, Welch t and their raw and
+    adjusted p-values.
+    '''
+    if clusters is None:
+        clusters = data.clusters
+    names, codes = np.unique(np.asarray(clusters), return_inverse=True)
+    sizes = np.bincount(codes).astype(np.float64)
+    n_cells = codes.shape[0]
+    indicator = csr_matrix((np.ones(n_cells), (codes, np.arange(n_cells))),
+                           shape=(names.shape[0], n_cells))
+
+    genes = getattr(data, "columns", None)
+    matrix = data.matrix if hasattr(data, "matrix") else data
+    if issparse(matrix):
+        matrix = csc_matrix(matrix, dtype=np.float64)
+    else:
+        matrix = np.asarray(matrix, dtype=np.float64)
+    n_genes = matrix.shape[1]
+    if genes is None:
+        genes = pd.RangeIndex(n_genes)
+    chunk_size = chunk_size or max(1, BLOCK_ENTRIES // max(1, n_cells))
+
+    def block(start):
+        chunk = csc_matrix(matrix[:, start:start + chunk_size])
+        chunk.eliminate_zeros()
+        return _marker_block(chunk, indicator, sizes)
+
+    starts = range(0, n_genes, chunk_size)
+    if n_jobs > 1:
+        with ThreadPoolExecutor(n_jobs) as executor:
+            blocks = list(executor.map(block, starts))
+    else:
+        blocks = [block(start) for start in starts]
+    stats = {key: np.hstack([b[key] for b in blocks]) for key in blocks[0]}
+    stats["wilcoxon_padj"] = benjamini_hochberg(stats["wilcoxon_pvalue"])
+    stats["t_padj"] = benjamini_hochberg(stats["t_pvalue"])
+
+    index = pd.MultiIndex.from_product([names, genes], names=["cluster", "gene"])
+    columns = ["mean_in", "mean_out", "logfoldchange", "frac_in", "frac_out",
+               "wilcoxon_z", "wilcoxon_pvalue", "wilcoxon_padj", "t", "t_pvalue", "t_padj"]
+    return pd.DataFrame({key: stats[key].ravel() for key in columns}, index=index)
+
+
+@instrument.instrumented
+def upregulated(data, n=20, method="wilcoxon", n_jobs=1):
+    '''
+    computes top features that differentiate each cluster from the others
 
     Parameters
     ----------
-    data: ndarray
-        2D array that is (observations, features)
-    clusters: ndarray
-        1D array of ints representing cluster lables of lenth (observations)
+    data: ExpressionMatrix or SparseExpressionMatrix
+        Data of shape (observations, features) with cluster labels
     n: int
         Number of top features to compute
+    method: str, default="wilcoxon"
+        "wilcoxon" or "t" to rank genes by the statistics of `markers`, or
+        "svm" to rank them by the weights of a linear SVM fit per cluster
+    n_jobs: int, default=1
+        Number of threads for `markers`
 
     Returns
     -------
-    features: ndarray
-        2D array containing the sorted indices the top features defining each
-        cluster, or size (clusters, n)
+    features: list
+        For each cluster, the names of its top upregulated features, best first
     '''
+    if method == "svm":
+        return _upregulated_svm(data, n)
+
+    if method == "t" and hasattr(data, "cluster_stats"):
+        # Welch's t needs only the cached per-cluster statistics
+        stats = data.cluster_stats()
+        scores = [stats.compare(cluster)["t"] for cluster in stats.clusters]
+    else:
+        score = {"wilcoxon": "wilcoxon_z", "t": "t"}[method]
+        stats = markers(data, n_jobs=n_jobs)[score]
+        scores = [stats.xs(cluster, level="cluster") for cluster in stats.index.levels[0]]
+
+    return [list(s[s > 0].sort_values(ascending=False, kind='stable').index[:n]) for s in scores]
+
+
+def _upregulated_svm(data, n):
+    from sklearn.svm import LinearSVC
     clusters = data.clusters
-    svc = LinearSVC(verbose=True)
+    svc = LinearSVC()
 
     results = []
 
     for i in np.unique(clusters):
-        print("finding genes for cluster {}".format(i+1))
         labels = clusters == i
         svc.fit(data, labels)
         w = svc.coef_[0]
@@ -35,6 +232,6 @@ def upregulated(data, n=20):
         pos_vals = z[pos_inds]
         pos_top_k = np.argsort(-pos_vals)[:n]
         top_k = pos_inds[pos_top_k]
-        results.append(top_k)
+        results.append(list(data.columns[top_k]))
 
-    return data.columns[np.array(results)].tolist()
+    return results
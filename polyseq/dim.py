@@ -2,14 +2,19 @@ import warnings
 
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from sklearn.neighbors.kde import KernelDensity
+from scipy.sparse import issparse
 import umap as umap_module
 
-from polyseq.utils import parallelize
+from polyseq import instrument
+from polyseq.cache import memoize
+from polyseq.density import binned_kde
+from polyseq.linalg import ZScoredOperator, randomized_pca, shuffled_top_eigenvalues
+from polyseq.utils import get_pool
+from polyseq.viz import STYLE_CONTEXTS
 from polyseq.expression_matrix import ExpressionMatrix
 
 
+@instrument.instrumented
 def tsne(data, algo='sklearn', **kwargs):
     '''
     wrapper for multicore TSNE algorithm
@@ -24,6 +29,7 @@ def tsne(data, algo='sklearn', **kwargs):
     col_names = ["tsne-{}".format(i) for i in range(tsne.shape[1])]
     return ExpressionMatrix(tsne, columns=col_names)._finalize(index=data.index)
 
+@instrument.instrumented
 def umap(data, **kwargs):
     '''
     wrapper for umap algorithm
@@ -33,47 +39,76 @@ def umap(data, **kwargs):
     return ExpressionMatrix(embedding, columns=col_names)._finalize(index=data.index)
 
 
-def pca(data, k=None, n_shuffles=100, alpha=0.05, n_processes=1, max_pcs=100, plot=False):
+def _shuffled_eigenvalues(data, operator, n_shuffles, n_processes=1, batch_size=8):
+    '''
+    top covariance eigenvalue of the z-scored data under independent shuffles
+    of each gene across cells, one per shuffle
+
+    Shuffles are run in batches; for dense data a batch shares each pass
+    over the data (see shuffled_top_eigenvalues). With several processes the
+    data are published once in shared memory and every worker of the
+    persistent pool attaches to the same pages.
+    '''
+    if hasattr(data, "matrix") and issparse(data.matrix):
+        data = data.matrix
+    pool = get_pool(n_processes)
+    if issparse(data):
+        csc = data.tocsc()
+        arrays = {"data": pool.share(csc.data, dtype=np.float64),
+                  "indptr": pool.share(csc.indptr)}
+    else:
+        arrays = {"dense": pool.share(data, dtype=np.float64, order='F')}
+
+    seeds = list(range(n_shuffles))
+    batches = [seeds[i:i + batch_size] for i in range(0, n_shuffles, batch_size)]
+    shape, mean, scale = operator.shape, operator.mean, operator.scale
+    try:
+        results = pool.map(shuffled_top_eigenvalues,
+                           [(arrays, shape, mean, scale, batch) for batch in batches])
+    finally:
+        pool.release(*arrays.values())
+    return np.concatenate(results)
+
+@instrument.instrumented
+@memoize(ignore=("n_processes", "chunk_size"), uncached_if=lambda args: args["plot"])
+def pca(data, k=None, n_shuffles=100, alpha=0.05, n_processes=1, max_pcs=100, plot=False,
+        chunk_size=None):
     '''
     Principal components analysis with shuffle test
+
+    Genes are z-scored implicitly: centering and scaling are folded into the
+    matrix products of a randomized SVD, which streams over row blocks of the
+    input. Dense, sparse (SparseExpressionMatrix or scipy.sparse) and
+    memory-mapped inputs are supported without making z-scored copies.
+
+    Parameters:
+    -----------
+    data: ExpressionMatrix, SparseExpressionMatrix or 2D array-like
+        Data of shape (cells, genes)
+    k: int, default=None
+        Number of components. If None, it is chosen with a shuffle test.
+    chunk_size: int, default=None
+        Rows per streamed block
     '''
-    centered = data - data.mean(axis=0)
-    zscored = centered/centered.std(axis=0)
+    operator = ZScoredOperator(data, chunk_size)
+    index = getattr(data, "index", None)
 
     if k is not None:
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            pca = PCA(n_components=k, svd_solver='randomized')
-        proj = pca.fit_transform(zscored)
+        with instrument.span("fit", k=k):
+            proj, _, _ = randomized_pca(operator, k)
         col_names = ["pc-{}".format(i) for i in range(proj.shape[1])]
-        return ExpressionMatrix(proj, columns=col_names)._finalize(index=data.index)
-
-    def bootstrap_pc(seed):
-        np.random.seed(seed)
-
-        b = np.copy(zscored)
-        nrows, ncols = b.shape
-        for i in range(ncols):
-            b[:, i] = b[:, i][np.random.permutation(nrows)]
-
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            pca = PCA(n_components=1, svd_solver='randomized')
-        pca.fit(b)
-        return pca.explained_variance_[0]
+        return ExpressionMatrix(proj, columns=col_names)._finalize(index=index)
 
-    args = [(i,) for i in range(n_shuffles)]
-    scores = parallelize(bootstrap_pc, args, n_processes)
+    with instrument.span("shuffle_test", n_shuffles=n_shuffles):
+        scores = _shuffled_eigenvalues(data, operator, n_shuffles, n_processes)
     cutoff = np.percentile(scores, 100 * (1 - alpha))
 
-    with warnings.catch_warnings():
-        warnings.simplefilter('ignore')
-        pca = PCA(n_components=max_pcs, svd_soler='randomized')
-    proj = pca.fit_transform(zscored)
+    with instrument.span("fit", k=max_pcs):
+        proj, explained_variance, _ = randomized_pca(operator, max_pcs)
 
-    inds = np.where(pca.explained_variance_ < cutoff)[0]
+    inds = np.where(explained_variance < cutoff)[0]
     if inds.shape == (0,):
-        print("all PCs computed are significant; you might try increasing max_pcs")
+        warnings.warn("all PCs computed are significant; you might try increasing max_pcs")
         n_pcs = max_pcs
     else:
         n_pcs = inds[0]
@@ -82,16 +117,15 @@ def pca(data, k=None, n_shuffles=100, alpha=0.05, n_processes=1, max_pcs=100, pl
     if plot:
         plt.figure(figsize=(20, 5))
 
-        with plt.style.context(['seaborn-talk', 'seaborn-whitegrid']):
+        with plt.style.context(STYLE_CONTEXTS):
 
             # plot of distribution of bootstrapped PCs
             ax = plt.subplot(1, 2, 1)
             eps = 0.1
             min_score, max_score = (1 - eps) * scores.min(), (1 + eps) * scores.max()
             bandwidth = 3.0 / n_shuffles * (max_score - min_score)
-            kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(scores[:, np.newaxis])
             s = np.linspace(min_score, max_score, 100)
-            density = np.exp(kde.score_samples(s[:, np.newaxis]))
+            density = binned_kde(scores, s, bandwidth)
             ax.fill_between(s.squeeze(), 0, density.squeeze())
             ylim = [0, 1.1 * density.max()]
             plt.plot([cutoff, cutoff], ylim, '--r')
@@ -102,8 +136,8 @@ def pca(data, k=None, n_shuffles=100, alpha=0.05, n_processes=1, max_pcs=100, pl
 
             # plot of final PCs with cutoff
             plt.subplot(1, 2, 2)
-            plt.plot(np.arange(max_pcs) + 1, pca.explained_variance_, 'o-')
-            max_variance = pca.explained_variance_.max()
+            plt.plot(np.arange(max_pcs) + 1, explained_variance, 'o-')
+            max_variance = explained_variance.max()
             xlim = [0, 1.1 * n_pcs]
             ylim = [0, 1.1 * max_variance]
             plt.plot(xlim, [cutoff, cutoff], '--r')
@@ -114,4 +148,4 @@ def pca(data, k=None, n_shuffles=100, alpha=0.05, n_processes=1, max_pcs=100, pl
             plt.ylabel('variance explained')
 
     col_names = ["pc-{}".format(i) for i in range(proj.shape[1])]
-    return ExpressionMatrix(proj, columns=col_names)._finalize(index=data.index), scores, pca.explained_variance_
+    return ExpressionMatrix(proj, columns=col_names)._finalize(index=index), scores, explained_variance
@@ -1,12 +1,43 @@
 import numpy as np
 import pandas as pd
-from scipy.io import mmwrite
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 
+from polyseq import instrument
 from polyseq.utils import cluster_arg_sort
 
 class ExpressionMatrix(pd.DataFrame):
 
+    # cached margins and cluster statistics are dropped on every write
+    # through pandas (item and indexer assignment, inplace methods); the
+    # values themselves are read-only views under copy-on-write
+    def __setitem__(self, key, value):
+        _invalidate(self)
+        pd.DataFrame.__setitem__(self, key, value)
+
+    def isetitem(self, loc, value):
+        _invalidate(self)
+        pd.DataFrame.isetitem(self, loc, value)
+
+    def _update_inplace(self, result, **kwargs):
+        _invalidate(self)
+        pd.DataFrame._update_inplace(self, result, **kwargs)
+
+    @property
+    def loc(self):
+        return _Indexer(pd.DataFrame.loc.fget(self), self)
+
+    @property
+    def iloc(self):
+        return _Indexer(pd.DataFrame.iloc.fget(self), self)
+
+    @property
+    def at(self):
+        return _Indexer(pd.DataFrame.at.fget(self), self)
+
+    @property
+    def iat(self):
+        return _Indexer(pd.DataFrame.iat.fget(self), self)
+
     def _finalize(self, index=None):
         if index is None:
             self.index = pd.Index.rename(self.index, "cell")
@@ -17,59 +48,86 @@ class ExpressionMatrix(pd.DataFrame):
     @property
     def clusters(self):
         if "cluster" in self.index.names:
-            return np.array(self.index.get_level_values("cluster"))
-    
+            return self.cluster_groups().labels
+
     @clusters.setter
     def clusters(self, clusters):
-        if not isinstance(self.index, pd.MultiIndex):
-            self.index = pd.MultiIndex.from_arrays([self.index], names=self.index.names)
-
-        if "cluster" in self.index.names:
-            ind = self.index.names.index("cluster")
-            new_labels = [
-                labels if i != ind else clusters 
-                for i, labels in enumerate(self.index.labels)
-            ]
-            new_levels = [
-                levels if i != ind else np.unique(clusters)
-                for i, levels in enumerate(self.index.levels)
-            ]
-            new_names = self.index.names
-        else:
-            new_labels = self.index.labels + [clusters]
-            new_levels = self.index.levels + [np.unique(clusters)]
-            new_names = self.index.names + ["cluster"]
-
-        self.index = pd.MultiIndex(
-            levels=new_levels, labels=new_labels, names=new_names)
+        self.index = _with_level(self.index, "cluster", clusters)
+        _invalidate(self)
+
+    def cluster_groups(self, by="cluster"):
+        '''
+        integer codes and CSR-style row offsets of the groups of an index
+        level, built once and cached until the index is reassigned; see
+        GroupIndex
+
+        Parameters:
+        -----------
+        by: str, default="cluster"
+            Index level to group cells by
+        '''
+        return _cached(self, ("groups", by), lambda: GroupIndex.from_index(self.index, by))
+
+    def cluster_stats(self, by="cluster"):
+        '''
+        per-cluster sufficient statistics from one pass over the values,
+        cached until the index is reassigned or the values are written to;
+        see ClusterStats
+
+        Parameters:
+        -----------
+        by: str, default="cluster"
+            Index level to group cells by
+        '''
+        return _cached_stats(self, by, self.values)
 
     def get_cluster(self, i):
-        return ExpressionMatrix(self.loc[self.clusters == i])
+        return ExpressionMatrix(self.iloc[self.cluster_groups().rows(i)])
+
+    def iter_clusters(self, by="cluster"):
+        '''
+        yields (label, cells) for every nonempty group of an index level
+        '''
+        groups = self.cluster_groups(by)
+        for code in groups.present():
+            yield groups.categories[code], ExpressionMatrix(self.iloc[groups.rows_of(code)])
+
+    def margins(self):
+        '''
+        per-cell and per-gene totals and detection counts, computed lazily,
+        cached until the values are written to, and carried over to subsets;
+        see Margins
+        '''
+        return _cached(self, "margins", lambda: Margins(self.values))
+
+    def _take(self, rows=None, cols=None):
+        result = ExpressionMatrix(self.iloc[slice(None) if rows is None else rows,
+                                            slice(None) if cols is None else cols])
+        instrument.count_copy(result.values)
+        _carry_margins(self, result, rows, cols, result.values)
+        return result
 
     def drop_cells(self, umis=None, num_genes=None, genes=None, umi_threshold=1):
 
         if isinstance(genes, (int, str)):
             genes = [genes]
 
-        relevant = self if genes is None else self[genes]
-
-        subset = self
-        if umis is not None:
-            subset = subset[relevant.sum(axis=1) >= umis]
-        if num_genes is not None:
-            subset = subset[(relevant >= umi_threshold).sum(axis=1) >= num_genes]
-
-        return ExpressionMatrix(subset)
+        margins = self.margins() if genes is None else Margins(self[genes].values)
+        return self._take(rows=np.flatnonzero(
+            margins.keep_cells(umis, num_genes, umi_threshold)))
 
     def drop_genes(self, umis=None, num_cells=None, umi_threshold=1):
-
-        subset = self
-        if umis is not None:
-            subset = subset.loc[:, subset.sum(axis=0) >= umis]
-        if num_cells is not None:
-            subset = subset.loc[:, (subset >= umi_threshold).sum(axis=0) >= num_cells]
-
-        return ExpressionMatrix(subset)
+        return self._take(cols=np.flatnonzero(
+            self.margins().keep_genes(umis, num_cells, umi_threshold)))
+
+    def qc_filter(self, cell_umis=None, num_genes=None, gene_umis=None, num_cells=None,
+                  umi_threshold=1):
+        '''
+        drops cells and genes in one step; see Margins.qc_masks
+        '''
+        rows, cols = self.margins().qc_masks(cell_umis, num_genes, gene_umis, num_cells,
+                                             umi_threshold)
+        return self._take(rows=np.flatnonzero(rows), cols=np.flatnonzero(cols))
 
     def downsample(self, fraction=None, number=None):
 
@@ -87,43 +145,62 @@ class ExpressionMatrix(pd.DataFrame):
         return ExpressionMatrix(self.iloc[tuple(inds)])
 
     def sort(self, sort_cells=True, sort_genes=True, genes=None):
-        if genes is None:
-            genes = slice(None, None, None)
-        elif isinstance(genes, (int, str)):
+        if isinstance(genes, (int, str)):
             genes = [genes]
 
+        result = self
         if sort_cells:
-            sorted = self.loc[self[genes].sum(axis=1).sort_values(ascending=False).index]
-        else:
-            sorted = self
+            totals = (self.margins() if genes is None else Margins(self[genes].values)).cell_umis
+            result = result._take(rows=np.argsort(-totals, kind="stable"))
 
         if sort_genes:
-            sorted = sorted[sorted.sum(axis=0).sort_values(ascending=False).index]
+            result = result._take(cols=np.argsort(-result.margins().gene_umis, kind="stable"))
 
-        return ExpressionMatrix(sorted)
+        return result
 
     def cluster_sort(self, sort_cells=True, sort_genes=True):
 
         if sort_cells:
-            inds = cluster_arg_sort(self)
+            # known clusters stay contiguous and are ordered by their centroids
+            inds = cluster_arg_sort(self, clusters=self.clusters)
             result = self.iloc[inds]
         else:
             result = self
 
         if sort_genes:
-            inds = cluster_arg_sort(result.T)
+            # genes are compared by their cluster means when clusters are known
+            if self.clusters is not None:
+                inds = cluster_arg_sort(self.cluster_stats().mean().T)
+            else:
+                inds = cluster_arg_sort(result.T)
             result = result.iloc[:, inds]
 
         return ExpressionMatrix(result)
 
     def log_normalize(self):
-        return ExpressionMatrix(np.log(self + 1))
+        result = ExpressionMatrix(np.log(self + 1))
+        instrument.count_copy(result.values)
+        return result
 
     def to_cellranger(self, path):
+        from scipy.io import mmwrite
         arr = coo_matrix(np.array(self).T)
         mmwrite(path + "matrix.mtx", arr)
         self.columns.to_series().to_csv(path + "genes.tsv", sep="\t")
 
+    def to_sparse(self):
+        matrix = csr_matrix(self.values)
+        instrument.count_copy(matrix)
+        return SparseExpressionMatrix(matrix, index=self.index, columns=self.columns)
+
+    def lazy(self, chunk_size=None):
+        '''
+        deferred, block-wise view of this matrix for building a fused
+        preprocessing plan; see polyseq.lazy.LazyMatrix
+        '''
+        from polyseq.lazy import LazyMatrix
+        return LazyMatrix(self, chunk_size=chunk_size)
+
     #def to_csv(self, path, mapping=None):
     #    '''
     #    write data to an CSV file in (genes, cells) format
@@ -144,3 +221,707 @@ class ExpressionMatrix(pd.DataFrame):
     #        final = final.iloc[:, [d-1] + range(d-1)]
     #
     #    final.to_csv(path, index=False)
+
+
+def _as_index(labels):
+    return labels if isinstance(labels, pd.Index) else pd.Index(labels)
+
+
+def _with_level(index, name, values):
+    '''
+    returns a MultiIndex equal to `index` with level `name` set to `values`
+    '''
+    names = list(index.names)
+    arrays = [index.get_level_values(i) for i in range(index.nlevels)]
+    if name in names:
+        arrays[names.index(name)] = values
+    else:
+        arrays.append(values)
+        names.append(name)
+    return pd.MultiIndex.from_arrays(arrays, names=names)
+
+
+class _Indexer(object):
+    '''
+    loc, iloc, at or iat of an ExpressionMatrix; assignments drop its cache
+    '''
+
+    def __init__(self, indexer, data):
+        self._indexer = indexer
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._indexer[key]
+
+    def __setitem__(self, key, value):
+        _invalidate(self._data)
+        self._indexer[key] = value
+
+    def __call__(self, *args, **kwargs):
+        return _Indexer(self._indexer(*args, **kwargs), self._data)
+
+    def __getattr__(self, name):
+        return getattr(self._indexer, name)
+
+
+def _invalidate(data):
+    object.__setattr__(data, "_cache", {})
+
+
+def _source(data):
+    # the matrix of a SparseExpressionMatrix, the block manager of an
+    # ExpressionMatrix (replaced by some inplace operations)
+    return data.__dict__.get("matrix", data.__dict__.get("_mgr"))
+
+
+def _cached(data, key, build):
+    # entries remember the index, columns and matrix they were computed for,
+    # so reassigning any of them (as the clusters setter does) invalidates
+    # them
+    cache = data.__dict__.get("_cache")
+    if cache is None:
+        cache = {}
+        object.__setattr__(data, "_cache", cache)
+    entry = cache.get(key)
+    if not _valid(data, entry):
+        entry = (data.index, data.columns, _source(data), build())
+        cache[key] = entry
+    return entry[3]
+
+
+def _valid(data, entry):
+    return (entry is not None and entry[0] is data.index and entry[1] is data.columns
+            and entry[2] is _source(data))
+
+
+def _carry_margins(data, result, rows, cols, matrix):
+    # margins already known for `data` are updated for the subset rather
+    # than recomputed from scratch; the result shares the subset's matrix
+    cache = data.__dict__.get("_cache") or {}
+    entry = cache.get("margins")
+    if _valid(data, entry):
+        margins = entry[3].take(rows, cols, matrix)
+        _cached(result, "margins", lambda: margins)
+
+
+def _count_at_least(matrix, threshold, axis):
+    '''
+    number of entries >= threshold along `axis` of a CSR matrix, using only
+    the stored entries
+    '''
+    passed = matrix.data >= threshold
+    if axis == 1:
+        cumulative = np.concatenate([[0], np.cumsum(passed)])
+        counts = cumulative[matrix.indptr[1:]] - cumulative[matrix.indptr[:-1]]
+        n_zeros = matrix.shape[1] - np.diff(matrix.indptr)
+    else:
+        counts = np.bincount(matrix.indices[passed], minlength=matrix.shape[1])
+        n_zeros = matrix.shape[0] - np.bincount(matrix.indices, minlength=matrix.shape[1])
+    if threshold <= 0:
+        counts = counts + n_zeros
+    return counts
+
+
+class Margins(object):
+    '''
+    Per-cell and per-gene margins of an expression matrix
+
+    Total UMIs per cell and per gene and, for any threshold t, the number of
+    genes per cell and of cells per gene with at least t UMIs. Everything is
+    computed lazily: the totals and the counts for all requested thresholds
+    come from a single pass over the matrix (row blocks of a dense matrix,
+    or only the stored entries of a sparse one), without a boolean matrix
+    the size of the data. Margins of a subset are derived with `take` from
+    the entries that were dropped, or kept if those are fewer.
+
+    Parameters:
+    -----------
+    matrix: 2D array or scipy.sparse matrix
+        Counts of shape (cells, genes), referenced rather than copied; may
+        be None when `cells` and `genes` already hold every statistic that
+        will be asked for
+    cells, genes: dict, default=None
+        Precomputed statistics, keyed by "umis" or threshold
+    '''
+
+    def __init__(self, matrix, cells=None, genes=None):
+        self.matrix = matrix.tocsr() if issparse(matrix) else matrix
+        # "umis" and thresholds map to per-cell and per-gene arrays
+        self._cells = {} if cells is None else cells
+        self._genes = {} if genes is None else genes
+
+    @instrument.instrumented(name="margins")
+    def _compute(self, thresholds=()):
+        thresholds = [t for t in thresholds if t not in self._cells]
+        if "umis" not in self._cells:
+            thresholds = ["umis"] + thresholds
+        if not thresholds:
+            return
+        matrix = self.matrix
+        if matrix is None:
+            raise ValueError("margins were derived without a matrix to compute {} from"
+                             .format(thresholds))
+        n_cells, n_genes = matrix.shape
+        if issparse(matrix):
+            for key in thresholds:
+                if key == "umis":
+                    rows = np.repeat(np.arange(n_cells), np.diff(matrix.indptr))
+                    self._cells[key] = np.bincount(rows, weights=matrix.data, minlength=n_cells)
+                    self._genes[key] = np.bincount(matrix.indices, weights=matrix.data,
+                                                   minlength=n_genes)
+                else:
+                    self._cells[key] = _count_at_least(matrix, key, axis=1)
+                    self._genes[key] = _count_at_least(matrix, key, axis=0)
+            return
+
+        from polyseq.linalg import BLOCK_ENTRIES
+        cells = {key: np.zeros(n_cells) if key == "umis" else np.zeros(n_cells, dtype=np.int64)
+                 for key in thresholds}
+        genes = {key: np.zeros(n_genes) if key == "umis" else np.zeros(n_genes, dtype=np.int64)
+                 for key in thresholds}
+        chunk_size = max(1, BLOCK_ENTRIES // max(1, n_genes))
+        for start in range(0, n_cells, chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size])
+            stop = start + block.shape[0]
+            for key in thresholds:
+                counted = block if key == "umis" else block >= key
+                cells[key][start:stop] = counted.sum(axis=1)
+                genes[key] += counted.sum(axis=0)
+        self._cells.update(cells)
+        self._genes.update(genes)
+
+    @property
+    def cell_umis(self):
+        self._compute()
+        return self._cells["umis"]
+
+    @property
+    def gene_umis(self):
+        self._compute()
+        return self._genes["umis"]
+
+    def cell_detected(self, threshold=1):
+        '''
+        number of genes with at least `threshold` UMIs in each cell
+        '''
+        self._compute([threshold])
+        return self._cells[threshold]
+
+    def gene_detected(self, threshold=1):
+        '''
+        number of cells with at least `threshold` UMIs of each gene
+        '''
+        self._compute([threshold])
+        return self._genes[threshold]
+
+    def keep_cells(self, umis=None, num_genes=None, umi_threshold=1):
+        keep = np.ones(len(self.cell_umis), dtype=bool)
+        if umis is not None:
+            keep &= self.cell_umis >= umis
+        if num_genes is not None:
+            keep &= self.cell_detected(umi_threshold) >= num_genes
+        return keep
+
+    def keep_genes(self, umis=None, num_cells=None, umi_threshold=1):
+        keep = np.ones(len(self.gene_umis), dtype=bool)
+        if umis is not None:
+            keep &= self.gene_umis >= umis
+        if num_cells is not None:
+            keep &= self.gene_detected(umi_threshold) >= num_cells
+        return keep
+
+    def qc_masks(self, cell_umis=None, num_genes=None, gene_umis=None, num_cells=None,
+                 umi_threshold=1):
+        '''
+        masks of the cells and genes that pass all criteria, from one pass
+
+        Cells and genes are both judged on the margins of the unfiltered
+        matrix, so the result does not depend on the order of the criteria
+        (drop_cells followed by drop_genes judges genes on the kept cells).
+
+        Parameters:
+        -----------
+        cell_umis: number, default=None
+            Minimum total UMIs per cell
+        num_genes: int, default=None
+            Minimum number of genes with at least umi_threshold UMIs per cell
+        gene_umis: number, default=None
+            Minimum total UMIs per gene
+        num_cells: int, default=None
+            Minimum number of cells with at least umi_threshold UMIs per gene
+        umi_threshold: number, default=1
+            UMIs for a gene to count as detected in a cell
+        '''
+        if num_genes is not None or num_cells is not None:
+            self._compute([umi_threshold])
+        return (self.keep_cells(cell_umis, num_genes, umi_threshold),
+                self.keep_genes(gene_umis, num_cells, umi_threshold))
+
+    def take(self, rows=None, cols=None, matrix=None):
+        '''
+        margins of matrix[rows][:, cols]; statistics computed so far are
+        updated from the dropped entries (or recomputed from the kept ones if
+        those are fewer), which are only sliced out temporarily
+
+        Parameters:
+        -----------
+        rows, cols: 1D array-like of int or bool, default=None
+            Kept cells and genes; all if None
+        matrix: 2D array or scipy.sparse matrix, default=None
+            The subset itself, referenced for statistics that have not been
+            computed yet
+        '''
+        cells, genes = dict(self._cells), dict(self._genes)
+        keys = list(cells)
+        if rows is not None:
+            rows = np.arange(self.matrix.shape[0])[rows]
+            cells = {key: value[rows] for key, value in cells.items()}
+            genes = _update(genes, self.matrix, rows, keys, axis=0)
+        if cols is not None:
+            cols = np.arange(self.matrix.shape[1])[cols]
+            genes = {key: value[cols] for key, value in genes.items()}
+            cells = _update(cells, self.matrix, cols, keys, axis=1, other=rows)
+        return Margins(matrix, cells, genes)
+
+
+def _submatrix(matrix, rows=None, cols=None):
+    if rows is not None and cols is not None and not issparse(matrix):
+        return matrix[np.ix_(rows, cols)]
+    if rows is not None:
+        matrix = matrix[rows]
+    if cols is not None:
+        matrix = matrix[:, cols]
+    return matrix
+
+
+def _update(margins, matrix, kept, keys, axis, other=None):
+    '''
+    margins along the other axis after keeping positions `kept` of `axis`,
+    restricted to positions `other` of the other axis
+    '''
+    if not keys:
+        return margins
+    n = matrix.shape[axis]
+    dropped = np.setdiff1d(np.arange(n), kept)
+    if dropped.shape[0] == 0:
+        return margins
+    side = "_genes" if axis == 0 else "_cells"
+    fewer = dropped if dropped.shape[0] < kept.shape[0] else kept
+    part = Margins(_submatrix(matrix, fewer, other) if axis == 0 else _submatrix(matrix, other, fewer))
+    part._compute([key for key in keys if key != "umis"])
+    if fewer is dropped:
+        return {key: margins[key] - getattr(part, side)[key] for key in keys}
+    return {key: getattr(part, side)[key] for key in keys}
+
+
+def _cached_stats(data, by, matrix):
+    return _cached(data, ("stats", by), lambda: ClusterStats.from_matrix(
+        matrix, data.cluster_groups(by).labels, data.columns))
+
+
+class GroupIndex(object):
+    '''
+    Rows of every group of a categorical labelling of cells, CSR-style
+
+    Groups are integer codes into `categories` (for a MultiIndex level these
+    are the level's own codes, so nothing is re-factorized). Rows sorted
+    stably by group are kept with the offsets at which each group starts, so
+    the rows of a group are a constant-time slice; groups whose rows are
+    consecutive, as in cluster-sorted data, are returned as plain slices,
+    which select views.
+
+    Parameters:
+    -----------
+    codes: 1D array of int
+        Group of each row, -1 for missing labels
+    categories: pandas Index
+        Label of each group
+    '''
+
+    def __init__(self, codes, categories):
+        self.codes = np.asarray(codes)
+        self.categories = categories
+        n_groups = len(categories)
+        labelled = self.codes >= 0
+        sizes = np.bincount(self.codes[labelled], minlength=n_groups)
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.order = np.flatnonzero(labelled)[np.argsort(self.codes[labelled], kind='stable')]
+        # rows within a group are increasing, so the group is one run of
+        # consecutive rows exactly when its first and last rows span its size
+        nonempty = sizes > 0
+        first = self.order[self.offsets[:-1][nonempty]]
+        last = self.order[self.offsets[1:][nonempty] - 1]
+        self.contiguous = np.zeros(n_groups, dtype=bool)
+        self.contiguous[nonempty] = last - first == sizes[nonempty] - 1
+        self._labels = None
+
+    @classmethod
+    def from_index(cls, index, level):
+        if isinstance(index, pd.MultiIndex):
+            position = index.names.index(level)
+            return cls(index.codes[position], index.levels[position])
+        codes, categories = pd.factorize(index.get_level_values(level), sort=True)
+        return cls(codes, categories)
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    @property
+    def labels(self):
+        '''
+        label of every row, built once and read-only
+        '''
+        if self._labels is None:
+            labels = np.asarray(pd.Categorical.from_codes(self.codes, self.categories))
+            labels.flags.writeable = False
+            self._labels = labels
+        return self._labels
+
+    def present(self):
+        '''
+        codes of the groups with at least one row
+        '''
+        return np.flatnonzero(self.sizes)
+
+    def rows_of(self, code):
+        start, stop = self.offsets[code], self.offsets[code + 1]
+        if self.contiguous[code]:
+            first = self.order[start]
+            return slice(first, first + stop - start)
+        return self.order[start:stop]
+
+    def rows(self, label):
+        '''
+        rows of the group labelled `label`: a slice if they are consecutive,
+        else an array of positions; empty for unknown labels
+        '''
+        try:
+            code = self.categories.get_loc(label)
+        except KeyError:
+            return np.empty(0, dtype=np.int64)
+        return self.rows_of(code)
+
+
+class ClusterStats(object):
+    '''
+    Per-cluster sufficient statistics of an expression matrix
+
+    Cell counts and, for every gene, sums, sums of squares and numbers of
+    nonzero entries per cluster. Means, variances, fractions expressing,
+    pseudobulk profiles and cluster comparisons are all derived from these
+    cluster-sized arrays without touching the matrix again.
+
+    Parameters:
+    -----------
+    clusters: 1D array
+        Cluster labels, one per row of the statistics
+    columns: pandas Index
+        Gene names
+    counts: 1D array
+        Number of cells per cluster
+    sums, sq_sums, nonzero: 2D arrays
+        Statistics of shape (clusters, genes)
+    '''
+
+    def __init__(self, clusters, columns, counts, sums, sq_sums, nonzero):
+        self.clusters = clusters
+        self.columns = columns
+        self.counts = counts
+        self.sums = sums
+        self.sq_sums = sq_sums
+        self.nonzero = nonzero
+
+    @classmethod
+    def from_matrix(cls, matrix, groups, columns, chunk_size=None):
+        '''
+        compute the statistics with one sparse indicator-matrix product per
+        statistic, in blocks of genes for dense input
+        '''
+        from polyseq.linalg import BLOCK_ENTRIES
+        clusters, codes = np.unique(np.asarray(groups), return_inverse=True)
+        n_cells, n_genes = matrix.shape
+        indicator = csr_matrix((np.ones(n_cells), (codes, np.arange(n_cells))),
+                               shape=(clusters.shape[0], n_cells))
+        counts = np.bincount(codes, minlength=clusters.shape[0])
+
+        if issparse(matrix):
+            matrix = csr_matrix(matrix)
+            pattern = matrix.copy()
+            pattern.data = (pattern.data != 0).astype(np.float64)
+            stats = [indicator @ matrix, indicator @ matrix.multiply(matrix), indicator @ pattern]
+            stats = [np.asarray(stat.todense(), dtype=np.float64) for stat in stats]
+        else:
+            matrix = np.asarray(matrix)
+            stats = [np.empty((clusters.shape[0], n_genes)) for _ in range(3)]
+            chunk_size = chunk_size or max(1, BLOCK_ENTRIES // max(1, n_cells))
+            for start in range(0, n_genes, chunk_size):
+                block = np.asarray(matrix[:, start:start + chunk_size], dtype=np.float64)
+                cols = slice(start, start + block.shape[1])
+                stats[0][:, cols] = indicator @ block
+                stats[1][:, cols] = indicator @ block**2
+                stats[2][:, cols] = indicator @ (block != 0).astype(np.float64)
+        return cls(clusters, _as_index(columns), counts, *stats)
+
+    def _frame(self, values):
+        return pd.DataFrame(values, index=pd.Index(self.clusters, name="cluster"),
+                            columns=self.columns)
+
+    def mean(self):
+        '''
+        mean expression, (clusters, genes)
+        '''
+        return self._frame(self.sums / self.counts[:, None])
+
+    def var(self, ddof=1):
+        '''
+        variance of expression, (clusters, genes)
+        '''
+        mean = self.sums / self.counts[:, None]
+        dof = np.maximum(self.counts - ddof, 1)[:, None]
+        return self._frame(np.maximum(self.sq_sums - self.counts[:, None] * mean**2, 0) / dof)
+
+    def fraction_expressing(self):
+        '''
+        fraction of cells with nonzero expression, (clusters, genes)
+        '''
+        return self._frame(self.nonzero / self.counts[:, None])
+
+    def pseudobulk(self):
+        '''
+        summed expression profile of each cluster, (clusters, genes)
+        '''
+        return self._frame(self.sums)
+
+    def _pooled(self, selection):
+        rows = np.isin(self.clusters, np.atleast_1d(selection))
+        return (self.counts[rows].sum(), self.sums[rows].sum(axis=0),
+                self.sq_sums[rows].sum(axis=0), self.nonzero[rows].sum(axis=0))
+
+    def compare(self, a, b=None):
+        '''
+        compare cells of cluster(s) a with those of cluster(s) b, or with all
+        other cells if b is None
+
+        Returns a DataFrame indexed by gene with the means and fractions
+        expressing of both groups, the log2 fold change of means and Welch's t.
+        '''
+        from polyseq.differential_expression import welch_t
+        if b is None:
+            b = self.clusters[~np.isin(self.clusters, np.atleast_1d(a))]
+        n_a, sum_a, sq_a, nz_a = self._pooled(a)
+        n_b, sum_b, sq_b, nz_b = self._pooled(b)
+        mean_a, mean_b = sum_a / n_a, sum_b / n_b
+        var_a = np.maximum(sq_a - n_a * mean_a**2, 0) / max(n_a - 1, 1)
+        var_b = np.maximum(sq_b - n_b * mean_b**2, 0) / max(n_b - 1, 1)
+        t, pvalue = welch_t(mean_a, var_a, n_a, mean_b, var_b, n_b)
+        return pd.DataFrame({
+            "mean_a": mean_a,
+            "mean_b": mean_b,
+            "frac_a": nz_a / n_a,
+            "frac_b": nz_b / n_b,
+            "logfoldchange": np.log2((mean_a + 1e-9) / (mean_b + 1e-9)),
+            "t": t,
+            "t_pvalue": pvalue,
+        }, index=self.columns)
+
+
+class SparseExpressionMatrix(object):
+    '''
+    Sparse counterpart to ExpressionMatrix
+
+    Counts are held in a scipy.sparse CSR matrix of shape (cells, genes)
+    alongside the cell index and gene columns, so memory scales with the
+    number of nonzero entries rather than with cells x genes. Nothing is
+    densified unless `to_dense` is called.
+
+    Parameters:
+    -----------
+    matrix: scipy.sparse matrix or 2D array-like
+        Counts of shape (cells, genes)
+    index: pandas Index, default=None
+        Cell labels. Defaults to a RangeIndex named "cell".
+    columns: pandas Index or list-like, default=None
+        Gene names. Defaults to a RangeIndex.
+    '''
+
+    def __init__(self, matrix, index=None, columns=None):
+        self.matrix = csr_matrix(matrix)
+        n_cells, n_genes = self.matrix.shape
+        self.index = pd.RangeIndex(n_cells) if index is None else _as_index(index)
+        self.columns = pd.RangeIndex(n_genes) if columns is None else _as_index(columns)
+
+    def _finalize(self, index=None):
+        if index is None:
+            self.index = pd.Index.rename(self.index, "cell")
+        else:
+            self.index = index
+        return self
+
+    def _take(self, rows=None, cols=None):
+        matrix, index, columns = self.matrix, self.index, self.columns
+        if rows is not None:
+            matrix, index = matrix[rows], index[rows]
+        if cols is not None:
+            matrix, columns = matrix[:, cols], columns[cols]
+        result = SparseExpressionMatrix(matrix, index=index, columns=columns)
+        instrument.count_copy(result.matrix)
+        _carry_margins(self, result, rows, cols, result.matrix)
+        return result
+
+    def margins(self):
+        '''
+        per-cell and per-gene totals and detection counts, computed lazily,
+        cached, and carried over to subsets; see Margins
+        '''
+        return _cached(self, "margins", lambda: Margins(self.matrix))
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def __repr__(self):
+        return "<SparseExpressionMatrix: {} cells x {} genes, {} stored entries>".format(
+            self.shape[0], self.shape[1], self.matrix.nnz)
+
+    def __getitem__(self, genes):
+        if isinstance(genes, (int, str)):
+            genes = [genes]
+        positions = self.columns.get_indexer(genes)
+        if (positions < 0).any():
+            raise KeyError("not found: {}".format([g for g, p in zip(genes, positions) if p < 0][:5]))
+        return self._take(cols=positions)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    def sum(self, axis=0):
+        sums = np.asarray(self.matrix.sum(axis=axis)).ravel()
+        return pd.Series(sums, index=self.columns if axis == 0 else self.index)
+
+    @property
+    def clusters(self):
+        if "cluster" in self.index.names:
+            return self.cluster_groups().labels
+
+    @clusters.setter
+    def clusters(self, clusters):
+        self.index = _with_level(self.index, "cluster", clusters)
+        _invalidate(self)
+
+    def cluster_groups(self, by="cluster"):
+        '''
+        integer codes and CSR-style row offsets of the groups of an index
+        level, built once and cached until the index is reassigned; see
+        GroupIndex
+
+        Parameters:
+        -----------
+        by: str, default="cluster"
+            Index level to group cells by
+        '''
+        return _cached(self, ("groups", by), lambda: GroupIndex.from_index(self.index, by))
+
+    def cluster_stats(self, by="cluster"):
+        '''
+        per-cluster sufficient statistics, computed once and cached until the
+        index (and so the clusters) is reassigned; see ClusterStats
+
+        Parameters:
+        -----------
+        by: str, default="cluster"
+            Index level to group cells by
+        '''
+        return _cached_stats(self, by, self.matrix)
+
+    def get_cluster(self, i):
+        return self._take(rows=self.cluster_groups().rows(i))
+
+    def iter_clusters(self, by="cluster"):
+        '''
+        yields (label, cells) for every nonempty group of an index level
+        '''
+        groups = self.cluster_groups(by)
+        for code in groups.present():
+            yield groups.categories[code], self._take(rows=groups.rows_of(code))
+
+    def drop_cells(self, umis=None, num_genes=None, genes=None, umi_threshold=1):
+
+        if isinstance(genes, (int, str)):
+            genes = [genes]
+
+        margins = self.margins() if genes is None else self[genes].margins()
+        return self._take(rows=np.flatnonzero(
+            margins.keep_cells(umis, num_genes, umi_threshold)))
+
+    def drop_genes(self, umis=None, num_cells=None, umi_threshold=1):
+        return self._take(cols=np.flatnonzero(
+            self.margins().keep_genes(umis, num_cells, umi_threshold)))
+
+    def qc_filter(self, cell_umis=None, num_genes=None, gene_umis=None, num_cells=None,
+                  umi_threshold=1):
+        '''
+        drops cells and genes in one step; see Margins.qc_masks
+        '''
+        rows, cols = self.margins().qc_masks(cell_umis, num_genes, gene_umis, num_cells,
+                                             umi_threshold)
+        return self._take(rows=np.flatnonzero(rows), cols=np.flatnonzero(cols))
+
+    def downsample(self, fraction=None, number=None):
+
+        if fraction is not None:
+            if isinstance(fraction, (int, float)):
+                fraction = (fraction, 1)
+            number = (int(np.round(f * s)) for f, s in zip(fraction, self.shape))
+
+        if isinstance(number, int):
+            number = (number, self.shape[1])
+
+        rows, cols = [np.random.choice(np.arange(s), n, replace=False) if n < s
+                      else None for n, s in zip(number, self.shape)]
+
+        return self._take(rows=rows, cols=cols)
+
+    def sort(self, sort_cells=True, sort_genes=True, genes=None):
+        result = self
+
+        if sort_cells:
+            totals = (self if genes is None else self[genes]).margins().cell_umis
+            result = result._take(rows=np.argsort(-totals, kind="stable"))
+
+        if sort_genes:
+            result = result._take(cols=np.argsort(-result.margins().gene_umis, kind="stable"))
+
+        return result
+
+    def log_normalize(self):
+        matrix = self.matrix.astype(np.float64)
+        instrument.count_copy(matrix)
+        np.log1p(matrix.data, out=matrix.data)
+        return SparseExpressionMatrix(matrix, index=self.index, columns=self.columns)
+
+    def to_cellranger(self, path):
+        from scipy.io import mmwrite
+        mmwrite(path + "matrix.mtx", self.matrix.T.tocoo())
+        self.columns.to_series().to_csv(path + "genes.tsv", sep="\t")
+
+    def lazy(self, chunk_size=None):
+        '''
+        deferred, block-wise view of this matrix for building a fused
+        preprocessing plan; see polyseq.lazy.LazyMatrix
+        '''
+        from polyseq.lazy import LazyMatrix
+        return LazyMatrix(self, chunk_size=chunk_size)
+
+    def to_dense(self):
+        '''
+        explicitly densify into an ExpressionMatrix
+        '''
+        with instrument.span("densify", shape=self.shape):
+            values = self.matrix.toarray()
+            instrument.count_copy(values)
+        return ExpressionMatrix(values, index=self.index, columns=self.columns, copy=False)
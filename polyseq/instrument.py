@@ -0,0 +1,289 @@
+'''
+Spans and counters for profiling polyseq
+
+Public functions are wrapped in spans and mark their internal steps
+(reading, parsing, densifying, fitting, ...) with nested spans; counters
+record bytes read, matrix copies and allocations. Nothing is recorded
+unless a sink is installed, in which case finished spans and counter
+increments are passed to every sink:
+
+    from polyseq import instrument
+    trace = instrument.MemorySink()
+    with instrument.tracing(trace, instrument.ChromeTraceSink("trace.json")):
+        data = pseq.io.read_cellranger(path)
+    trace.summary()
+
+While no sink is installed, span() returns a shared no-op context manager
+and count() returns immediately.
+'''
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+_sinks = ()
+_local = threading.local()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    '''
+    A timed region of a thread, with attributes and the counters
+    incremented inside it (including in nested spans)
+    '''
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1] if stack else None
+        self.depth = len(stack)
+        self.thread = threading.get_ident()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.end = time.perf_counter()
+        _stack().pop()
+        if self.parent is not None:
+            for key, value in self.counters.items():
+                self.parent.counters[key] = self.parent.counters.get(key, 0) + value
+        for sink in _sinks:
+            sink.emit(self)
+        return False
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def span(name, **attrs):
+    '''
+    context manager timing a region of code under `name`; keyword arguments
+    are recorded as attributes
+    '''
+    if not _sinks:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def count(name, value=1):
+    '''
+    adds `value` to counter `name` (e.g. "bytes_read", "copies",
+    "alloc_bytes") for the innermost open span and the sinks
+    '''
+    if not _sinks:
+        return
+    stack = _stack()
+    if stack:
+        counters = stack[-1].counters
+        counters[name] = counters.get(name, 0) + value
+    for sink in _sinks:
+        sink.count(name, value)
+
+
+def count_copy(arr):
+    '''
+    records a new copy of a matrix or array: one copy and its bytes
+    '''
+    if not _sinks:
+        return
+    nbytes = getattr(arr, "nbytes", None)
+    if nbytes is None and hasattr(arr, "data"):
+        # scipy.sparse
+        nbytes = sum(getattr(arr, a).nbytes for a in ("data", "indices", "indptr") if hasattr(arr, a))
+    count("copies")
+    count("alloc_bytes", nbytes or 0)
+
+
+def instrumented(func=None, name=None):
+    '''
+    decorator wrapping every call of a function in a span named after it
+    '''
+    if func is None:
+        return functools.partial(instrumented, name=name)
+    label = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _sinks:
+            return func(*args, **kwargs)
+        with Span(label, {}):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+class Sink(object):
+    '''
+    Receiver of finished spans and counter increments
+    '''
+
+    def emit(self, span):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def close(self):
+        pass
+
+
+class LoggingSink(Sink):
+    '''
+    logs every finished span, indented by nesting depth, with its counters
+
+    Parameters:
+    -----------
+    logger: logging.Logger, default=None
+        Defaults to the "polyseq" logger
+    level: int, default=logging.INFO
+        Level of the records
+    '''
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("polyseq")
+        self.level = level
+
+    def emit(self, span):
+        details = dict(span.attrs, **span.counters)
+        self.logger.log(self.level, "%s%s: %.4f s%s", "  " * span.depth, span.name, span.duration,
+                        " " + " ".join("{}={}".format(k, v) for k, v in details.items()) if details else "")
+
+
+class MemorySink(Sink):
+    '''
+    keeps finished spans as dicts in `spans` and counter totals in `totals`
+    '''
+
+    def __init__(self):
+        self.spans = []
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def emit(self, span):
+        self.spans.append({"name": span.name, "parent": span.parent.name if span.parent else None,
+                           "depth": span.depth, "thread": span.thread, "start": span.start,
+                           "seconds": span.duration, "attrs": dict(span.attrs),
+                           "counters": dict(span.counters)})
+
+    def count(self, name, value):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+
+    def summary(self):
+        '''
+        DataFrame with the number of calls, total seconds and counter sums
+        of every span name, slowest first
+        '''
+        if not self.spans:
+            return pd.DataFrame(columns=["calls", "seconds"])
+        rows = [dict(s["counters"], name=s["name"], seconds=s["seconds"], calls=1) for s in self.spans]
+        table = pd.DataFrame(rows).groupby("name", sort=False).sum()
+        columns = ["calls", "seconds"] + [c for c in table.columns if c not in ("calls", "seconds")]
+        return table[columns].sort_values("seconds", ascending=False)
+
+
+class ChromeTraceSink(Sink):
+    '''
+    writes spans and counters in the Chrome trace event format, viewable in
+    chrome://tracing or Perfetto; the file is written on `close`
+
+    Parameters:
+    -----------
+    path: str
+        Output JSON file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+        self.totals = {}
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _us(self, t):
+        return (t - self._origin) * 1e6
+
+    def emit(self, span):
+        args = dict(span.attrs, **span.counters)
+        self.events.append({"name": span.name, "cat": "polyseq", "ph": "X", "pid": self._pid,
+                            "tid": span.thread, "ts": self._us(span.start), "dur": span.duration * 1e6,
+                            "args": {k: v if isinstance(v, (int, float, str)) else repr(v)
+                                     for k, v in args.items()}})
+
+    def count(self, name, value):
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+            self.events.append({"name": name, "ph": "C", "pid": self._pid,
+                                "ts": self._us(time.perf_counter()), "args": {name: self.totals[name]}})
+
+    def close(self):
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def enable(*sinks):
+    '''
+    installs sinks in addition to those already installed
+    '''
+    global _sinks
+    _sinks = _sinks + tuple(sinks)
+
+
+def disable(*sinks):
+    '''
+    removes the given sinks, or all of them, and closes them
+    '''
+    global _sinks
+    removed = sinks or _sinks
+    _sinks = tuple(s for s in _sinks if s not in removed)
+    for sink in removed:
+        sink.close()
+
+
+@contextmanager
+def tracing(*sinks):
+    '''
+    context manager installing sinks for the duration of a block; they are
+    closed (e.g. a Chrome trace is written) on exit
+    '''
+    enable(*sinks)
+    try:
+        yield sinks[0] if len(sinks) == 1 else sinks
+    finally:
+        disable(*sinks)
@@ -1,74 +1,341 @@
-from pkg_resources import resource_filename
+import json
+import os
 from subprocess import call
 
+import numpy as np
 import pandas as pd
-from scipy.io import mmread
-import tables
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 
-from polyseq.expression_matrix import ExpressionMatrix
+from polyseq import instrument
+from polyseq.cache import memoize
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
 
-def read_mtx(exp_matrix_path, genes=None):
-    arr = mmread(exp_matrix_path).toarray().T
-    exp_matrix = pd.DataFrame(arr)
+def _mtx_to_csr(arr):
+    '''
+    (cells, genes) CSR matrix of an mmread result of shape (genes, cells),
+    with int32 counts when integer values fit
+    '''
+    if not issparse(arr):
+        return csr_matrix(arr.T)
+    coo = arr.tocoo()
+    values = coo.data
+    if values.dtype.kind in "iu":
+        max_value = values.max() if len(values) else 0
+        values = values.astype(np.int32 if max_value <= np.iinfo(np.int32).max else np.int64, copy=False)
+    return coo_matrix((values, (coo.col, coo.row)), shape=coo.shape[::-1]).tocsr()
+
+@instrument.instrumented
+def read_mtx(exp_matrix_path, genes=None, sparse=False):
+    '''
+    read a Matrix Market file (optionally gzipped) of shape (genes, cells)
+
+    scipy's mmread parses the file on several threads; coordinate files are
+    turned straight into a sparse matrix with an integer count dtype. With
+    `sparse=True` a SparseExpressionMatrix is returned and the counts are
+    never densified.
+    '''
+    from scipy.io import mmread
+    with instrument.span("parse", path=exp_matrix_path):
+        instrument.count("bytes_read", os.path.getsize(exp_matrix_path))
+        arr = mmread(exp_matrix_path)
+    with instrument.span("assemble"):
+        arr = _mtx_to_csr(arr)
+    if sparse:
+        columns = None if genes is None else np.asarray(genes)
+        return SparseExpressionMatrix(arr, columns=columns)._finalize()
+    with instrument.span("densify"):
+        exp_matrix = pd.DataFrame(arr.toarray())
+        instrument.count_copy(exp_matrix.values)
     if genes is not None:
         exp_matrix = exp_matrix.rename(genes, axis=1)
     return ExpressionMatrix(exp_matrix)._finalize()
 
-def read_cellranger(path):
+@instrument.instrumented
+@memoize(paths=("path",))
+def read_cellranger(path, sparse=False, cells=None, genes=None):
+    '''
+    read a cellranger output directory or .h5 file
+
+    Parameters:
+    -----------
+    path: string
+        Path to a cellranger output directory or .h5 file
+    sparse: bool, default=False
+        Return a SparseExpressionMatrix instead of a dense ExpressionMatrix
+    cells: list-like, default=None
+        Subset of cells to load, given as barcodes, integer positions or a
+        boolean mask. For .h5 files only the selected cells are read.
+    genes: list-like, default=None
+        Subset of genes to load, given as names, integer positions or a
+        boolean mask
+    '''
     if path[-3:] == ".h5":
-        expression_matrix = _load_cellranger_h5(path)
+        expression_matrix = _load_cellranger_h5(path, sparse=sparse, cells=cells, genes=genes)
+    elif cells is None and genes is None:
+        expression_matrix = _load_cellranger_mtx(path, sparse=sparse)
     else:
-        expression_matrix = _load_cellranger_mtx(path)
+        expression_matrix = _load_cellranger_mtx(path, sparse=True)
+        rows = _positions(cells, expression_matrix.index)
+        cols = _positions(genes, expression_matrix.columns)
+        expression_matrix = expression_matrix._take(rows=rows, cols=cols)
+        if not sparse:
+            expression_matrix = expression_matrix.to_dense()
     return expression_matrix
 
-def _load_cellranger_h5(path):
+def _positions(selection, labels):
+    '''
+    integer positions for a selection of labels, positions or a boolean mask
+    '''
+    if selection is None:
+        return None
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        return np.flatnonzero(selection)
+    if np.issubdtype(selection.dtype, np.integer):
+        return selection
+    positions = pd.Index(labels).get_indexer(selection)
+    if (positions < 0).any():
+        raise KeyError("not found: {}".format(list(selection[positions < 0][:5])))
+    return positions
+
+def _h5_matrix_group(f):
+    return list(f.iter_nodes(f.root))[0] # assuming first and only group is the correct one
+
+def _h5_labels(mat_group):
+    '''
+    barcodes and gene names for both the cellranger 2 and 3 layouts
+    '''
+    barcodes = mat_group.barcodes.read().astype(str)
+    if "gene_names" in mat_group:
+        genes = mat_group.gene_names.read()
+    else:
+        genes = mat_group.features.name.read()
+    return barcodes, genes.astype(str)
+
+def _read_h5_cells(mat_group, indptr, rows, cols, n_genes):
+    '''
+    read the given cells (columns of the on-disk CSC matrix) as CSR rows,
+    issuing one read per run of consecutive cells
+    '''
+    shape = (len(rows), n_genes if cols is None else len(cols))
+    if len(rows) == 0:
+        return csr_matrix(shape)
+
+    if cols is not None:
+        new_cols = np.full(n_genes, -1, dtype=np.int64)
+        new_cols[cols] = np.arange(len(cols))
+
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(rows)]])
+
+    data, indices, lengths = [], [], []
+    for start, stop in zip(starts, stops):
+        first, last = rows[start], rows[stop - 1] + 1
+        lo, hi = indptr[first], indptr[last]
+        run_data = mat_group.data.read(lo, hi)
+        run_indices = mat_group.indices.read(lo, hi)
+        instrument.count("bytes_read", run_data.nbytes + run_indices.nbytes)
+        run_indptr = indptr[first:last + 1] - lo
+        if cols is not None:
+            keep = new_cols[run_indices] >= 0
+            run_data, run_indices = run_data[keep], new_cols[run_indices[keep]]
+            cumulative = np.concatenate([[0], np.cumsum(keep)])
+            run_indptr = cumulative[run_indptr]
+        data.append(run_data)
+        indices.append(run_indices)
+        lengths.append(np.diff(run_indptr))
+
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(lengths))])
+    arr = csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=shape)
+    arr.sort_indices()
+    return arr
+
+def _load_cellranger_h5(path, sparse=False, cells=None, genes=None):
     '''
     https://support.10xgenomics.com/single-cell-gene-expression/software/pipelines/latest/advanced/h5_matrices
     '''
+    import tables
     with tables.open_file(path, 'r') as f:
-        mat_group = list(f.iter_nodes(f.root))[0] # assuming first and only group is the correct one
-        print("reading data")
-        data = mat_group.data.read()
-        print(data.dtype)
-        print("reading indices")
-        indices = mat_group.indices.read()
-        print(indices.dtype)
-        print("reading indptrs")
+        mat_group = _h5_matrix_group(f)
+        barcodes, gene_names = _h5_labels(mat_group)
         indptr = mat_group.indptr.read()
-        print(indptr.dtype)
-        print("reading shape")
-        shape = mat_group.shape.read()
-        print(shape.dtype)
-        print(shape)
-        print("reading genes")
-        genes = mat_group.gene_names.read()
-    print("making sparse matrix")
-    arr = csc_matrix((data, indices, indptr), shape=shape)#.toarray().T
-    print("making dense matrix")
-    return arr.toarray().T
-    exp_matrix = pd.DataFrame(arr).rename(genes, axis=1)
-    return ExpressionMatrix(exp_matrix)
-
-def _load_cellranger_mtx(path):
-    genes = pd.read_csv(path + "/genes.tsv", delimiter='\t', header=None)[1]
-    try:
-        expression_matrix = read_mtx(path + "/matrix.mtx", genes=genes)
-    except:
-        expression_matrix = read_mtx(path + "/matrix.mtx.gz", genes=genes)
-    return expression_matrix
+        rows = _positions(cells, barcodes)
+        rows = np.arange(len(barcodes)) if rows is None else rows
+        cols = _positions(genes, gene_names)
+        with instrument.span("read", path=path, cells=len(rows)):
+            arr = _read_h5_cells(mat_group, indptr, rows, cols, len(gene_names))
+
+    index = pd.Index(barcodes[rows], name="cell")
+    columns = gene_names if cols is None else gene_names[cols]
+    expression_matrix = SparseExpressionMatrix(arr, index=index, columns=columns)
+    return expression_matrix if sparse else expression_matrix.to_dense()
+
+def iter_cellranger_h5(path, chunk_size=10000, genes=None):
+    '''
+    stream a cellranger .h5 file as SparseExpressionMatrix chunks of cells
+
+    Only one chunk is held in memory at a time, so QC and filtering can be run
+    on files larger than RAM.
+
+    Parameters:
+    -----------
+    path: string
+        Path to a cellranger .h5 file
+    chunk_size: int, default=10000
+        Number of cells per chunk
+    genes: list-like, default=None
+        Subset of genes to load, given as names, integer positions or a
+        boolean mask
+    '''
+    import tables
+    with tables.open_file(path, 'r') as f:
+        mat_group = _h5_matrix_group(f)
+        barcodes, gene_names = _h5_labels(mat_group)
+        indptr = mat_group.indptr.read()
+        cols = _positions(genes, gene_names)
+        columns = gene_names if cols is None else gene_names[cols]
+
+        for start in range(0, len(barcodes), chunk_size):
+            rows = np.arange(start, min(start + chunk_size, len(barcodes)))
+            arr = _read_h5_cells(mat_group, indptr, rows, cols, len(gene_names))
+            index = pd.Index(barcodes[rows], name="cell")
+            yield SparseExpressionMatrix(arr, index=index, columns=columns)
+
+def _find_file(path, names):
+    for name in names:
+        candidate = os.path.join(path, name)
+        if os.path.exists(candidate):
+            return candidate
+    raise IOError("none of {} found in {}".format(", ".join(names), path))
+
+def _load_cellranger_mtx(path, sparse=False):
+    genes_path = _find_file(path, ["genes.tsv", "genes.tsv.gz", "features.tsv.gz"])
+    genes = pd.read_csv(genes_path, delimiter='\t', header=None)[1]
+    matrix_path = _find_file(path, ["matrix.mtx", "matrix.mtx.gz"])
+    return read_mtx(matrix_path, genes=genes, sparse=sparse)
 
 def read_pickle(path):
     return ExpressionMatrix(pd.read_pickle(path))
 
-def load_example(example="brain"):
+POLYSEQ_FORMAT_VERSION = 1
+
+def _index_dtype(max_value):
+    return np.int32 if max_value < np.iinfo(np.int32).max else np.int64
+
+def _save_array(path, name, arr):
+    np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(arr))
+
+def _load_array(path, name, mmap_mode):
+    return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+def _encode_labels(labels):
+    values = np.asarray(labels)
+    return values.astype(str) if values.dtype == object else values
+
+def _write_index(path, prefix, index):
+    if isinstance(index, pd.RangeIndex):
+        return {"kind": "range", "names": list(index.names),
+                "range": [int(index.start), int(index.stop), int(index.step)]}
+
+    multi = isinstance(index, pd.MultiIndex)
+    levels = index.levels if multi else [index.unique()]
+    codes = index.codes if multi else [levels[0].get_indexer(index)]
+    for i, (level, level_codes) in enumerate(zip(levels, codes)):
+        _save_array(path, "{}-{}-levels".format(prefix, i), _encode_labels(level))
+        _save_array(path, "{}-{}-codes".format(prefix, i),
+                    np.asarray(level_codes, dtype=_index_dtype(len(level))))
+    return {"kind": "multi" if multi else "flat", "names": list(index.names),
+            "n_levels": len(levels)}
+
+def _read_index(path, prefix, meta, mmap_mode):
+    if meta["kind"] == "range":
+        return pd.RangeIndex(*meta["range"], name=meta["names"][0])
+
+    levels, codes = [], []
+    for i in range(meta["n_levels"]):
+        levels.append(_load_array(path, "{}-{}-levels".format(prefix, i), mmap_mode))
+        codes.append(_load_array(path, "{}-{}-codes".format(prefix, i), mmap_mode))
+    if meta["kind"] == "multi":
+        return pd.MultiIndex(levels=levels, codes=codes, names=meta["names"])
+    return pd.Index(np.asarray(levels[0])[codes[0]], name=meta["names"][0])
+
+@instrument.instrumented
+def write_polyseq(data, path):
+    '''
+    write an ExpressionMatrix or SparseExpressionMatrix in the native polyseq
+    format
+
+    The format is a directory of aligned .npy arrays (the CSR arrays or the
+    dense values, plus codes and levels for the cell index and the genes) and
+    a small JSON header, so that `read_polyseq` can memory-map every array
+    without parsing or copying it.
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    meta = {"version": POLYSEQ_FORMAT_VERSION, "shape": list(data.shape)}
+
+    if isinstance(data, SparseExpressionMatrix):
+        arr = data.matrix
+        idx_dtype = _index_dtype(max(arr.nnz, arr.shape[1]))
+        _save_array(path, "matrix-data", arr.data)
+        _save_array(path, "matrix-indices", arr.indices.astype(idx_dtype, copy=False))
+        _save_array(path, "matrix-indptr", arr.indptr.astype(idx_dtype, copy=False))
+        meta["kind"] = "sparse"
+    else:
+        _save_array(path, "matrix-values", np.asarray(data))
+        meta["kind"] = "dense"
+
+    meta["index"] = _write_index(path, "index", data.index)
+    meta["columns"] = _write_index(path, "columns", data.columns)
+
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+@instrument.instrumented
+def read_polyseq(path, mmap_mode='r'):
+    '''
+    open a matrix written by `write_polyseq`
+
+    Parameters:
+    -----------
+    path: string
+        Path to the polyseq directory
+    mmap_mode: {None, 'r', 'r+', 'c'}, default='r'
+        Passed to `np.load`. With the default, the count arrays are
+        memory-mapped read-only and wrapped without copying, so opening is
+        nearly instantaneous and processes opening the same file share pages.
+        Use None to read everything into memory.
+    '''
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["version"] > POLYSEQ_FORMAT_VERSION:
+        raise ValueError("unsupported polyseq format version {}".format(meta["version"]))
+
+    index = _read_index(path, "index", meta["index"], mmap_mode)
+    columns = _read_index(path, "columns", meta["columns"], mmap_mode)
+
+    if meta["kind"] == "sparse":
+        arrays = [_load_array(path, "matrix-" + name, mmap_mode)
+                  for name in ("data", "indices", "indptr")]
+        arr = csr_matrix(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+        return SparseExpressionMatrix(arr, index=index, columns=columns)
+
+    values = _load_array(path, "matrix-values", mmap_mode)
+    return ExpressionMatrix(values, index=index, columns=columns, copy=False)
+
+def load_example(example="brain", sparse=False):
     '''
     options are "brain" and "vnc"
     '''
+    from pkg_resources import resource_filename
     path = resource_filename(__name__, "examples/sample_{}".format(example))
-    return read_cellranger(path)
+    return read_cellranger(path, sparse=sparse)
 
 def download_example_data():
     from itertools import product
+    from pkg_resources import resource_filename
 
     path = resource_filename(__name__, "examples")
     url = "https://raw.githubusercontent.com/jwittenbach/polyseq/master/examples/"
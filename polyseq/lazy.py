@@ -0,0 +1,223 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+
+from polyseq import instrument
+from polyseq.expression_matrix import ExpressionMatrix, Margins
+from polyseq.linalg import default_chunk_size
+
+
+class _Log1p(object):
+    stateful = False
+
+    def apply(self, block, start, stop):
+        if issparse(block):
+            np.log1p(block.data, out=block.data)
+        else:
+            np.log1p(block, out=block)
+        return block
+
+
+class _Residualize(object):
+    '''
+    projects blocks of cells off the covariate space and z-scores them;
+    the per-gene coefficients and residual scale are fitted by one pass over
+    the plan that precedes this step
+    '''
+    stateful = True
+
+    def __init__(self, prefix, basis):
+        self.prefix = prefix
+        self.basis = basis
+        self.coefs = None
+
+    def fit(self):
+        if self.coefs is not None:
+            return
+        with instrument.span("fit", step="regress"):
+            self._fit()
+
+    def _fit(self):
+        n_genes = self.prefix.shape[1]
+        coefs = np.zeros((self.basis.shape[1], n_genes))
+        sq_sums = np.zeros(n_genes)
+        for start, stop, block in self.prefix.iter_blocks():
+            coefs += (block.T @ self.basis[start:stop]).T
+            sq_sums += np.asarray(block.multiply(block).sum(axis=0)).ravel() if issparse(block) \
+                else (block**2).sum(axis=0)
+        # the basis is orthonormal, so |y - Q Q^T y|^2 = |y|^2 - |Q^T y|^2,
+        # and residuals have mean zero since the basis spans the intercept
+        residual = np.maximum(sq_sums - (coefs**2).sum(axis=0), 0)
+        std = np.sqrt(residual / max(self.basis.shape[0] - 1, 1))
+        self.scale = np.where(std > 0, std, 1.0)
+        self.coefs = coefs
+
+    def apply(self, block, start, stop):
+        block = block.toarray() if issparse(block) else block
+        block -= self.basis[start:stop] @ self.coefs
+        block /= self.scale
+        return block
+
+
+class LazyMatrix(object):
+    '''
+    Deferred preprocessing plan over an ExpressionMatrix or
+    SparseExpressionMatrix
+
+    Methods record a selection of cells and genes and a list of steps
+    instead of producing new matrices. Nothing runs until a consumer asks
+    for blocks of cells through `iter_blocks`, which every function that
+    streams with polyseq.linalg.iter_row_blocks does (dim.pca and the linalg
+    helpers among them). Each block is read from the source once and passes
+    through all steps in place, so log normalization, residualization and
+    scaling are fused and peak memory is one block plus the outputs.
+    Reductions the plan itself needs (margins for filtering, regression
+    coefficients) are streaming passes too.
+
+    Cell and gene filters must be recorded before `regress`, whose fit
+    depends on the cells present.
+
+    Parameters:
+    -----------
+    source: ExpressionMatrix or SparseExpressionMatrix
+        Data of shape (cells, genes)
+    rows, cols: 1D array of int, default=None
+        Selected cells and genes of the source; all if None
+    steps: list, default=()
+        Recorded steps
+    chunk_size: int, default=None
+        Cells per block; by default blocks hold about 2**23 entries
+    '''
+
+    def __init__(self, source, rows=None, cols=None, steps=(), chunk_size=None):
+        self.source = source
+        self.rows = rows
+        self.cols = cols
+        self.steps = list(steps)
+        self.chunk_size = chunk_size
+
+    def _derive(self, rows=None, cols=None, step=None):
+        if (rows is not None or cols is not None) and any(s.stateful for s in self.steps):
+            raise ValueError("select cells and genes before regress")
+        compose = lambda old, new: new if old is None else old[new]
+        return LazyMatrix(self.source,
+                          self.rows if rows is None else compose(self.rows, rows),
+                          self.cols if cols is None else compose(self.cols, cols),
+                          self.steps + ([step] if step is not None else []),
+                          self.chunk_size)
+
+    @property
+    def shape(self):
+        n_cells, n_genes = self.source.shape
+        return (n_cells if self.rows is None else len(self.rows),
+                n_genes if self.cols is None else len(self.cols))
+
+    @property
+    def index(self):
+        return self.source.index if self.rows is None else self.source.index[self.rows]
+
+    @property
+    def columns(self):
+        return self.source.columns if self.cols is None else self.source.columns[self.cols]
+
+    def __repr__(self):
+        steps = ", ".join(type(s).__name__.strip("_").lower() for s in self.steps) or "none"
+        return "<LazyMatrix: {} cells x {} genes, steps: {}>".format(self.shape[0], self.shape[1], steps)
+
+    def iter_blocks(self, chunk_size=None):
+        '''
+        yields (start, stop, block) for consecutive blocks of cells with all
+        steps applied; blocks are CSR matrices while the source is sparse and
+        no step has densified them, float64 ndarrays otherwise
+        '''
+        for step in self.steps:
+            if step.stateful:
+                step.fit()
+        matrix = self.source.matrix if hasattr(self.source, "matrix") else self.source.values
+        n_cells, n_genes = self.shape
+        chunk_size = chunk_size or self.chunk_size or default_chunk_size(n_genes)
+        for start in range(0, n_cells, chunk_size):
+            stop = min(start + chunk_size, n_cells)
+            block = matrix[start:stop] if self.rows is None else matrix[self.rows[start:stop]]
+            if self.cols is not None:
+                block = block[:, self.cols]
+            if issparse(block):
+                block = block.tocsr().astype(np.float64, copy=True)
+            else:
+                block = np.array(block, dtype=np.float64)
+            for step in self.steps:
+                block = step.apply(block, start, stop)
+            yield start, stop, block
+
+    def margins(self, thresholds=(1,)):
+        '''
+        Margins of the planned matrix for the given detection thresholds,
+        from one streaming pass (or the source's cached margins when nothing
+        has been recorded yet)
+        '''
+        if self.rows is None and self.cols is None and not self.steps:
+            margins = self.source.margins()
+            for threshold in thresholds:
+                margins.cell_detected(threshold)
+            return margins
+        n_cells, n_genes = self.shape
+        keys = ["umis"] + list(thresholds)
+        cells = {key: np.zeros(n_cells) for key in keys}
+        genes = {key: np.zeros(n_genes) for key in keys}
+        for start, stop, block in self.iter_blocks():
+            for key in keys:
+                if key == "umis":
+                    counted = block
+                elif issparse(block):
+                    counted = block >= key if key > 0 else np.asarray(block.todense()) >= key
+                else:
+                    counted = block >= key
+                cells[key][start:stop] = np.asarray(counted.sum(axis=1)).ravel()
+                genes[key] += np.asarray(counted.sum(axis=0)).ravel()
+        return Margins(None, cells, genes)
+
+    def sum(self, axis=0):
+        margins = self.margins(())
+        sums = margins.gene_umis if axis == 0 else margins.cell_umis
+        return pd.Series(sums, index=self.columns if axis == 0 else self.index)
+
+    def drop_cells(self, umis=None, num_genes=None, umi_threshold=1):
+        keep = self.margins([umi_threshold]).keep_cells(umis, num_genes, umi_threshold)
+        return self._derive(rows=np.flatnonzero(keep))
+
+    def drop_genes(self, umis=None, num_cells=None, umi_threshold=1):
+        keep = self.margins([umi_threshold]).keep_genes(umis, num_cells, umi_threshold)
+        return self._derive(cols=np.flatnonzero(keep))
+
+    def qc_filter(self, cell_umis=None, num_genes=None, gene_umis=None, num_cells=None,
+                  umi_threshold=1):
+        rows, cols = self.margins([umi_threshold]).qc_masks(
+            cell_umis, num_genes, gene_umis, num_cells, umi_threshold)
+        return self._derive(rows=np.flatnonzero(rows), cols=np.flatnonzero(cols))
+
+    def log_normalize(self):
+        return self._derive(step=_Log1p())
+
+    def regress(self, regressors=None, categorical=None):
+        '''
+        records the regression of covariates out of every gene followed by
+        z-scoring, as polyseq.regress does eagerly
+        '''
+        from polyseq.regression import _orthonormal_basis, design_matrix
+        basis = _orthonormal_basis(design_matrix(self.index, regressors, categorical))
+        return self._derive(step=_Residualize(self, basis))
+
+    @instrument.instrumented(name="collect")
+    def collect(self):
+        '''
+        runs the plan into a dense ExpressionMatrix
+        '''
+        out = np.empty(self.shape)
+        instrument.count("alloc_bytes", out.nbytes)
+        for start, stop, block in self.iter_blocks():
+            out[start:stop] = block.toarray() if issparse(block) else block
+        return ExpressionMatrix(out, index=self.index, columns=self.columns, copy=False)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.collect().values
+        return array if dtype is None else array.astype(dtype)
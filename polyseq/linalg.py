@@ -0,0 +1,416 @@
+import numpy as np
+from scipy.linalg import eigvalsh_tridiagonal, qr, svd
+from scipy.sparse import csc_matrix, issparse
+from scipy.sparse.linalg import LinearOperator
+
+# target number of matrix entries per dense block (64 MB of float64)
+BLOCK_ENTRIES = 2**23
+# bytes of permutation indices kept per batch of shuffles before falling back
+# to regenerating them on every pass
+PERMUTATION_BUDGET = 2**28
+
+
+def default_chunk_size(n_cols):
+    return max(1, BLOCK_ENTRIES // max(1, n_cols))
+
+
+def iter_row_blocks(data, chunk_size=None):
+    '''
+    iterate over (start, stop, block) row blocks of a matrix
+
+    `block` is a float64 ndarray for dense input (including np.memmap, which
+    is only paged in one block at a time) and a CSR matrix for sparse input.
+    Objects that know how to stream themselves provide `iter_blocks`.
+    '''
+    if hasattr(data, "iter_blocks"):
+        for item in data.iter_blocks(chunk_size):
+            yield item
+        return
+
+    if hasattr(data, "matrix") and issparse(data.matrix):
+        data = data.matrix
+    elif not issparse(data):
+        data = np.asarray(data)
+
+    n_rows, n_cols = data.shape
+    chunk_size = chunk_size or default_chunk_size(n_cols)
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        block = data[start:stop]
+        if issparse(block):
+            block = block.tocsr().astype(np.float64, copy=False)
+        else:
+            block = np.asarray(block, dtype=np.float64)
+        yield start, stop, block
+
+
+def column_stats(data, chunk_size=None):
+    '''
+    column means and standard deviations (ddof=1) in a single pass over
+    row blocks, merging per-block moments with Chan's update
+    '''
+    n, mean, m2 = 0, 0.0, 0.0
+    for start, stop, block in iter_row_blocks(data, chunk_size):
+        n_block = stop - start
+        if issparse(block):
+            block_mean = np.asarray(block.mean(axis=0)).ravel()
+            block_m2 = np.asarray(block.multiply(block).sum(axis=0)).ravel() - n_block * block_mean**2
+        else:
+            block_mean = block.mean(axis=0)
+            block_m2 = ((block - block_mean)**2).sum(axis=0)
+        delta = block_mean - mean
+        total = n + n_block
+        mean = mean + delta * n_block / total
+        m2 = m2 + block_m2 + delta**2 * n * n_block / total
+        n = total
+    std = np.sqrt(np.maximum(m2, 0) / max(n - 1, 1))
+    return mean, std
+
+
+class ZScoredOperator(LinearOperator):
+    '''
+    Linear operator for a column z-scored matrix that is never materialized
+
+    Centering and scaling are folded into the products:
+
+        Z @ B   = X @ (B / s) - 1 (m / s)^T B
+        Z.T @ Y = (X.T @ Y - m 1^T Y) / s
+
+    so each product is one streaming pass over the row blocks of X, which can
+    be dense, sparse or memory-mapped.
+
+    Parameters:
+    -----------
+    data: 2D array-like, scipy.sparse matrix or SparseExpressionMatrix
+        Matrix of shape (observations, features)
+    chunk_size: int, default=None
+        Rows per block; by default blocks hold about 2**23 entries
+    mean, std: ndarray, default=None
+        Precomputed column statistics; computed in one pass if omitted
+    '''
+
+    def __init__(self, data, chunk_size=None, mean=None, std=None):
+        self.data = data
+        self.chunk_size = chunk_size
+        if mean is None or std is None:
+            mean, std = column_stats(data, chunk_size)
+        self.mean = mean
+        # constant columns are all zero once centered; leave them unscaled
+        self.scale = np.where(std > 0, std, 1.0)
+        super(ZScoredOperator, self).__init__(dtype=np.float64, shape=data.shape)
+
+    def _matmat(self, B):
+        B = np.asarray(B, dtype=np.float64)
+        scaled = B / self.scale[:, np.newaxis]
+        offset = self.mean.dot(scaled)
+        out = np.empty((self.shape[0], B.shape[1]))
+        for start, stop, block in iter_row_blocks(self.data, self.chunk_size):
+            out[start:stop] = block.dot(scaled) - offset
+        return out
+
+    def _rmatmat(self, Y):
+        Y = np.asarray(Y, dtype=np.float64)
+        out = np.zeros((self.shape[1], Y.shape[1]))
+        for start, stop, block in iter_row_blocks(self.data, self.chunk_size):
+            out += block.T.dot(Y[start:stop])
+        out -= np.outer(self.mean, Y.sum(axis=0))
+        return out / self.scale[:, np.newaxis]
+
+    def _matvec(self, v):
+        return self._matmat(v.reshape(-1, 1)).ravel()
+
+    def _rmatvec(self, v):
+        return self._rmatmat(v.reshape(-1, 1)).ravel()
+
+
+def randomized_svd(operator, k, n_oversamples=10, n_iter=4, random_state=None):
+    '''
+    truncated SVD by randomized subspace iteration (Halko et al., 2011)
+
+    Only products with `operator` and its transpose are used, so the matrix
+    is touched in 2 * n_iter + 3 streaming passes and never copied.
+
+    Returns:
+    --------
+    u: ndarray of shape (observations, k)
+    s: ndarray of shape (k,)
+    vt: ndarray of shape (k, features)
+    '''
+    rng = np.random.RandomState(random_state)
+    n_rows, n_cols = operator.shape
+    n_components = min(k + n_oversamples, n_rows, n_cols)
+
+    omega = rng.standard_normal((n_cols, n_components))
+    q, _ = qr(operator.matmat(omega), mode='economic')
+    for _ in range(n_iter):
+        z, _ = qr(operator.rmatmat(q), mode='economic')
+        q, _ = qr(operator.matmat(z), mode='economic')
+
+    b = operator.rmatmat(q).T
+    u_b, s, vt = svd(b, full_matrices=False)
+    u = q.dot(u_b)
+
+    # deterministic signs: largest loading of each component is positive
+    signs = np.sign(vt[np.arange(vt.shape[0]), np.abs(vt).argmax(axis=1)])
+    signs[signs == 0] = 1
+    return u[:, :k] * signs[:k], s[:k], vt[:k] * signs[:k, np.newaxis]
+
+
+def randomized_pca(data, k, chunk_size=None, random_state=None, **kwargs):
+    '''
+    PCA of the column z-scored data without forming the z-scored matrix
+
+    Returns:
+    --------
+    proj: ndarray of shape (observations, k)
+        Projection of the data onto the top k components
+    explained_variance: ndarray of shape (k,)
+    components: ndarray of shape (k, features)
+    '''
+    operator = data if isinstance(data, LinearOperator) else ZScoredOperator(data, chunk_size)
+    u, s, vt = randomized_svd(operator, k, random_state=random_state, **kwargs)
+    explained_variance = s**2 / (operator.shape[0] - 1)
+    return u * s, explained_variance, vt
+
+
+def lanczos_top_eigenvalues(matvec, n, n_vectors, rng, max_steps=60, tol=1e-3):
+    '''
+    largest eigenvalue of several symmetric PSD operators at once by Lanczos
+    iteration with full reorthogonalization
+
+    Parameters:
+    -----------
+    matvec: callable
+        Maps an array of shape (n_vectors, n) to the products of each
+        operator with the corresponding row
+    n: int
+        Dimension of the operators
+    n_vectors: int
+        Number of operators handled together
+    rng: numpy Generator
+        Source of the starting vectors
+    max_steps: int, default=60
+        Maximum Krylov dimension
+    tol: float, default=1e-3
+        Stop once no eigenvalue estimate changes by more than this fraction
+        between steps
+
+    Returns:
+    --------
+    eigenvalues: ndarray of shape (n_vectors,)
+    '''
+    n_steps = min(max_steps, n)
+    # Krylov vectors are written into one buffer, step after step; pages of
+    # steps that are never reached are never touched
+    basis = np.empty((n_steps + 1, n_vectors, n))
+    v = basis[0]
+    v[...] = rng.standard_normal((n_vectors, n))
+    v /= np.linalg.norm(v, axis=1, keepdims=True)
+    alphas, betas = [], []
+    previous = np.zeros_like(v)
+    beta = np.zeros(n_vectors)
+    top = np.full(n_vectors, np.inf)
+
+    for step in range(n_steps):
+        w = matvec(v) - beta[:, np.newaxis] * previous
+        alpha = (w * v).sum(axis=1)
+        w -= alpha[:, np.newaxis] * v
+        done = basis[:step + 1]
+        w -= np.einsum('mb,mbn->bn', np.einsum('mbn,bn->mb', done, w), done)
+        previous, beta = v, np.linalg.norm(w, axis=1)
+        alphas.append(alpha)
+        betas.append(beta)
+
+        last = top
+        diagonal = np.array(alphas)
+        off_diagonal = np.array(betas[:-1]).reshape(step, n_vectors)
+        top = np.array([
+            eigvalsh_tridiagonal(diagonal[:, b], off_diagonal[:, b], select='i',
+                                 select_range=(step, step))[0]
+            for b in range(n_vectors)
+        ])
+        if np.all(np.abs(top - last) <= tol * np.abs(top)) or np.all(beta == 0):
+            break
+
+        v = basis[step + 1]
+        np.divide(w, np.where(beta > 0, beta, 1)[:, np.newaxis], out=v)
+
+    return top
+
+
+def _permuted_rows(indptr, n_rows, rng, out=None):
+    '''
+    row indices for the nonzeros of each CSC column after permuting the rows
+    of every column independently
+
+    Only the destinations of the stored entries are drawn: a uniform sample
+    of distinct rows per column. Mostly-full columns take a slice of a full
+    permutation; the rest draw with replacement and redraw within-column
+    repeats until none remain, which is exact because the procedure is
+    symmetric in the rows. Columns are handled in blocks of about
+    BLOCK_ENTRIES stored entries, so temporaries stay small, and the rows are
+    written into `out` (a new int64 array by default).
+    '''
+    n_cols = len(indptr) - 1
+    if out is None:
+        out = np.empty(indptr[-1], dtype=np.int64)
+    start = 0
+    while start < n_cols:
+        stop = np.searchsorted(indptr, indptr[start] + BLOCK_ENTRIES, side='right') - 1
+        stop = min(max(stop, start + 1), n_cols)
+        _permute_block(np.asarray(indptr[start:stop + 1], dtype=np.int64) - indptr[start], n_rows, rng,
+                       out[indptr[start]:indptr[stop]])
+        start = stop
+    return out
+
+
+def _permute_block(indptr, n_rows, rng, rows):
+    counts = np.diff(indptr)
+    cols = np.repeat(np.arange(len(counts)), counts)
+
+    full = counts > n_rows // 2
+    for j in np.flatnonzero(full):
+        rows[indptr[j]:indptr[j + 1]] = rng.permutation(n_rows)[:counts[j]]
+
+    # first round: draw everything, keep the first of each within-column repeat
+    active = np.flatnonzero(~full[cols])
+    rows[active] = rng.integers(0, n_rows, len(active))
+    keys = cols[active] * n_rows + rows[active]
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    first = np.ones(len(sorted_keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    accepted = sorted_keys[first]
+    redraw = active[order[~first]]
+
+    # later rounds only compare the redrawn entries against the accepted keys
+    while len(redraw):
+        rows[redraw] = rng.integers(0, n_rows, len(redraw))
+        keys = cols[redraw] * n_rows + rows[redraw]
+        positions = np.searchsorted(accepted, keys)
+        taken = accepted[np.minimum(positions, len(accepted) - 1)] == keys
+        order = np.argsort(keys, kind='stable')
+        repeated = np.zeros(len(keys), dtype=bool)
+        repeated[order[1:]] = keys[order][1:] == keys[order][:-1]
+        keep = ~taken & ~repeated
+        kept = np.sort(keys[keep])
+        accepted = np.insert(accepted, np.searchsorted(accepted, kept), kept)
+        redraw = redraw[~keep]
+
+
+def shuffled_top_eigenvalues(arrays, shape, mean, scale, seeds, block_width=None, max_steps=60,
+                             **kwargs):
+    '''
+    top covariance eigenvalue of the z-scored data after independently
+    permuting the rows of every column, for each seed
+
+    The shuffled matrices are never formed. For sparse data Lanczos runs on
+    Z^T Z / (n - 1), or on Z Z^T / (n - 1) if there are fewer cells than
+    genes, so that its Krylov vectors have the smaller dimension; the seeds
+    run one after another, each drawing the row indices of the nonzeros into
+    the same buffer. For dense data the permutations of a block of columns
+    are regenerated from the seed when the block is visited, and all seeds
+    in the batch share each pass over the data. There Lanczos runs on
+    Z Z^T, whose products take a single fused pass instead of two, unless
+    its Krylov vectors would outgrow the data itself.
+
+    Parameters:
+    -----------
+    arrays: dict
+        Either {"dense": Fortran-ordered (cells, genes) array} or the CSC
+        arrays {"data", "indptr"} of a (cells, genes) matrix
+    shape: tuple
+        (cells, genes)
+    mean, scale: ndarray
+        Column means and scales used for z-scoring
+    seeds: list of int
+        One seed per shuffle
+    block_width: int, default=None
+        Columns per dense block; by default a block's permutations and
+        shuffled copies hold about 2**23 entries in total
+    '''
+    n_rows, n_cols = shape
+    inv_scale = 1.0 / scale
+    kwargs["max_steps"] = max_steps
+
+    if "dense" in arrays:
+        genes_side = n_cols < (max_steps + 1) * len(seeds)
+        dim = n_cols if genes_side else n_rows
+        data = arrays["dense"]
+        width = block_width or max(1, BLOCK_ENTRIES // (n_rows * len(seeds)))
+        starts = range(0, n_cols, width)
+        index_dtype = np.int32 if n_rows * width < 2**31 else np.int64
+        base = np.tile(np.arange(n_rows, dtype=index_dtype)[:, np.newaxis], (1, width))
+
+        def flat_indices(seed, start):
+            # positions in the column-major flattened block of each shuffled entry
+            w = min(width, n_cols - start)
+            perm = np.random.default_rng([seed, start]).permuted(base[:, :w], axis=0)
+            perm += np.arange(w, dtype=index_dtype) * n_rows
+            return perm.ravel(order='F')
+
+        cache = {}
+        if n_rows * n_cols * len(seeds) * base.itemsize <= PERMUTATION_BUDGET:
+            cache = dict(((seed, start), flat_indices(seed, start)) for seed in seeds for start in starts)
+
+        def shuffled_blocks():
+            for start in starts:
+                stop = min(start + width, n_cols)
+                block = np.asfortranarray(data[:, start:stop], dtype=np.float64).ravel(order='F')
+                yield start, stop, [
+                    block.take(cache[seed, start] if cache else flat_indices(seed, start))
+                    .reshape((n_rows, stop - start), order='F') for seed in seeds]
+
+        if genes_side:
+            def matvec(v):
+                # Z v from one pass over the blocks, then Z^T (Z v) from another
+                s = v * inv_scale
+                y = np.zeros((len(seeds), n_rows))
+                for start, stop, shuffled in shuffled_blocks():
+                    for b, block in enumerate(shuffled):
+                        y[b] += block.dot(s[b, start:stop]) - mean[start:stop].dot(s[b, start:stop])
+                out = np.empty_like(v)
+                totals = y.sum(axis=1)
+                for start, stop, shuffled in shuffled_blocks():
+                    for b, block in enumerate(shuffled):
+                        out[b, start:stop] = y[b].dot(block) - mean[start:stop] * totals[b]
+                return out * inv_scale / (n_rows - 1)
+        else:
+            def matvec(u):
+                # each block contributes Z_b Z_b^T u, in a single pass
+                out = np.zeros_like(u)
+                totals = u.sum(axis=1)
+                for start, stop, shuffled in shuffled_blocks():
+                    m, w = mean[start:stop], inv_scale[start:stop]**2
+                    for b, block in enumerate(shuffled):
+                        r = (u[b].dot(block) - m * totals[b]) * w
+                        out[b] += block.dot(r) - m.dot(r)
+                return out / (n_rows - 1)
+
+        rng = np.random.default_rng(list(seeds))
+        return lanczos_top_eigenvalues(matvec, dim, len(seeds), rng, **kwargs)
+
+    genes_side = n_cols <= n_rows
+    dim = n_cols if genes_side else n_rows
+    nnz = len(arrays["data"])
+    index_dtype = np.int32 if max(n_rows, nnz) < 2**31 else np.int64
+    indptr = np.asarray(arrays["indptr"], dtype=index_dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    tops = []
+    for seed in seeds:
+        _permuted_rows(indptr, n_rows, np.random.default_rng(seed), out=indices)
+        matrix = csc_matrix((arrays["data"], indices, indptr), shape=shape, copy=False)
+
+        def matvec(v, matrix=matrix):
+            if genes_side:
+                s = v[0] * inv_scale
+                y = matrix.dot(s) - mean.dot(s)
+                out = (matrix.T.dot(y) - mean * y.sum()) * inv_scale
+            else:
+                r = (matrix.T.dot(v[0]) - mean * v[0].sum()) * inv_scale**2
+                out = matrix.dot(r) - mean.dot(r)
+            return out[np.newaxis] / (n_rows - 1)
+
+        rng = np.random.default_rng([seed])
+        tops.append(lanczos_top_eigenvalues(matvec, dim, 1, rng, **kwargs)[0])
+    return np.array(tops)
@@ -0,0 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from polyseq import instrument
+from polyseq.linalg import BLOCK_ENTRIES
+
+# data sets above this many cells get nn_descent with method="auto"; None
+# keeps the exact search, since nn_descent has not been measured faster
+# (60000 cells x 30 dimensions: 21 s against 18 s on one core)
+EXACT_MAX_CELLS = None
+
+
+@instrument.instrumented
+def nearest_neighbors(data, n_neighbors, method="auto", random_state=None, n_jobs=1, **kwargs):
+    '''
+    k nearest neighbors of every row of a matrix, excluding the row itself
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data of shape (cells, features), typically a PCA projection
+    n_neighbors: int
+        Number of neighbors per cell
+    method: str, default="auto"
+        "exact" (sklearn), "nndescent" (approximate) or "auto", which is exact
+        unless EXACT_MAX_CELLS is set and exceeded
+    random_state: int, default=None
+        Seed for the approximate search
+    n_jobs: int, default=1
+        Number of threads
+
+    Returns (indices, distances), both of shape (cells, n_neighbors), with
+    each row sorted by increasing euclidean distance.
+    '''
+    data = np.asarray(data)
+    if method == "auto":
+        method = "exact" if EXACT_MAX_CELLS is None or data.shape[0] <= EXACT_MAX_CELLS else "nndescent"
+    if method == "exact":
+        return exact_neighbors(data, n_neighbors, n_jobs=n_jobs)
+    if method == "nndescent":
+        return nn_descent(data, n_neighbors, random_state=random_state, n_jobs=n_jobs, **kwargs)
+    raise ValueError("unknown neighbor search method: {}".format(method))
+
+
+def exact_neighbors(data, n_neighbors, n_jobs=1):
+    '''
+    exact k nearest neighbors with sklearn, excluding each point itself
+    '''
+    from sklearn.neighbors import NearestNeighbors
+    nn = NearestNeighbors(n_neighbors=n_neighbors + 1, n_jobs=n_jobs).fit(data)
+    distances, indices = nn.kneighbors(data)
+    # the point itself is usually, but not always (duplicates), in column 0
+    not_self = indices != np.arange(indices.shape[0])[:, None]
+    keep = np.argsort(~not_self, axis=1, kind='stable')[:, :n_neighbors]
+    return (np.take_along_axis(indices, keep, axis=1),
+            np.take_along_axis(distances, keep, axis=1))
+
+
+def _pair_sq_distances(X, norms, rows, cols):
+    dots = np.einsum('pd,pd->p', X[rows], X[cols])
+    return np.maximum(norms[rows] + norms[cols] - 2 * dots, 0)
+
+
+def _merge(rows, indices, distances, cand_rows, candidates, n, k, distance):
+    '''
+    merge flat (row, candidate) pairs into the sorted k-neighbor lists of the
+    contiguous range of points `rows`; candidates already listed or repeated
+    are dropped before their distances are computed. Returns the new lists and
+    a mask of the entries that came from the candidates.
+    '''
+    n_rows, n_cur = rows.shape[0], indices.size
+    local = np.concatenate([np.repeat(np.arange(n_rows), k), cand_rows - rows[0]])
+    cols = np.concatenate([indices.ravel(), candidates])
+    # a stable sort puts the current entry first among equal pairs
+    order = np.argsort(local * n + cols, kind='stable')
+    local, cols = local[order], cols[order]
+    keep = np.ones(order.shape[0], dtype=bool)
+    keep[1:] = (local[1:] != local[:-1]) | (cols[1:] != cols[:-1])
+    order, local, cols = order[keep], local[keep], cols[keep]
+
+    is_cand = order >= n_cur
+    dist = np.empty(order.shape[0], dtype=distances.dtype)
+    dist[~is_cand] = distances.ravel()[order[~is_cand]]
+    dist[is_cand] = distance(local[is_cand] + rows[0], cols[is_cand])
+
+    # lay the entries of each row out in a padded table and keep the k closest
+    counts = np.bincount(local, minlength=n_rows)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    table = np.full((n_rows, counts.max()), np.inf, dtype=dist.dtype)
+    table[local, np.arange(local.shape[0]) - starts[local]] = dist
+    top = np.argpartition(table, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(top, np.argsort(np.take_along_axis(table, top, axis=1), axis=1), axis=1)
+    top += starts[:, None]
+    return cols[top], dist[top], is_cand[top]
+
+
+def _rp_tree_order(X, leaf_size, rng):
+    '''
+    order of points after recursive random-projection splits into halves
+    until segments hold at most leaf_size points; segments at every level
+    are contiguous, equal-size runs of the order
+    '''
+    n = X.shape[0]
+    order = np.arange(n)
+    n_levels = max(0, int(np.ceil(np.log2(n / leaf_size))))
+    for level in range(n_levels):
+        n_seg = 2**level
+        bounds = (np.arange(n_seg + 1) * n) // n_seg
+        sizes = np.diff(bounds)
+        # split each segment orthogonally to the line through two of its points
+        a = order[bounds[:-1] + rng.integers(0, sizes)]
+        b = order[bounds[:-1] + rng.integers(0, sizes)]
+        direction = X[a] - X[b]
+        seg = np.repeat(np.arange(n_seg), sizes)
+        proj = np.einsum('pd,pd->p', X[order], direction[seg])
+        order = order[np.lexsort((proj, seg))]
+    return order, n_levels
+
+
+def _leaf_neighbors(X, norms, order, n_leaves, k, rows_per_block):
+    '''
+    exact k nearest neighbors of every point within its leaf
+    '''
+    n = X.shape[0]
+    bounds = (np.arange(n_leaves + 1) * n) // n_leaves
+    size = np.diff(bounds).max()
+    # (n_leaves, size) table of points, padded with -1
+    pos = np.arange(size) + bounds[:-1, None]
+    leaves = np.where(pos < bounds[1:, None], order[np.minimum(pos, n - 1)], -1)
+
+    indices = np.empty((n, k), dtype=np.int64)
+    distances = np.empty((n, k), dtype=X.dtype)
+    block = max(1, rows_per_block // size)
+    for start in range(0, n_leaves, block):
+        members = leaves[start:start + block]
+        pts = X[members]
+        d2 = norms[members][:, :, None] + norms[members][:, None, :] - 2 * pts @ pts.transpose(0, 2, 1)
+        d2[(members < 0)[:, None, :].repeat(size, axis=1)] = np.inf
+        d2[:, np.arange(size), np.arange(size)] = np.inf
+        top = np.argpartition(d2, k - 1, axis=2)[:, :, :k]
+        valid = members >= 0
+        rows = members[valid]
+        cols = np.take_along_axis(members[:, None, :].repeat(size, axis=1), top, axis=2)
+        indices[rows] = cols[valid]
+        distances[rows] = np.maximum(np.take_along_axis(d2, top, axis=2)[valid], 0)
+    return indices, distances
+
+
+def _sample_columns(indices, is_new, n_samples, rng):
+    if n_samples >= indices.shape[1]:
+        return indices, is_new
+    # prefer entries that are new since the last round
+    keys = rng.random(indices.shape) + ~is_new
+    cols = np.argpartition(keys, n_samples - 1, axis=1)[:, :n_samples]
+    return (np.take_along_axis(indices, cols, axis=1),
+            np.take_along_axis(is_new, cols, axis=1))
+
+
+def _reverse_sample(forward, forward_new, n_samples, rng):
+    '''
+    up to n_samples random reverse neighbors per point, padded with -1, new
+    ones first
+    '''
+    n = forward.shape[0]
+    src = np.repeat(np.arange(n), forward.shape[1])
+    dst, is_new = forward.ravel(), forward_new.ravel()
+    order = np.lexsort((rng.random(dst.shape[0]) + ~is_new, dst))
+    src, dst, is_new = src[order], dst[order], is_new[order]
+    rank = np.arange(dst.shape[0]) - np.searchsorted(dst, dst)
+    keep = rank < n_samples
+    reverse = np.full((n, n_samples), -1, dtype=forward.dtype)
+    reverse_new = np.zeros((n, n_samples), dtype=bool)
+    reverse[dst[keep], rank[keep]] = src[keep]
+    reverse_new[dst[keep], rank[keep]] = is_new[keep]
+    return reverse, reverse_new
+
+
+def nn_descent(data, n_neighbors, n_trees=4, n_iter=12, sample_size=8, delta=0.001,
+               random_state=None, n_jobs=1):
+    '''
+    approximate k nearest neighbors by NN-descent
+
+    Starting from neighbors found within the leaves of random-projection
+    trees, every round compares each point with
+    the neighbors of a random sample of its forward and reverse neighbors and
+    keeps the closest k. Rounds are vectorized over blocks of points and stop
+    once fewer than delta * n * k list entries change.
+
+    The result is approximate: with the defaults, the fraction of exact
+    neighbors found (recall) was about 0.93 on 20000 and 0.87 on 60000
+    clustered points in 30 dimensions. More trees and a larger sample
+    (n_trees=8, sample_size=15) raised it to 0.99 and 0.97 at about 1.6
+    times the cost.
+
+    Parameters:
+    -----------
+    data: 2D array-like
+        Data of shape (cells, features)
+    n_neighbors: int
+        Number of neighbors per cell
+    n_trees: int, default=4
+        Random-projection trees used for the initial neighbor lists
+    n_iter: int, default=12
+        Maximum number of rounds
+    sample_size: int, default=8
+        Forward and reverse neighbors sampled per point and round
+    delta: float, default=0.001
+        Early stopping threshold
+    random_state: int, default=None
+        Seed
+    n_jobs: int, default=1
+        Number of threads
+    '''
+    X = np.ascontiguousarray(data, dtype=np.float32)
+    n, k = X.shape[0], n_neighbors
+    if k >= n:
+        raise ValueError("n_neighbors must be smaller than the number of cells")
+    # a point has only k forward neighbors to sample
+    sample_size = min(sample_size, k)
+    rng = np.random.default_rng(random_state)
+    norms = np.einsum('ij,ij->i', X, X)
+
+    def distance(rows, cols):
+        return _pair_sq_distances(X, norms, rows, cols)
+
+    # start from exact neighbors within the leaves of a small random-projection
+    # forest; a single tree would leave every leaf a closed island
+    all_rows = np.arange(n)
+    for tree in range(n_trees):
+        order, n_levels = _rp_tree_order(X, max(4 * k, 64), rng)
+        leaf_indices, leaf_distances = _leaf_neighbors(X, norms, order, 2**n_levels, k,
+                                                       BLOCK_ENTRIES // (4 * k))
+        if tree == 0:
+            indices, distances = leaf_indices, leaf_distances
+        else:
+            indices, distances, _ = _merge(all_rows, indices, distances,
+                                           np.repeat(all_rows, k), leaf_indices.ravel(),
+                                           n, k, distance)
+    is_new = np.ones((n, k), dtype=bool)
+
+    n_cand = 4 * sample_size**2 + sample_size
+    chunk_size = max(1, BLOCK_ENTRIES // (n_cand * max(1, X.shape[1])))
+    starts = range(0, n, chunk_size)
+
+    def update(start):
+        rows = np.arange(start, min(start + chunk_size, n))
+        # i meets the neighbors of its neighbors j; pairs where both hops
+        # were already known last round have been compared before
+        hop = neighbors[rows]
+        candidates = neighbors[hop]
+        useful = new[rows][:, :, None] | new[hop]
+        candidates = np.where(useful, candidates, -1).reshape(rows.shape[0], -1)
+        candidates = np.hstack([candidates, reverse[rows]])
+        cand_rows = np.repeat(rows, candidates.shape[1])
+        candidates = candidates.ravel()
+        valid = (candidates >= 0) & (candidates != cand_rows)
+        result = _merge(rows, indices[rows], distances[rows], cand_rows[valid],
+                        candidates[valid], n, k, distance)
+        new_indices[rows], new_distances[rows], new_is_new[rows] = result
+        return int(result[2].sum())
+
+    with ThreadPoolExecutor(n_jobs) as executor:
+        for _ in range(n_iter):
+            forward, forward_new = _sample_columns(indices, is_new, sample_size, rng)
+            reverse, reverse_new = _reverse_sample(forward, forward_new, sample_size, rng)
+            # row n is the all-missing padding row that -1 points to
+            neighbors = np.vstack([np.hstack([forward, reverse]),
+                                   np.full((1, 2 * sample_size), -1)])
+            new = np.vstack([np.hstack([forward_new, reverse_new]),
+                             np.zeros((1, 2 * sample_size), dtype=bool)])
+            new_indices, new_distances = np.empty_like(indices), np.empty_like(distances)
+            new_is_new = np.empty_like(is_new)
+            updates = sum(executor.map(update, starts))
+            indices, distances, is_new = new_indices, new_distances, new_is_new
+            if updates <= delta * n * k:
+                break
+
+    return indices, np.sqrt(distances)
@@ -0,0 +1,162 @@
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+def _extent(x, y, extent=None):
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max())
+    x0, x1, y0, y1 = (float(e) for e in extent)
+    # a flat axis still needs a pixel of nonzero width
+    if x1 <= x0:
+        x0, x1 = x0 - 0.5, x1 + 0.5
+    if y1 <= y0:
+        y0, y1 = y0 - 0.5, y1 + 0.5
+    return x0, x1, y0, y1
+
+
+def _pixels(x, y, shape, extent):
+    '''
+    flat pixel of every point (row-major, row 0 at the bottom), -1 outside
+    the extent
+    '''
+    height, width = shape
+    x0, x1, y0, y1 = extent
+    col = np.floor((x - x0) / (x1 - x0) * width).astype(np.int64)
+    row = np.floor((y - y0) / (y1 - y0) * height).astype(np.int64)
+    # points on the upper edges belong to the last pixel
+    col[x == x1], row[y == y1] = width - 1, height - 1
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    return np.where(inside, row * width + col, -1)
+
+
+def point_counts(x, y, shape, extent=None):
+    '''
+    number of points falling in each pixel of a grid
+
+    Parameters:
+    -----------
+    x, y: 1D array-like
+        Point coordinates
+    shape: tuple of length 2
+        (height, width) of the grid in pixels
+    extent: tuple of length 4, default=None
+        (xmin, xmax, ymin, ymax) covered by the grid; defaults to the range
+        of the points
+
+    Returns (counts, extent), where counts has shape `shape` and row 0 is
+    the bottom of the grid, as for imshow(origin='lower').
+    '''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    extent = _extent(x, y, extent)
+    pixel = _pixels(x, y, shape, extent)
+    counts = np.bincount(pixel[pixel >= 0], minlength=shape[0] * shape[1])
+    return counts.reshape(shape), extent
+
+
+def point_means(x, y, values, shape, extent=None):
+    '''
+    mean of `values` over the points in each pixel of a grid, NaN where
+    there are none; see point_counts
+    '''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    extent = _extent(x, y, extent)
+    pixel = _pixels(x, y, shape, extent)
+    inside = pixel >= 0
+    n_pixels = shape[0] * shape[1]
+    counts = np.bincount(pixel[inside], minlength=n_pixels)
+    sums = np.bincount(pixel[inside], weights=np.asarray(values, dtype=np.float64)[inside],
+                       minlength=n_pixels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.reshape(shape), extent
+
+
+def point_majority(x, y, codes, n_codes, shape, extent=None):
+    '''
+    most frequent integer code (e.g. cluster) among the points in each pixel
+    of a grid, -1 where there are none; ties go to the smaller code. See
+    point_counts.
+
+    Parameters:
+    -----------
+    codes: 1D array-like of int
+        Code of each point, in [0, n_codes)
+    n_codes: int
+        Number of distinct codes
+    '''
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    extent = _extent(x, y, extent)
+    pixel = _pixels(x, y, shape, extent)
+    inside = pixel >= 0
+    n_pixels = shape[0] * shape[1]
+    votes = np.bincount(pixel[inside] * n_codes + np.asarray(codes)[inside],
+                        minlength=n_pixels * n_codes).reshape(n_pixels, n_codes)
+    majority = np.where(votes.any(axis=1), votes.argmax(axis=1), -1)
+    return majority.reshape(shape), extent
+
+
+def row_bins(n_rows, n_bins, labels=None):
+    '''
+    splits rows 0..n_rows-1 into at most n_bins runs of consecutive rows
+
+    With labels, runs never straddle a change of label (e.g. a cluster
+    boundary in cluster-sorted data); every labelled run of rows keeps at
+    least one bin and the remaining bins are shared in proportion to length.
+    If there are more runs than bins (e.g. clustered rows that are not
+    sorted by cluster), adjacent runs are merged into bins of about equal
+    size instead.
+
+    Returns (bins, starts): the bin of every row and the first row of every
+    bin.
+    '''
+    if labels is None:
+        boundaries = np.array([0, n_rows])
+    else:
+        labels = np.asarray(labels)
+        changes = np.flatnonzero(labels[1:] != labels[:-1]) + 1
+        boundaries = np.concatenate([[0], changes, [n_rows]])
+    if boundaries.shape[0] - 1 > n_bins:
+        # merge runs: cut at the first run boundary past each equal split
+        targets = np.arange(n_bins + 1) * n_rows / float(n_bins)
+        boundaries = np.unique(boundaries[np.searchsorted(boundaries, targets)])
+    lengths = np.diff(boundaries)
+
+    # largest-remainder allocation of bins to runs, at least one each
+    quota = lengths * (n_bins - lengths.shape[0]) / float(n_rows)
+    alloc = 1 + np.floor(quota).astype(np.int64)
+    remainder = n_bins - alloc.sum()
+    alloc[np.argsort(-(quota - np.floor(quota)), kind='stable')[:remainder]] += 1
+    alloc = np.minimum(alloc, lengths)
+
+    run = np.repeat(np.arange(lengths.shape[0]), lengths)
+    offset = np.arange(n_rows) - boundaries[run]
+    first_bin = np.concatenate([[0], np.cumsum(alloc)[:-1]])
+    bins = first_bin[run] + offset * alloc[run] // lengths[run]
+    starts = np.flatnonzero(np.concatenate([[True], bins[1:] != bins[:-1]]))
+    return bins, starts
+
+
+def aggregate_rows(matrix, n_bins, labels=None):
+    '''
+    averages runs of consecutive rows so that a matrix has at most n_bins
+    rows, e.g. to draw a heatmap with one row per pixel; see row_bins
+
+    Parameters:
+    -----------
+    matrix: 2D array-like or scipy.sparse matrix
+        Matrix of shape (rows, columns)
+    n_bins: int
+        Maximum number of output rows
+    labels: 1D array-like, default=None
+        Label of each row; runs of equal labels are aggregated separately
+
+    Returns (reduced, starts): the averaged matrix as a dense ndarray and the
+    first input row of every output row.
+    '''
+    n_rows = matrix.shape[0]
+    bins, starts = row_bins(n_rows, n_bins, labels)
+    counts = np.bincount(bins).astype(np.float64)
+    indicator = csr_matrix((1.0 / counts[bins], (bins, np.arange(n_rows))),
+                           shape=(counts.shape[0], n_rows))
+    reduced = indicator @ (matrix if issparse(matrix) else np.asarray(matrix, dtype=np.float64))
+    return np.asarray(reduced.todense() if issparse(reduced) else reduced), starts
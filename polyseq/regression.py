@@ -1,19 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-from sklearn.linear_model import LinearRegression
+import pandas as pd
+from scipy.linalg import qr
+from scipy.sparse import csc_matrix, issparse
 
+from polyseq import instrument
+from polyseq.cache import memoize
 from polyseq.expression_matrix import ExpressionMatrix
+from polyseq.lazy import LazyMatrix
+from polyseq.linalg import BLOCK_ENTRIES
+
+
+def _one_hot(labels):
+    '''
+    indicator columns for all but the first category of `labels`; the
+    intercept stands in for the dropped one
+    '''
+    codes, _ = pd.factorize(np.asarray(labels), sort=True)
+    n_levels = codes.max() + 1
+    encoded = np.zeros((codes.shape[0], max(n_levels - 1, 0)))
+    rows = np.flatnonzero(codes > 0)
+    encoded[rows, codes[rows] - 1] = 1
+    return encoded
+
+
+def design_matrix(index, regressors=None, categorical=None):
+    '''
+    design matrix with an intercept, numeric regressors and one-hot encoded
+    categorical covariates
+
+    Parameters:
+    -----------
+    index: pandas Index
+        Cell index; categorical covariates given by name are read from its
+        levels
+    regressors: 1D or 2D array-like, default=None
+        Numeric covariates of shape (cells,) or (cells, regressors)
+    categorical: str, ndarray or list of them, default=None
+        Index level names (e.g. "sample" after concat) or arrays of labels;
+        a list holds several covariates
+    '''
+    n_cells = len(index)
+    columns = [np.ones((n_cells, 1))]
+    if regressors is not None:
+        regressors = np.asarray(regressors, dtype=np.float64)
+        columns.append(regressors[:, np.newaxis] if regressors.ndim == 1 else regressors)
+    if categorical is not None:
+        if not isinstance(categorical, (list, tuple)):
+            categorical = [categorical]
+        for covariate in categorical:
+            if isinstance(covariate, str):
+                covariate = index.get_level_values(covariate)
+            columns.append(_one_hot(covariate))
+    return np.hstack(columns)
+
+
+def _orthonormal_basis(design):
+    '''
+    orthonormal basis of the column space of `design`, dropping columns that
+    are (numerically) linear combinations of the others
+    '''
+    q, r, _ = qr(design, mode='economic', pivoting=True)
+    diag = np.abs(np.diag(r))
+    rank = int((diag > diag[0] * max(design.shape) * np.finfo(np.float64).eps).sum())
+    return q[:, :rank]
+
+
+@instrument.instrumented
+@memoize(ignore=("n_processes", "chunk_size"),
+         uncached_if=lambda args: args["out"] is not None)
+def regress(data, regressors=None, n_processes=1, categorical=None, chunk_size=None,
+            dtype=np.float32, out=None):
+    '''
+    regresses covariates out of every gene and z-scores the residuals
+
+    The design matrix is factorized once (QR), after which the residuals of
+    a block of genes Y are Y - Q (Q^T Y). Blocks of genes are converted to
+    `dtype`, fitted and z-scored independently and written straight into a
+    single preallocated output, so apart from the output only one block per
+    thread is held in memory.
+
+    Parameters:
+    -----------
+    data: ExpressionMatrix, SparseExpressionMatrix or 2D array-like
+        Data of shape (cells, genes)
+    regressors: 1D or 2D array-like, default=None
+        Numeric covariates of shape (cells,) or (cells, regressors)
+    n_processes: int, default=1
+        Number of threads working on blocks of genes
+    categorical: str, ndarray or list of them, default=None
+        Categorical covariates, one-hot encoded: index level names such as
+        "sample" (as produced by concat) or arrays of labels
+    chunk_size: int, default=None
+        Genes per block; by default blocks hold about 2**23 entries
+    dtype: numpy dtype, default=np.float32
+        Precision of the computation and of the output
+    out: ndarray, default=None
+        Array of shape (cells, genes) to write the result into, e.g. an
+        np.memmap; allocated if omitted
 
+    Returns:
+    --------
+    ExpressionMatrix of z-scored residuals (ddof=1 per gene), backed by `out`;
+    for a LazyMatrix the step is recorded in its plan instead
+    '''
+    if isinstance(data, LazyMatrix):
+        return data.regress(regressors, categorical=categorical)
 
-def regress(data, regressors, n_processes=1):
+    index = getattr(data, "index", None)
+    columns = getattr(data, "columns", None)
+    matrix = data.matrix if hasattr(data, "matrix") else data
+    if issparse(matrix):
+        # column blocks are cheap to slice from CSC
+        matrix = csc_matrix(matrix)
+    elif isinstance(matrix, pd.DataFrame):
+        matrix = matrix.values
+    else:
+        matrix = np.asarray(matrix)
+    n_cells, n_genes = matrix.shape
+    if index is None:
+        index = pd.RangeIndex(n_cells, name="cell")
 
-    regressors = np.array(regressors)
-    regressors = regressors[:, np.newaxis] if regressors.ndim == 1 else regressors
+    with instrument.span("design"):
+        basis = _orthonormal_basis(design_matrix(index, regressors, categorical)).astype(dtype)
+    if out is None:
+        out = np.empty((n_cells, n_genes), dtype=dtype)
+        instrument.count("alloc_bytes", out.nbytes)
+    chunk_size = chunk_size or max(1, BLOCK_ENTRIES // max(1, n_cells))
 
-    model = LinearRegression(n_jobs=n_processes)
-    model.fit(regressors, data)
+    def fit(start):
+        stop = min(start + chunk_size, n_genes)
+        block = matrix[:, start:stop]
+        if issparse(block):
+            block = block.toarray().astype(dtype, copy=False)
+        else:
+            block = np.array(block, dtype=dtype)
+        block -= basis @ (basis.T @ block)
+        block -= block.mean(axis=0)
+        std = np.sqrt((block**2).sum(axis=0, dtype=np.float64) / max(n_cells - 1, 1))
+        # genes the covariates explain completely are left at zero
+        block /= np.where(std > 0, std, 1.0).astype(dtype)
+        out[:, start:stop] = block
 
-    y_hat = model.predict(regressors)
-    residuals = data - y_hat
+    starts = range(0, n_genes, chunk_size)
+    with instrument.span("fit", genes=n_genes, blocks=len(starts)):
+        if n_processes > 1:
+            with ThreadPoolExecutor(n_processes) as executor:
+                list(executor.map(fit, starts))
+        else:
+            for start in starts:
+                fit(start)
 
-    zscores = (residuals - residuals.mean())/residuals.std()
-    return ExpressionMatrix(zscores, columns=data.columns)
+    return ExpressionMatrix(out, index=index, columns=columns, copy=False)
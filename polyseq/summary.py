@@ -1,50 +1,241 @@
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from scipy.sparse import issparse
 
+from polyseq import instrument
+from polyseq.linalg import iter_row_blocks
 from polyseq.viz import kde_plot, STYLE_CONTEXTS
 
+# integer values up to this size are tallied exactly with bincount
+MAX_BIN = 2**20
+# relative width of the logarithmic bins used for any other values
+RELATIVE_ERROR = 1e-3
 
-def summarize(data, umi_threshold=1, plot=True):
 
-    counts_by_cell = data.sum(axis=1)
-    genes_expressed = (data >= umi_threshold).sum(axis=1)
-    counts_by_gene = data.sum(axis=0)
-    cells_expressed = (data > umi_threshold).sum(axis=0)
+def _is_small_integer(values):
+    return values.size == 0 or (values.min() >= 0 and values.max() < MAX_BIN
+                                and np.array_equal(values, np.floor(values)))
 
-    # central_tendency = np.log(data + 1).mean(axis=0)
-    # spread = np.log(data + 1).std(axis=0)
-    # central_tendency = data.mean(axis=0)
-    # spread = data.std(axis=0)
-    #
-    # good_inds = (central_tendency > 0) & (spread > 0)
-    # central_tendency, spread = central_tendency[good_inds], spread[good_inds]
-    # dispersion = spread/central_tendency
 
-    data = data.__array__().flatten()
-    distributions = {
-        'umis': data,
-        'umis above {}'.format(umi_threshold - 1): data[data >= umi_threshold],
+def _add_bins(offset, tally, keys, weights):
+    '''
+    adds weighted integer keys to a tally of keys offset, offset+1, ...
+    '''
+    if keys.size == 0:
+        return offset, tally
+    lo, hi = keys.min(), keys.max()
+    if tally.size:
+        lo, hi = min(lo, offset), max(hi, offset + tally.size - 1)
+    merged = np.bincount(keys - lo, weights=weights, minlength=hi - lo + 1).astype(np.float64)
+    merged[offset - lo:offset - lo + tally.size] += tally
+    return lo, merged
+
+
+class _ValueCounts(object):
+    '''
+    Distribution of the entries of a matrix, accumulated block by block
+
+    Integers in [0, MAX_BIN) are counted exactly. Once any other value is
+    seen, all values are kept in bins whose bounds grow by a factor of
+    1 + 2 * RELATIVE_ERROR, each reported by a center within RELATIVE_ERROR
+    of every value in it, so the number of bins depends on the range of the
+    values rather than on how many there are. Minimum and maximum stay exact.
+    '''
+
+    def __init__(self):
+        self.exact = True
+        self.tally = np.zeros(0)
+        self.n_zeros = 0
+        self.negative, self.positive = (0, np.zeros(0)), (0, np.zeros(0))
+        self.min, self.max = np.inf, -np.inf
+        self.total = 0
+        self._log_gamma = np.log1p(2 * RELATIVE_ERROR)
+
+    def add(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        if values.size == 0:
+            return
+        self.min, self.max = min(self.min, values.min()), max(self.max, values.max())
+        self.total += values.shape[0] if weights is None else int(np.sum(weights))
+        if self.exact and _is_small_integer(values):
+            tally = np.bincount(values.astype(np.int64), weights=weights,
+                                minlength=self.tally.size).astype(np.float64)
+            tally[:self.tally.size] += self.tally
+            self.tally = tally
+            return
+        if self.exact:
+            # move the integers counted so far into logarithmic bins
+            self.exact = False
+            seen = np.flatnonzero(self.tally)
+            tally, self.tally = self.tally, np.zeros(0)
+            self._add_logarithmic(seen.astype(np.float64), tally[seen])
+        self._add_logarithmic(values, weights)
+
+    def _add_logarithmic(self, values, weights):
+        weights = np.ones(values.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+        zero = values == 0
+        self.n_zeros += weights[zero].sum()
+        for sign, side in [(1, "positive"), (-1, "negative")]:
+            mask = sign * values > 0
+            keys = np.ceil(np.log(sign * values[mask]) / self._log_gamma).astype(np.int64)
+            setattr(self, side, _add_bins(*getattr(self, side), keys=keys, weights=weights[mask]))
+
+    def result(self):
+        '''
+        sorted distinct values (or bin centers) and their counts
+        '''
+        if self.exact:
+            values = np.flatnonzero(self.tally)
+            return values.astype(np.float64), np.rint(self.tally[values]).astype(np.int64)
+        gamma = np.exp(self._log_gamma)
+        parts = []
+        for sign, (offset, tally) in [(-1, self.negative), (1, self.positive)]:
+            keys = offset + np.flatnonzero(tally)
+            centers = sign * 2 * gamma**keys / (gamma + 1)
+            parts.append((centers, tally[keys - offset]))
+        (neg_values, neg_counts), (pos_values, pos_counts) = parts
+        values = np.concatenate([neg_values[::-1], [0.0] if self.n_zeros else [], pos_values])
+        counts = np.concatenate([neg_counts[::-1], [self.n_zeros] if self.n_zeros else [], pos_counts])
+        if values.size:
+            # the outermost bins hold the extremes
+            values[0], values[-1] = self.min, self.max
+        return values, np.rint(counts).astype(np.int64)
+
+
+def _counted_stats(values, counts):
+    '''
+    min, max, mean and median of a distribution given as sorted distinct
+    values and their counts; the median matches np.median on the expanded data
+    '''
+    n = counts.sum()
+    if n == 0:
+        return {'min': np.nan, 'max': np.nan, 'mean': np.nan, 'median': np.nan}
+    cumulative = np.cumsum(counts)
+    lower = values[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+    upper = values[np.searchsorted(cumulative, n // 2, side='right')]
+    return {
+        'min': values[0],
+        'max': values[-1],
+        'mean': (values * counts).sum() / n,
+        'median': (lower + upper) / 2.0,
+    }
+
+
+def _array_stats(values):
+    return {'min': np.min(values), 'max': np.max(values), 'mean': np.mean(values),
+            'median': np.median(values)}
+
+
+@instrument.instrumented
+def summary_stats(data, umi_threshold=1, chunk_size=None):
+    '''
+    per-cell and per-gene totals and the distribution of all matrix entries,
+    gathered in a single pass over row blocks
+
+    The entries are never flattened: each block adds its nonzero values to
+    a distribution held in bounded memory, and zeros are counted rather than
+    stored. Integer UMI counts are tallied exactly; other values (e.g.
+    normalized data) go into logarithmic bins, so their median and mean are
+    within RELATIVE_ERROR (see _ValueCounts).
+
+    Parameters:
+    -----------
+    data: ExpressionMatrix, SparseExpressionMatrix, 2D array-like or np.memmap
+        Data of shape (cells, genes)
+    umi_threshold: int, default=1
+        Minimum UMIs for a gene to count as expressed
+    chunk_size: int, default=None
+        Rows per block; by default blocks hold about 2**23 entries
+
+    Returns:
+    --------
+    dict with 'umis per cell', 'genes expressed', 'umis per gene' and
+    'cells expressing' arrays and the ('values', 'counts') of all entries
+    '''
+    n_cells, n_genes = data.shape
+    counts_by_cell = np.empty(n_cells)
+    genes_expressed = np.empty(n_cells, dtype=np.int64)
+    counts_by_gene = np.zeros(n_genes)
+    cells_expressed = np.zeros(n_genes, dtype=np.int64)
+    distribution = _ValueCounts()
+
+    for start, stop, block in iter_row_blocks(data, chunk_size):
+        n_rows = stop - start
+        if issparse(block):
+            entries = block.data
+            row_nnz = np.diff(block.indptr)
+            col_nnz = np.bincount(block.indices, minlength=n_genes)
+            rows = np.repeat(np.arange(n_rows), row_nnz)
+            counts_by_cell[start:stop] = np.bincount(rows, weights=entries, minlength=n_rows)
+            counts_by_gene += np.bincount(block.indices, weights=entries, minlength=n_genes)
+            # stored entries are compared directly; implicit zeros are counted
+            genes_expressed[start:stop] = np.bincount(rows, weights=entries >= umi_threshold,
+                                                      minlength=n_rows)
+            genes_expressed[start:stop] += (umi_threshold <= 0) * (n_genes - row_nnz)
+            cells_expressed += np.bincount(block.indices, weights=entries > umi_threshold,
+                                           minlength=n_genes).astype(np.int64)
+            cells_expressed += (umi_threshold < 0) * (n_rows - col_nnz)
+        else:
+            entries = block[block != 0]
+            counts_by_cell[start:stop] = block.sum(axis=1)
+            counts_by_gene += block.sum(axis=0)
+            genes_expressed[start:stop] = (block >= umi_threshold).sum(axis=1)
+            cells_expressed += (block > umi_threshold).sum(axis=0)
+        distribution.add(entries[entries != 0])
+
+    n_zeros = n_cells * n_genes - distribution.total
+    if n_zeros:
+        distribution.add(np.zeros(1), np.array([n_zeros]))
+    values, counts = distribution.result()
+    return {
         'umis per cell': counts_by_cell,
         'genes expressed': genes_expressed,
         'umis per gene': counts_by_gene,
         'cells expressing': cells_expressed,
+        'values': values,
+        'counts': counts,
     }
 
-    stats = {
-        'min': np.min,
-        'max': np.max,
-        'mean': np.mean,
-        'median': np.median
+
+@instrument.instrumented
+def summarize(data, umi_threshold=1, plot=True, chunk_size=None):
+    '''
+    min, max, mean and median of the UMI distributions of a data set, with
+    optional QC plots; see summary_stats
+
+    Parameters:
+    -----------
+    data: ExpressionMatrix, SparseExpressionMatrix, 2D array-like or np.memmap
+        Data of shape (cells, genes)
+    umi_threshold: int, default=1
+        Minimum UMIs for a gene to count as expressed
+    plot: bool, default=True
+        Whether to plot the per-cell and per-gene distributions
+    chunk_size: int, default=None
+        Rows per block
+    '''
+    summary = summary_stats(data, umi_threshold, chunk_size)
+    counts_by_cell = summary['umis per cell']
+    genes_expressed = summary['genes expressed']
+    counts_by_gene = summary['umis per gene']
+    cells_expressed = summary['cells expressing']
+    values, counts = summary['values'], summary['counts']
+    above = values >= umi_threshold
+
+    distributions = {
+        'umis': _counted_stats(values, counts),
+        'umis above {}'.format(umi_threshold - 1): _counted_stats(values[above], counts[above]),
+        'umis per cell': _array_stats(counts_by_cell),
+        'genes expressed': _array_stats(genes_expressed),
+        'umis per gene': _array_stats(counts_by_gene),
+        'cells expressing': _array_stats(cells_expressed),
     }
 
-    result = pd.DataFrame()
-    for dist_name, dist in distributions.items():
-        df = pd.DataFrame()
-        for stat_name, stat in stats.items():
-            df[stat_name] = [int(np.round(stat(dist)))]
-        df.index = [dist_name]
-        result = pd.concat([result, df])
+    result = pd.DataFrame.from_dict(distributions, orient='index')[['min', 'max', 'mean', 'median']]
+    result = result.round()
+    if not result.isnull().values.any():
+        result = result.astype(int)
 
     if plot:
 
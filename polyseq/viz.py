@@ -1,77 +1,166 @@
-import collections
+import collections.abc
 
 import seaborn as sns
 import numpy as np
 from matplotlib import pyplot as plt
 import matplotlib as mpl
-from sklearn.neighbors.kde import KernelDensity
+from scipy.sparse import issparse
 
+from polyseq.density import binned_kde
+from polyseq.expression_matrix import GroupIndex
+from polyseq.raster import aggregate_rows, point_counts, point_majority, point_means
 
-STYLE_CONTEXTS = ['seaborn-talk', 'seaborn-whitegrid']
 
+def _style(name):
+    # matplotlib >= 3.6 ships the seaborn styles as seaborn-v0_8-*
+    if name in plt.style.available:
+        return name
+    return name.replace('seaborn', 'seaborn-v0_8', 1)
 
-def violins(data, genes, group_by=None, cluster_genes=True, figsize=(20, 20)):
-    ncols = len(genes)
-    subset = data.copy()[genes]
 
-    groups = data.index.get_level_values(group_by)
+STYLE_CONTEXTS = [_style('seaborn-talk'), _style('seaborn-whitegrid')]
 
-    if groups is not None:
-        subset['group'] = groups
+# scatter plots with more points are drawn as aggregated images
+RASTER_MIN_POINTS = 100000
 
-        if cluster_genes:
-            from .utils import cluster_arg_sort
 
-            X = subset.groupby('group').mean().__array__().T
-            order = cluster_arg_sort(X)
+def violins(data, genes, group_by=None, cluster_genes=True, figsize=(20, 20)):
+    ncols = len(genes)
 
-    if not cluster_genes:
-        order = range(len(genes))
+    groups = data.index.get_level_values(group_by) if group_by is not None else None
+    order = range(len(genes))
+
+    if groups is not None and cluster_genes:
+        from .utils import cluster_arg_sort
+
+        # group means come from the cached per-cluster statistics
+        X = data.cluster_stats(group_by).mean()[genes].__array__().T
+        order = cluster_arg_sort(X)
 
     f, axes = plt.subplots(1, ncols, sharey=True, figsize=figsize)
     f.subplots_adjust(wspace=0)
+    axes = np.atleast_1d(axes)
 
-    cmap = mpl.cm.get_cmap('tab10')
+    cmap = plt.get_cmap('tab10')
+    names = np.sort(np.unique(groups)) if groups is not None else np.array([''])
 
     for i in range(len(genes)):
         c = cmap((i % 10) / 10)
-        ax, col = axes[i], subset.columns[order[i]] 
+        ax, col = axes[i], genes[order[i]]
+        values = np.asarray(data[col], dtype=np.float64).ravel()
+        samples = [values[groups == name] for name in names] if groups is not None else [values]
+        grids, density = _violin_densities(samples)
+        # every violin gets the same maximum width
+        half_width = 0.4 * density / np.maximum(density.max(axis=1, keepdims=True), 1e-300)
+        for k in range(len(names)):
+            if samples[k].size:
+                ax.fill_between(grids[k], k - half_width[k], k + half_width[k], facecolor=c,
+                                edgecolor='0.25', linewidth=2)
         ax.xaxis.set_visible(False)
-        sns.violinplot(y=groups, x=data[col], order=np.sort(np.unique(groups)), color=c,
-                       orient="h", ax=ax, scale='width', bw=0.3, gridsize=50, inner=None, linewidth=2)
+        ax.set_yticks(range(len(names)))
+        ax.set_yticklabels(names)
+        ax.set_ylim(len(names) - 0.5, -0.5)
         ax.set_ylabel('')
         ax.set_title(col, rotation=45, y=1.08)
         if groups is not None:
-            ax.set_xlim([0, subset.groupby('group')[col].apply(lambda x: np.percentile(x, 100)).max()])
+            ax.set_xlim([0, values.max()])
+
+
+def _violin_densities(samples, bw=0.3, cut=2.0, gridsize=50):
+    '''
+    kernel densities of several groups of samples in one batched call; the
+    bandwidth is `bw` standard deviations and each grid extends `cut`
+    bandwidths past its group's extremes
+    '''
+    bandwidth = np.array([bw * s.std(ddof=1) if s.size > 1 else 0.0 for s in samples])
+    low = np.array([s.min() if s.size else 0.0 for s in samples]) - cut * bandwidth
+    high = np.array([s.max() if s.size else 0.0 for s in samples]) + cut * bandwidth
+    # constant groups still need a grid of nonzero width
+    flat = high - low <= 0
+    low, high = np.where(flat, low - 0.5, low), np.where(flat, high + 0.5, high)
+    grids = low[:, np.newaxis] + (high - low)[:, np.newaxis] * np.linspace(0, 1, gridsize)
+    return grids, binned_kde(list(samples), grids, bandwidth)
+
+
+def scatter(data, color_by=None, cmap=None, rasterize=None, **kwargs):
+    '''
+    Scatter plot of the first two columns of a data set, e.g. a projection
 
-def scatter(data, color_by=None, cmap=None, **kwargs):
-    x = data.iloc[:, 0]
-    y = data.iloc[:, 1]
+    Above RASTER_MIN_POINTS points the points are binned into the pixels of
+    the axes (see polyseq.raster) and drawn as one image: point counts,
+    the mean of `color_by` values, or the majority `color_by` level of each
+    pixel. The cost then depends on the axes resolution, not the cell count.
 
+    Parameters:
+    -----------
+    data: DataFrame
+        Coordinates of shape (cells, 2 or more)
+    color_by: str or 1D array-like, default=None
+        Index level to color by, or one value per cell
+    cmap: str or Colormap, default=None
+        Color map
+    rasterize: bool, default=None
+        Draw an aggregated image; defaults to True above RASTER_MIN_POINTS
+    '''
+    x = np.asarray(data.iloc[:, 0], dtype=np.float64)
+    y = np.asarray(data.iloc[:, 1], dtype=np.float64)
+    if rasterize is None:
+        rasterize = x.shape[0] > RASTER_MIN_POINTS
+
+    values, codes = None, None
     if color_by is None:
-        plt.scatter(x, y, cmap=cmap, **kwargs)
-    elif isinstance(color_by, collections.Iterable) and not isinstance(color_by, str):
+        pass
+    elif isinstance(color_by, collections.abc.Iterable) and not isinstance(color_by, str):
         cmap = 'Blues' if cmap is None else cmap
-        plt.scatter(x, y, c=color_by, cmap=cmap, **kwargs)
+        values = np.asarray(color_by)
     elif color_by in data.index.names:
-        color_idx = data.index.names.index(color_by)
-        color_levels = data.index.levels[color_idx]
-        color_labels = data.index.labels[color_idx]
-
+        groups = (data.cluster_groups(color_by) if hasattr(data, "cluster_groups")
+                  else GroupIndex.from_index(data.index, color_by))
+        color_levels, codes = groups.categories, groups.codes
         n_levels = len(color_levels)
         cmap = 'gist_stern' if cmap is None else cmap
-        cmap = mpl.cm.get_cmap(cmap)
+        cmap = plt.get_cmap(cmap)
         if isinstance(cmap, mpl.colors.ListedColormap):
             colors = np.array(cmap.colors)[np.arange(n_levels) % len(cmap.colors)]
         else:
             colors = cmap(np.arange(n_levels, dtype='float') / n_levels)[:, :-1]
 
+    if not rasterize:
+        if codes is not None:
+            for i in range(n_levels):
+                rows = groups.rows_of(i)
+                label = "{} {}".format(color_by, i)
+                plt.scatter(x[rows], y[rows], c=[colors[i]], label=label, **kwargs)
+        else:
+            plt.scatter(x, y, c=values, cmap=cmap, **kwargs)
+        return
+
+    ax = plt.gca()
+    bbox = ax.get_window_extent()
+    shape = (max(1, int(bbox.height)), max(1, int(bbox.width)))
+    if codes is not None:
+        labelled = codes >= 0
+        majority, extent = point_majority(x[labelled], y[labelled], codes[labelled], n_levels, shape)
+        image = mpl.colors.to_rgba_array(colors)[np.maximum(majority, 0)]
+        image[majority < 0] = 0
         for i in range(n_levels):
-            mask = color_labels == i
-            label = "{} {}".format(color_by, i)
-            plt.scatter(x[mask], y[mask], c=[colors[i]], label=label, **kwargs)
+            # empty artists carry the legend entries
+            ax.scatter([], [], color=colors[i], label="{} {}".format(color_by, i))
+    elif values is not None:
+        image, extent = point_means(x, y, values, shape)
+        image = np.ma.masked_invalid(image)
+    else:
+        image, extent = point_counts(x, y, shape)
+        image = np.ma.masked_equal(image, 0)
+        cmap = 'Blues' if cmap is None else cmap
+    ax.imshow(image, cmap=cmap, extent=extent, origin='lower', aspect='auto',
+              interpolation='nearest')
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+
 
-def heatmap(data, figsize=(10, 10), cmap='viridis', row_names=False, col_names=True, col_rotation=30, log_norm=False, colorbar=False):
+def heatmap(data, figsize=(10, 10), cmap='viridis', row_names=False, col_names=True, col_rotation=30, log_norm=False, colorbar=False,
+            max_rows=None):
     '''
     Draws a heatmap of gene expression levels across cells
 
@@ -93,6 +182,11 @@ def heatmap(data, figsize=(10, 10), cmap='viridis', row_names=False, col_names=T
         Apply log normalization to color map
     colorBar: bool, defualt=True
         Include a color bar.
+    max_rows: int, default=None
+        Cells beyond this many are averaged over runs of consecutive rows,
+        never mixing clusters, so that the image has about one row per pixel
+        (see polyseq.raster.aggregate_rows). Defaults to the figure height in
+        pixels.
     '''
     # aspect = h/w
     # figsize = (w, h)
@@ -105,13 +199,25 @@ def heatmap(data, figsize=(10, 10), cmap='viridis', row_names=False, col_names=T
     sns.set_style('white')
     r = 1.0*figsize[1]/figsize[0]
 
-    plt.figure(figsize=figsize)
-    im = plt.imshow(data, cmap=cmap, aspect=r, interpolation='none', norm=norm)
+    fig = plt.figure(figsize=figsize)
+    if max_rows is None:
+        max_rows = int(figsize[1] * fig.dpi)
+    matrix = data.matrix if hasattr(data, "matrix") else np.asarray(data)
+    index = data.index
+    if matrix.shape[0] > max_rows:
+        clusters = getattr(data, "clusters", None)
+        matrix, starts = aggregate_rows(matrix, max_rows, clusters)
+        index = index[starts]
+        # keep the image the shape it would have had at full size
+        r *= float(data.shape[0]) / matrix.shape[0]
+    elif issparse(matrix):
+        matrix = matrix.toarray()
+    im = plt.imshow(matrix, cmap=cmap, aspect=r, interpolation='none', norm=norm)
     ax = plt.gca()
 
     if colorbar:
         if log_norm:
-            maxDecade = np.floor(np.log10(data.max().max())).astype(int)
+            maxDecade = np.floor(np.log10(matrix.max())).astype(int)
             ticks = [10**k for k in range(maxDecade+1)]
             plt.colorbar(im, ticks=ticks, fraction=0.045, pad=0.04)
         else:
@@ -123,8 +229,8 @@ def heatmap(data, figsize=(10, 10), cmap='viridis', row_names=False, col_names=T
             #cb.update_ticks()
 
     if row_names:
-        ax.set_yticks(range(data.shape[0]))
-        ax.set_yticklabels(data.index)
+        ax.set_yticks(range(matrix.shape[0]))
+        ax.set_yticklabels(index)
 
     if col_names:
         ax.set_xticks(range(data.shape[1]))
@@ -136,14 +242,14 @@ def kde_plot(samples, ax=None, eps=0.1, bw_factor=10.0):
     if ax is None:
         ax = plt.gca()
 
+    samples = np.asarray(samples, dtype=np.float64).ravel()
     n_samples = len(samples)
 
     min_score, max_score = (1 - eps) * samples.min(), (1 + eps) * samples.max()
     bandwidth = bw_factor * (max_score - min_score) / n_samples
 
-    kde = KernelDensity(kernel='gaussian', bandwidth=bandwidth).fit(samples[:, np.newaxis])
     s = np.linspace(min_score, max_score, 100)
-    density = np.exp(kde.score_samples(s[:, np.newaxis]))
+    density = binned_kde(samples, s, bandwidth)
 
     ax.fill_between(s.squeeze(), 0, density.squeeze())
     ylim = [0, (1 + eps) * density.max()]
@@ -0,0 +1,32 @@
+import numpy as np
+
+from polyseq import benchmark
+
+
+def test_synthetic_counts():
+    data, labels = benchmark.synthetic_counts(500, n_genes=100, n_clusters=4, n_markers=10,
+                                              chunk_size=128)
+    assert data.shape == (500, 100)
+    assert labels.shape == (500,) and set(labels) == {0, 1, 2, 3}
+    counts = data.matrix.toarray()
+    assert (counts >= 0).all() and (counts == np.round(counts)).all()
+    # overdispersed relative to Poisson within a cluster
+    first = counts[labels == 0]
+    assert (first.var(axis=0) > first.mean(axis=0))[first.mean(axis=0) > 5].mean() > 0.9
+    again, _ = benchmark.synthetic_counts(500, n_genes=100, n_clusters=4, n_markers=10,
+                                          chunk_size=128)
+    np.testing.assert_array_equal(again.matrix.toarray(), counts)
+
+
+def test_run_and_compare(tmp_path):
+    results = benchmark.run_benchmark(sizes=[300], stages=["io", "qc", "normalize"], n_genes=50,
+                                      workdir=str(tmp_path))
+    assert [r["stage"] for r in results["results"]] == ["io", "qc", "normalize"]
+    assert all(r["seconds"] > 0 and r["peak_rss_mb"] > 0 for r in results["results"])
+    assert benchmark.compare(results, results) == []
+
+    slower = {"results": [dict(r, seconds=r["seconds"] * 2 + 1) for r in results["results"]]}
+    regressions = benchmark.compare(slower, results)
+    assert [r["stage"] for r in regressions] == ["io", "qc", "normalize"]
+    assert all(r["metric"] == "seconds" and r["ratio"] > 1.25 for r in regressions)
+    assert list(benchmark.report(slower, results)["seconds_ratio"] > 1) == [True] * 3
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+import polyseq as pseq
+from polyseq import cache
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+
+np.random.seed(0)
+
+counts = np.random.poisson(1.0, size=(300, 40)).astype(float)
+big = np.random.randn(2**20)
+
+
+def test_fingerprint(monkeypatch):
+    data = ExpressionMatrix(counts)._finalize()
+    assert cache.fingerprint(data) == cache.fingerprint(ExpressionMatrix(counts.copy())._finalize())
+    changed = counts.copy()
+    changed[0, 0] += 1
+    assert cache.fingerprint(data) != cache.fingerprint(ExpressionMatrix(changed)._finalize())
+    assert cache.fingerprint(csr_matrix(counts)) == cache.fingerprint(SparseExpressionMatrix(counts).matrix)
+    assert cache.fingerprint(counts, 1) != cache.fingerprint(counts, 2)
+    assert cache.fingerprint(np.float32) != cache.fingerprint(np.float64)
+    # large arrays are hashed in chunks, and an edit anywhere is noticed
+    monkeypatch.setattr(cache, "CHUNK_BYTES", 2**16)
+    monkeypatch.setattr(cache, "CHUNK_OBJECTS", 2**10)
+    for position in [0, 12345, -1]:
+        edited = big.copy()
+        edited[position] = 0
+        assert cache.fingerprint(big) != cache.fingerprint(edited)
+    wide = big.reshape(2**10, 2**10)
+    edited = wide.copy()
+    edited[517, 3] += 1
+    assert cache.fingerprint(wide) != cache.fingerprint(edited)
+    labels = np.array(["cell-{}".format(i) for i in range(10**5)], dtype=object)
+    edited = labels.copy()
+    edited[54321] = "other"
+    assert cache.fingerprint(pd.Index(labels)) != cache.fingerprint(pd.Index(edited))
+
+
+def test_disk_cache_lru(tmpdir):
+    disk = cache.DiskCache(str(tmpdir), max_bytes=3 * 10**5)
+    for key in "abc":
+        disk.put(key, np.zeros(10**4))
+        os.utime(disk._path(key), ns=(0, {"a": 1, "b": 2, "c": 3}[key] * 10**9))
+    assert disk.get("a")[0]  # refreshes "a", so "b" is now least recently used
+    disk.put("d", np.zeros(10**4))
+    assert [disk.get(key)[0] for key in "abcd"] == [True, False, True, True]
+    assert disk.size() <= disk.max_bytes
+
+
+def test_memoize(tmpdir):
+    calls = []
+
+    @cache.memoize(ignore=("n_jobs",))
+    def stage(data, scale=1.0, n_jobs=1):
+        calls.append(n_jobs)
+        return data * scale
+
+    data = ExpressionMatrix(counts)._finalize()
+    stage(data)
+    assert len(calls) == 1
+    cache.enable(str(tmpdir))
+    try:
+        first = stage(data, 2.0)
+        second = stage(data, scale=2.0, n_jobs=4)
+        assert len(calls) == 2
+        np.testing.assert_array_equal(first.values, second.values)
+        stage(data, 3.0)
+        assert len(calls) == 3
+
+        expected = pseq.regress(data, data.sum(axis=1))
+        cached = pseq.regress(data, data.sum(axis=1), n_processes=2)
+        assert isinstance(cached, ExpressionMatrix)
+        np.testing.assert_array_equal(cached.values, expected.values)
+    finally:
+        cache.disable()
@@ -0,0 +1,29 @@
+import numpy as np
+from sklearn.neighbors import KernelDensity
+
+from polyseq.density import binned_kde
+
+np.random.seed(0)
+
+samples = np.random.gamma(2, size=5000)
+grid = np.linspace(-1, 15, 200)
+
+
+def _exact(x, grid, bandwidth):
+    kde = KernelDensity(bandwidth=bandwidth).fit(x[:, np.newaxis])
+    return np.exp(kde.score_samples(grid[:, np.newaxis]))
+
+
+def test_binned_kde_matches_exact():
+    for bandwidth in [0.3, 2.0]:
+        expected = _exact(samples, grid, bandwidth)
+        density = binned_kde(samples, grid, bandwidth)
+        assert np.abs(density - expected).max() < 2e-3 * expected.max()
+
+
+def test_binned_kde_batched():
+    density = binned_kde([samples, 3 * samples[:100]], np.vstack([grid, 3 * grid]), [0.3, 0.9])
+    assert density.shape == (2, 200)
+    np.testing.assert_allclose(density[0], binned_kde(samples, grid, 0.3))
+    expected = _exact(3 * samples[:100], 3 * grid, 0.9)
+    assert np.abs(density[1] - expected).max() < 5e-3 * expected.max()
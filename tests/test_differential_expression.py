@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from scipy.stats import mannwhitneyu, ttest_ind
+
+from polyseq.differential_expression import benjamini_hochberg, markers, upregulated
+from polyseq.expression_matrix import ExpressionMatrix
+
+
+rng = np.random.RandomState(0)
+clusters = rng.randint(0, 3, 400)
+counts = rng.poisson(1.0, (400, 12)).astype(float)
+# genes 0-2 mark clusters 0-2
+counts[np.arange(400), clusters] += rng.poisson(4, 400)
+genes = ["gene-{}".format(i) for i in range(12)]
+data = ExpressionMatrix(counts, columns=genes)._finalize()
+data.index = pd.MultiIndex.from_arrays([np.arange(400), clusters], names=["cell", "cluster"])
+
+def test_markers_match_scipy():
+    stats = markers(data, chunk_size=5)
+    sparse_stats = markers(data.to_sparse(), n_jobs=2)
+    assert np.allclose(stats.values, sparse_stats.values)
+    for c in range(3):
+        for j in [0, 1, 7]:
+            a, b = counts[clusters == c, j], counts[clusters != c, j]
+            row = stats.loc[(c, genes[j])]
+            expected = mannwhitneyu(a, b, use_continuity=False, method='asymptotic').pvalue
+            assert np.isclose(row.wilcoxon_pvalue, expected)
+            assert np.isclose(row.t_pvalue, ttest_ind(a, b, equal_var=False).pvalue)
+            assert np.isclose(row.logfoldchange, np.log2(a.mean() / b.mean()))
+
+def test_benjamini_hochberg():
+    p = np.array([0.01, 0.04, 0.03, 0.5])
+    assert np.allclose(benjamini_hochberg(p), [0.04, 0.16 / 3, 0.16 / 3, 0.5])
+
+def test_upregulated():
+    top = upregulated(data, n=2)
+    assert [genes[0], genes[1], genes[2]] == [t[0] for t in top]
+    assert [t[0] for t in upregulated(data, n=2, method="t")] == [t[0] for t in top]
@@ -0,0 +1,182 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse import csr_matrix
+
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+
+np.random.seed(0)
+
+counts = np.random.poisson(0.3, size=(200, 40))
+genes = ["gene-{}".format(i) for i in range(counts.shape[1])]
+dense = ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize()
+sparse = dense.to_sparse()
+
+
+def assert_same(s, d):
+    assert isinstance(s, SparseExpressionMatrix)
+    np.testing.assert_allclose(s.matrix.toarray(), np.asarray(d))
+    assert list(s.index) == list(d.index)
+    assert list(s.columns) == list(d.columns)
+
+
+def test_round_trip():
+    assert_same(sparse, dense)
+    assert isinstance(sparse.to_dense(), ExpressionMatrix)
+    np.testing.assert_array_equal(sparse.to_dense().values, counts)
+
+
+def test_select_genes():
+    assert_same(sparse[genes[3]], dense[[genes[3]]])
+    assert_same(sparse[genes[5:1:-1]], dense[genes[5:1:-1]])
+    for data in [dense, sparse]:
+        with pytest.raises(KeyError, match="not_a_gene"):
+            data[[genes[0], "not_a_gene"]]
+        with pytest.raises(KeyError):
+            data["not_a_gene"]
+
+
+def test_drop_cells():
+    assert_same(sparse.drop_cells(umis=12), dense.drop_cells(umis=12))
+    assert_same(sparse.drop_cells(num_genes=10, umi_threshold=2),
+                dense.drop_cells(num_genes=10, umi_threshold=2))
+    assert_same(sparse.drop_cells(umis=2, genes=genes[:5]),
+                dense.drop_cells(umis=2, genes=genes[:5]))
+
+
+def test_drop_genes():
+    assert_same(sparse.drop_genes(umis=60), dense.drop_genes(umis=60))
+    assert_same(sparse.drop_genes(num_cells=50), dense.drop_genes(num_cells=50))
+    assert_same(sparse.drop_genes(num_cells=200, umi_threshold=0),
+                dense.drop_genes(num_cells=200, umi_threshold=0))
+
+
+def test_sort_and_normalize():
+    ordered = sparse.sort()
+    assert np.all(np.diff(ordered.sum(axis=0)) <= 0)
+    assert np.all(np.diff(ordered.sum(axis=1)) <= 0)
+    assert sorted(ordered.index) == sorted(dense.index)
+    assert_same(sparse.log_normalize(), dense.log_normalize())
+    np.testing.assert_allclose(sparse.sum(axis=1), dense.sum(axis=1))
+
+
+def test_downsample():
+    assert sparse.downsample(fraction=0.5).shape == (100, 40)
+    assert sparse.downsample(number=(10, 5)).shape == (10, 5)
+
+
+def test_clusters():
+    s = dense.to_sparse()
+    labels = np.arange(s.shape[0]) % 3
+    s.clusters = labels
+    np.testing.assert_array_equal(s.clusters, labels)
+    cluster = s.get_cluster(1)
+    assert cluster.shape == ((labels == 1).sum(), s.shape[1])
+    np.testing.assert_array_equal(cluster.matrix.toarray(), counts[labels == 1])
+
+
+def test_cluster_stats():
+    from scipy.stats import ttest_ind
+    labels = np.arange(counts.shape[0]) % 4
+    d = ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize()
+    d.clusters = labels
+    s = d.to_sparse()
+    grouped = pd.DataFrame(counts, columns=genes).groupby(labels)
+    for data in [d, s]:
+        stats = data.cluster_stats()
+        assert data.cluster_stats() is stats
+        np.testing.assert_allclose(stats.mean().values, grouped.mean().values)
+        np.testing.assert_allclose(stats.var().values, grouped.var().values)
+        np.testing.assert_allclose(stats.fraction_expressing().values, (grouped.agg(np.count_nonzero) / 50).values)
+        np.testing.assert_allclose(stats.pseudobulk().values, grouped.sum().values)
+        comparison = stats.compare(0, [2, 3])
+        a, b = counts[labels == 0], counts[np.isin(labels, [2, 3])]
+        t, p = ttest_ind(a, b, equal_var=False)
+        np.testing.assert_allclose(comparison["t"].values[~np.isnan(t)], t[~np.isnan(t)])
+
+        # reassigning clusters invalidates the cache
+        data.clusters = labels % 2
+        assert data.cluster_stats() is not stats
+        assert list(data.cluster_stats().counts) == [100, 100]
+
+    # in-place edits of the values are reflected
+    d.cluster_stats()
+    d.iloc[:, 0] = 7
+    np.testing.assert_array_equal(d.cluster_stats().mean().values[:, 0], [7, 7])
+    s.cluster_stats()
+    s.matrix = csr_matrix(np.where(np.arange(counts.shape[1]) == 0, 7, counts))
+    np.testing.assert_array_equal(s.cluster_stats().mean().values[:, 0], [7, 7])
+
+
+def test_cluster_groups():
+    labels = np.array([2, 0, 2, 1, 1, 1, 2] * 20 + [0] * 60)
+    d = ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize()
+    d.clusters = labels
+    groups = d.cluster_groups()
+    assert d.cluster_groups() is groups
+    assert list(groups.sizes) == [80, 60, 60]
+    np.testing.assert_array_equal(d.clusters, labels)
+    for data in [d, d.to_sparse()]:
+        for label, cells in data.iter_clusters():
+            assert cells.shape[0] == (labels == label).sum()
+            np.testing.assert_array_equal(cells.clusters, label)
+        assert data.get_cluster(5).shape[0] == 0
+    # the trailing run of cluster 0 is not contiguous, but sorted data is
+    assert not groups.contiguous[0]
+    ordered = ExpressionMatrix(d.iloc[np.argsort(labels, kind='stable')])
+    assert ordered.cluster_groups().rows(1) == slice(80, 140)
+
+
+def test_margins_and_qc_filter():
+    expected = counts[counts.sum(axis=1) >= 10]
+    expected = expected[:, (expected >= 1).sum(axis=0) >= 30]
+    for data in [ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize(), dense.to_sparse()]:
+        data.margins().cell_detected(2)
+        subset = data.drop_cells(umis=10).drop_genes(num_cells=30)
+        margins = subset.margins()
+        assert subset.margins() is margins
+        # carried over from the parent rather than recomputed, and sharing
+        # the subset's matrix instead of copying it
+        assert "umis" in margins._cells and 2 in margins._cells
+        if isinstance(data, SparseExpressionMatrix):
+            assert margins.matrix is subset.matrix
+        else:
+            assert np.shares_memory(margins.matrix, subset.values)
+        np.testing.assert_allclose(margins.cell_umis, expected.sum(axis=1))
+        np.testing.assert_allclose(margins.gene_umis, expected.sum(axis=0))
+        np.testing.assert_array_equal(margins.cell_detected(2), (expected >= 2).sum(axis=1))
+        np.testing.assert_array_equal(margins.gene_detected(1), (expected >= 1).sum(axis=0))
+
+        filtered = data.qc_filter(cell_umis=10, num_cells=30)
+        rows, cols = counts.sum(axis=1) >= 10, (counts >= 1).sum(axis=0) >= 30
+        assert filtered.shape == (rows.sum(), cols.sum())
+
+
+def test_margins_follow_changes():
+    d = ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize()
+    kept = list(d.drop_genes(umis=1).columns)
+    d[genes[0]] = 0.0
+    assert list(d.drop_genes(umis=1).columns) == [g for g in kept if g != genes[0]]
+    d.iloc[:, 1] = 0.0
+    assert genes[1] not in d.drop_genes(umis=1).columns
+
+    # every way of writing through pandas drops the cached margins
+    edits = [lambda d: d.loc.__setitem__((d.index[0], genes[0]), 100.0),
+             lambda d: d.at.__setitem__((d.index[0], genes[0]), 100.0),
+             lambda d: d.iat.__setitem__((0, 0), 100.0),
+             lambda d: d.isetitem(0, np.full(len(d), 100.0)),
+             lambda d: d.__iadd__(100.0),
+             lambda d: d.clip(lower=100.0, inplace=True),
+             lambda d: d.mask(d >= 0, 100.0, inplace=True)]
+    for change in edits:
+        d = ExpressionMatrix(pd.DataFrame(counts, columns=genes))._finalize()
+        before = d.margins().cell_umis[0]
+        change(d)
+        assert d.margins().cell_umis[0] == d.values[0].sum() != before
+
+    s = dense.to_sparse()
+    s.drop_genes(umis=1)
+    matrix = s.matrix.tolil()
+    matrix[:, 0] = 0
+    s.matrix = matrix.tocsr()
+    assert genes[0] not in s.drop_genes(umis=1).columns
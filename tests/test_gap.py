@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+from polyseq.clustering import batched_kmeans, gap_statistic, hCluster
+
+
+rng = np.random.RandomState(0)
+truth = rng.randint(0, 4, 1000)
+X = 8 * rng.randn(4, 3)[truth] + rng.randn(1000, 3)
+
+def test_batched_kmeans():
+    inertia, labels = batched_kmeans(np.stack([X, X[::-1]]), [1, 2, 4], n_init=3, random_state=0)
+    assert inertia.shape == (2, 3)
+    assert labels.shape == (2, 3, 1000)
+    assert np.allclose(inertia[:, 0], ((X - X.mean(axis=0))**2).sum())
+    assert np.all(np.diff(inertia, axis=1) < 0)
+    expected = KMeans(4, n_init=3, random_state=0).fit(X).inertia_
+    assert np.allclose(inertia[:, 2], expected, rtol=1e-6)
+    # inertia matches the returned labels
+    centers = np.array([X[labels[0, 2] == j].mean(axis=0) for j in range(4)])
+    assert np.isclose(((X - centers[labels[0, 2]])**2).sum(), inertia[0, 2])
+
+def test_gap_statistic():
+    k, labels, stats = gap_statistic(X, n_samples=20, window=3, return_stats=True)
+    assert k == 4
+    assert len(np.unique(np.stack([labels, truth]), axis=1).T) == 4
+    # stopped after the window containing k + 1
+    assert list(stats.index) == [1, 2, 3, 4, 5, 6]
+
+    k, _ = gap_statistic(rng.randn(300, 2), n_samples=20)
+    assert k == 1
+    k, _ = gap_statistic(X, n_samples=20, cutoff=2, n_processes=2)
+    assert k == -1
+
+def test_hcluster():
+    data = pd.DataFrame(X, index=["cell-{}".format(i) for i in range(1000)])
+    identity = lambda x: x
+    tree = hCluster(data, identity, KMeans, nSamples=20)
+    assert tree['k'] == 4
+    assert sorted(len(c) for c in tree['clusters']) == sorted(np.bincount(truth))
+    assert all(sub['k'] == 1 for sub in tree['subclusters'])
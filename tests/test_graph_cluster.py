@@ -0,0 +1,68 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from polyseq.clustering import (cluster_sweep, graph_cluster, louvain, modularity, neighbor_graph,
+                                snn_graph)
+
+
+rng = np.random.RandomState(0)
+truth = rng.randint(0, 6, 2000)
+X = 5 * rng.randn(6, 10)[truth] + rng.randn(2000, 10)
+
+def same_partition(a, b):
+    pairs = np.unique(np.stack([a, b]), axis=1)
+    return pairs.shape[1] == len(np.unique(a)) == len(np.unique(b))
+
+def test_snn_graph():
+    graph = neighbor_graph(X, 15)
+    snn = graph.snn()
+    assert graph.snn() is snn
+    assert abs(snn - snn.T).max() < 1e-12
+    # spot check the Jaccard weight of one edge against sets
+    i, j = 0, graph.indices[0, 0]
+    a, b = set(graph.indices[i]), set(graph.indices[j])
+    jaccard = len(a & b) / len(a | b)
+    expected = jaccard if i in b else jaccard / 2
+    assert np.isclose(snn[i, j], expected)
+
+def test_snn_graph_blocks():
+    graph = neighbor_graph(X, 15)
+    # distances as weights must not matter, only the pattern
+    knn = csr_matrix((graph.distances.ravel() + 1, graph.indices.ravel(),
+                      np.arange(0, 2000 * 15 + 1, 15)), shape=(2000, 2000))
+    expected = graph.snn()
+    for chunk_size, n_jobs in [(1, 1), (7, 3), (None, 2)]:
+        snn = snn_graph(knn, chunk_size=chunk_size, n_jobs=n_jobs)
+        assert abs(snn - expected).max() < 1e-12
+
+def test_modularity():
+    # two triangles joined by one edge
+    edges = [(0, 1), (1, 2), (0, 2), (3, 4), (4, 5), (3, 5), (2, 3)]
+    rows, cols = np.array(edges).T
+    adjacency = csr_matrix((np.ones(14), (np.r_[rows, cols], np.r_[cols, rows])), shape=(6, 6))
+    labels, q = louvain(adjacency, random_state=0)
+    assert same_partition(labels, np.array([0, 0, 0, 1, 1, 1]))
+    assert np.isclose(q, 5 / 14)
+    assert np.isclose(modularity(adjacency, labels), q)
+
+def test_graph_cluster():
+    clusters, graph = graph_cluster(X, n_neighbors=15, return_graph=True)
+    assert same_partition(clusters, truth)
+    assert np.all(np.diff(np.bincount(clusters)) <= 0)
+    again = graph_cluster(None, resolution=1.0, graph=graph)
+    assert np.array_equal(again, clusters)
+
+def test_cluster_sweep():
+    clusters, summary, graph = cluster_sweep(X, resolutions=[0.5, 1.0, 2.0], n_neighbors=[10, 20],
+                                             n_processes=2)
+    assert graph.n_neighbors == 20
+    assert clusters.shape == (2000, 6)
+    assert list(summary.columns) == ["n_clusters", "modularity"]
+    assert np.array_equal(clusters[(20, 1.0)], graph_cluster(None, graph=graph))
+    assert np.array_equal(graph.truncate(10).indices, neighbor_graph(X, 10).indices)
+    assert summary.loc[(10, 2.0), "n_clusters"] >= summary.loc[(10, 0.5), "n_clusters"]
+
+    # results are memoized on the graph
+    cached, again, _ = cluster_sweep(None, resolutions=[1.0], n_neighbors=[10], graph=graph)
+    assert np.array_equal(cached[(10, 1.0)], clusters[(10, 1.0)])
+    assert np.isclose(again.loc[(10, 1.0), "modularity"], summary.loc[(10, 1.0), "modularity"])
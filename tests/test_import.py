@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+from polyseq.benchmark import import_time
+
+HEAVY = ["umap", "numba", "sklearn", "matplotlib", "seaborn", "phenograph", "tables"]
+
+
+def test_import_is_lazy():
+    code = ("import sys; import polyseq; polyseq.io.read_cellranger; "
+            "print(' '.join(m for m in {} if m in sys.modules))".format(HEAVY))
+    loaded = subprocess.check_output([sys.executable, "-c", code]).decode().split()
+    assert loaded == []
+
+
+def test_exports():
+    code = ("import polyseq; from polyseq import *; "
+            "assert regress is polyseq.regression.regress; assert pca is polyseq.dim.pca; "
+            "assert 'regress' in dir(polyseq)")
+    subprocess.check_call([sys.executable, "-c", code])
+
+
+def test_import_time():
+    # well under a second on a typical machine; the bound leaves room for
+    # slow CI runners
+    assert import_time(repeat=3) < 3.0
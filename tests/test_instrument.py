@@ -0,0 +1,63 @@
+import json
+import logging
+
+import numpy as np
+
+import polyseq as pseq
+from polyseq import instrument
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+
+np.random.seed(0)
+
+counts = np.random.poisson(1.0, size=(200, 30)).astype(float)
+
+
+def test_disabled_is_noop():
+    assert instrument.span("anything") is instrument.span("else")
+    instrument.count("bytes_read", 10)
+    trace = instrument.MemorySink()
+    with instrument.tracing(trace):
+        pass
+    assert trace.spans == [] and trace.totals == {}
+
+
+def test_nested_spans_and_counters():
+    with instrument.tracing(instrument.MemorySink()) as trace:
+        with instrument.span("outer", size=3):
+            instrument.count("copies")
+            with instrument.span("inner"):
+                instrument.count("copies", 2)
+                instrument.count("bytes_read", 100)
+    inner, outer = trace.spans
+    assert (inner["name"], inner["parent"], inner["depth"]) == ("inner", "outer", 1)
+    assert inner["counters"] == {"copies": 2, "bytes_read": 100}
+    assert outer["counters"] == {"copies": 3, "bytes_read": 100}
+    assert outer["attrs"] == {"size": 3} and outer["seconds"] >= inner["seconds"]
+    assert trace.totals == {"copies": 3, "bytes_read": 100}
+    summary = trace.summary()
+    assert list(summary.index) == ["outer", "inner"]
+    assert summary.loc["outer", "calls"] == 1
+
+
+def test_pipeline_spans(tmp_path, caplog):
+    path = str(tmp_path / "trace.json")
+    trace = instrument.MemorySink()
+    with caplog.at_level(logging.INFO, logger="polyseq"), \
+            instrument.tracing(trace, instrument.ChromeTraceSink(path), instrument.LoggingSink()):
+        dense = SparseExpressionMatrix(counts).to_dense()
+        regressed = pseq.regress(dense.log_normalize(), dense.sum(axis=1))
+        pseq.dim.pca(regressed, k=3)
+
+    names = [s["name"] for s in trace.spans]
+    for name in ["densify", "design", "fit", "regress", "pca"]:
+        assert name in names
+    regress = next(s for s in trace.spans if s["name"] == "regress")
+    assert regress["counters"]["alloc_bytes"] == 200 * 30 * 4
+    assert trace.totals["copies"] == 2
+    assert "regress" in caplog.text
+
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    assert {e["name"] for e in events if e["ph"] == "X"} == set(names)
+    assert all(e["dur"] >= 0 for e in events if e["ph"] == "X")
+    assert isinstance(dense, ExpressionMatrix)
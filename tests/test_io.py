@@ -0,0 +1,103 @@
+import numpy as np
+import tables
+from scipy.sparse import csc_matrix
+
+import polyseq as pseq
+
+np.random.seed(0)
+
+n_cells, n_genes = 50, 30
+counts = np.random.poisson(0.5, size=(n_cells, n_genes)).astype(np.int32)
+barcodes = np.array(["cell-{}".format(i) for i in range(n_cells)])
+genes = np.array(["gene-{}".format(i) for i in range(n_genes)])
+
+
+def write_h5(path):
+    arr = csc_matrix(counts.T)
+    with tables.open_file(path, 'w') as f:
+        group = f.create_group(f.root, "matrix")
+        f.create_array(group, "data", arr.data)
+        f.create_array(group, "indices", arr.indices.astype(np.int64))
+        f.create_array(group, "indptr", arr.indptr.astype(np.int64))
+        f.create_array(group, "shape", np.array(arr.shape, dtype=np.int32))
+        f.create_array(group, "barcodes", barcodes.astype("S"))
+        features = f.create_group(group, "features")
+        f.create_array(features, "name", genes.astype("S"))
+    return path
+
+
+def test_read_h5(tmp_path):
+    path = write_h5(str(tmp_path / "matrix.h5"))
+    data = pseq.io.read_cellranger(path)
+    np.testing.assert_array_equal(data.values, counts)
+    assert list(data.index) == list(barcodes)
+    assert list(data.columns) == list(genes)
+
+
+def test_read_h5_subset(tmp_path):
+    path = write_h5(str(tmp_path / "matrix.h5"))
+    cells = ["cell-7", "cell-8", "cell-9", "cell-2", "cell-40"]
+    subset = pseq.io.read_cellranger(path, sparse=True, cells=cells, genes=[5, 3, 20])
+    expected = counts[[7, 8, 9, 2, 40]][:, [5, 3, 20]]
+    np.testing.assert_array_equal(subset.matrix.toarray(), expected)
+    assert list(subset.index) == cells
+    assert list(subset.columns) == ["gene-5", "gene-3", "gene-20"]
+
+
+def test_iter_h5(tmp_path):
+    path = write_h5(str(tmp_path / "matrix.h5"))
+    chunks = list(pseq.io.iter_cellranger_h5(path, chunk_size=16, genes=genes[::2]))
+    assert [c.shape[0] for c in chunks] == [16, 16, 16, 2]
+    stacked = np.vstack([c.matrix.toarray() for c in chunks])
+    np.testing.assert_array_equal(stacked, counts[:, ::2])
+
+
+def test_polyseq_format_round_trip(tmp_path):
+    data = pseq.io.read_cellranger(write_h5(str(tmp_path / "matrix.h5")), sparse=True)
+    data.clusters = np.arange(n_cells) % 4
+    path = str(tmp_path / "data.polyseq")
+    pseq.io.write_polyseq(data, path)
+
+    loaded = pseq.io.read_polyseq(path)
+    # read-only arrays mean the memory map was wrapped without copying
+    assert not loaded.matrix.data.flags.writeable
+    assert not loaded.matrix.indices.flags.writeable
+    np.testing.assert_array_equal(loaded.matrix.toarray(), counts)
+    assert loaded.index.equals(data.index)
+    assert list(loaded.columns) == list(genes)
+    np.testing.assert_array_equal(loaded.clusters, data.clusters)
+
+    dense = data.to_dense()
+    pseq.io.write_polyseq(dense, str(tmp_path / "dense.polyseq"))
+    loaded = pseq.io.read_polyseq(str(tmp_path / "dense.polyseq"), mmap_mode=None)
+    np.testing.assert_array_equal(loaded.values, counts)
+    assert loaded.index.equals(dense.index)
+
+
+def write_mtx(path, field="integer"):
+    import gzip
+    rows, cols = np.nonzero(counts.T)
+    values = counts.T[rows, cols]
+    lines = ["%%MatrixMarket matrix coordinate {} general".format(field), "%",
+             "{} {} {}".format(n_genes, n_cells, len(values))]
+    lines += ["{} {} {}".format(r + 1, c + 1, v) for r, c, v in zip(rows, cols, values)]
+    with gzip.open(str(path / "matrix.mtx.gz"), "wt") as f:
+        f.write("\n".join(lines) + "\n")
+    with open(str(path / "genes.tsv"), "w") as f:
+        f.write("\n".join("id-{}\t{}".format(i, g) for i, g in enumerate(genes)) + "\n")
+    return str(path)
+
+
+def test_read_mtx(tmp_path):
+    path = write_mtx(tmp_path)
+    data = pseq.io.read_cellranger(path, sparse=True)
+    assert data.matrix.dtype == np.int32
+    np.testing.assert_array_equal(data.matrix.toarray(), counts)
+    assert list(data.columns) == list(genes)
+
+
+def test_read_mtx_real(tmp_path):
+    path = write_mtx(tmp_path, field="real")
+    data = pseq.io.read_cellranger(path)
+    assert data.values.dtype == np.float64
+    np.testing.assert_array_equal(data.values, counts)
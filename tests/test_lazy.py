@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import polyseq as pseq
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+from polyseq.linalg import randomized_pca
+
+np.random.seed(0)
+
+lowdim = np.random.randn(500, 3) * np.array([6, 4, 2])
+counts = np.random.poisson(np.exp(lowdim.dot(np.random.randn(3, 60)) / 6)).astype(float)
+counts[:, :3] = 0
+
+
+def _eager(data):
+    normed = data.drop_genes(num_cells=1).log_normalize()
+    normed = normed.to_dense() if hasattr(normed, "to_dense") else normed
+    return pseq.regress(normed, normed.sum(axis=1), dtype=np.float64)
+
+
+def test_lazy_pipeline_matches_eager():
+    for data in [ExpressionMatrix(counts)._finalize(), SparseExpressionMatrix(counts)]:
+        plan = data.lazy(chunk_size=70).drop_genes(num_cells=1).log_normalize()
+        regressed = pseq.regress(plan, plan.sum(axis=1))
+        assert regressed.shape == (500, 57)
+        expected = _eager(data)
+        np.testing.assert_allclose(regressed.collect().values, expected.values, atol=1e-10)
+        proj = randomized_pca(regressed, 3, random_state=0)[0]
+        np.testing.assert_allclose(np.abs(proj), np.abs(randomized_pca(expected.values, 3, random_state=0)[0]),
+                                   atol=1e-8)
+        with pytest.raises(ValueError):
+            regressed.drop_cells(umis=1)
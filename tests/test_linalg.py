@@ -0,0 +1,108 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import PCA
+
+import polyseq as pseq
+from polyseq.linalg import ZScoredOperator, column_stats, randomized_pca
+
+np.random.seed(0)
+
+lowdim = np.random.randn(400, 3) * np.array([10, 5, 2])
+counts = np.random.poisson(np.exp(lowdim.dot(np.random.randn(3, 50)) / 10)).astype(float)
+zscored = (counts - counts.mean(axis=0)) / counts.std(axis=0, ddof=1)
+
+
+def test_column_stats():
+    mean, std = column_stats(csr_matrix(counts), chunk_size=33)
+    np.testing.assert_allclose(mean, counts.mean(axis=0))
+    np.testing.assert_allclose(std, counts.std(axis=0, ddof=1))
+
+
+def test_operator_products():
+    operator = ZScoredOperator(csr_matrix(counts), chunk_size=64)
+    b = np.random.randn(50, 4)
+    y = np.random.randn(400, 4)
+    np.testing.assert_allclose(operator.matmat(b), zscored.dot(b))
+    np.testing.assert_allclose(operator.rmatmat(y), zscored.T.dot(y))
+
+
+def test_randomized_pca_matches_sklearn(tmp_path):
+    expected = PCA(n_components=3).fit(zscored)
+
+    path = str(tmp_path / "counts.npy")
+    np.save(path, counts)
+    for data in [counts, csr_matrix(counts), np.load(path, mmap_mode='r')]:
+        proj, variance, components = randomized_pca(data, 3, chunk_size=50, n_iter=7)
+        np.testing.assert_allclose(variance, expected.explained_variance_, rtol=1e-4)
+        np.testing.assert_allclose(np.abs(proj), np.abs(expected.transform(zscored)), atol=1e-3)
+
+
+def test_pca_index():
+    reduced = pseq.pca(csr_matrix(counts), k=3)
+    assert reduced.shape == (400, 3)
+    assert list(reduced.columns) == ["pc-0", "pc-1", "pc-2"]
+
+
+def test_permuted_rows_are_distinct_within_columns(monkeypatch):
+    from scipy.sparse import csc_matrix
+    from polyseq import linalg
+
+    arr = csc_matrix(counts)
+    cols = np.repeat(np.arange(arr.shape[1]), np.diff(arr.indptr))
+    rows = linalg._permuted_rows(arr.indptr, arr.shape[0], np.random.default_rng(0))
+    keys = cols * arr.shape[0] + rows
+    assert len(np.unique(keys)) == len(keys)
+
+    # in blocks of a few columns, written into a given buffer
+    monkeypatch.setattr(linalg, "BLOCK_ENTRIES", 1000)
+    out = np.full(arr.nnz, -1, dtype=np.int32)
+    assert linalg._permuted_rows(arr.indptr, arr.shape[0], np.random.default_rng(0), out=out) is out
+    keys = cols * arr.shape[0] + out
+    assert out.min() >= 0 and len(np.unique(keys)) == len(keys)
+
+
+def test_shuffled_eigenvalues_match_explicit_shuffles():
+    from scipy.sparse import csc_matrix
+    from polyseq.linalg import _permuted_rows, shuffled_top_eigenvalues
+
+    seeds = [0, 1, 2]
+    # more cells than genes (Lanczos over genes) and fewer (over cells)
+    for data in [counts, counts[:30]]:
+        operator = ZScoredOperator(data)
+        mean, scale = operator.mean, operator.scale
+        arr = csc_matrix(data)
+
+        eigenvalues = shuffled_top_eigenvalues(
+            {"data": arr.data, "indptr": arr.indptr}, data.shape, mean, scale, seeds, tol=1e-8)
+        for seed, eigenvalue in zip(seeds, eigenvalues):
+            rows = _permuted_rows(arr.indptr, data.shape[0], np.random.default_rng(seed))
+            shuffled = csc_matrix((arr.data, rows, arr.indptr), shape=data.shape).toarray()
+            z = (shuffled - mean) / scale
+            expected = np.linalg.eigvalsh(z.T.dot(z) / (data.shape[0] - 1))[-1]
+            np.testing.assert_allclose(eigenvalue, expected, rtol=1e-6)
+
+        # dense data run over cells once a Krylov basis over genes would
+        # outgrow the data (here with few steps)
+        width = 16
+        eigenvalues = shuffled_top_eigenvalues(
+            {"dense": np.asfortranarray(data)}, data.shape, mean, scale, seeds,
+            block_width=width, max_steps=60 if data is counts else 15, tol=1e-8)
+        for seed, eigenvalue in zip(seeds, eigenvalues):
+            shuffled = np.empty_like(data)
+            for start in range(0, data.shape[1], width):
+                block = data[:, start:start + width]
+                rows = np.tile(np.arange(data.shape[0])[:, np.newaxis], (1, block.shape[1]))
+                perm = np.random.default_rng([seed, start]).permuted(rows, axis=0)
+                shuffled[:, start:start + width] = np.take_along_axis(block, perm, axis=0)
+            z = (shuffled - mean) / scale
+            expected = np.linalg.eigvalsh(z.T.dot(z) / (data.shape[0] - 1))[-1]
+            np.testing.assert_allclose(eigenvalue, expected, rtol=1e-6)
+
+
+def test_pca_shuffle_test():
+    reduced, scores, variance = pseq.pca(counts, n_shuffles=16, max_pcs=10)
+    assert scores.shape == (16,)
+    assert reduced.shape[1] == np.argmax(variance < np.percentile(scores, 95))
+    sparse_reduced, sparse_scores, _ = pseq.pca(csr_matrix(counts), n_shuffles=16, max_pcs=10,
+                                                n_processes=2)
+    assert sparse_reduced.shape == reduced.shape
@@ -0,0 +1,43 @@
+import numpy as np
+
+from polyseq.neighbors import exact_neighbors, nearest_neighbors, nn_descent
+
+
+rng = np.random.RandomState(0)
+centers = 4 * rng.randn(10, 5)
+X = centers[rng.randint(0, 10, 3000)] + rng.randn(3000, 5)
+
+def recall(indices, exact):
+    return np.mean([len(np.intersect1d(a, b)) for a, b in zip(indices, exact)]) / exact.shape[1]
+
+def test_exact_neighbors():
+    indices, distances = exact_neighbors(X, 10)
+    assert indices.shape == (3000, 10)
+    assert not (indices == np.arange(3000)[:, None]).any()
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    assert np.allclose(distances[:, 0], np.linalg.norm(X[indices[:, 0]] - X, axis=1))
+
+def test_nn_descent():
+    exact, exact_distances = exact_neighbors(X, 15)
+    indices, distances = nn_descent(X, 15, random_state=0)
+    assert indices.shape == (3000, 15)
+    assert not (indices == np.arange(3000)[:, None]).any()
+    assert all(len(np.unique(row)) == 15 for row in indices)
+    assert np.all(np.diff(distances, axis=1) >= 0)
+    assert np.allclose(distances, np.linalg.norm(X[indices] - X[:, None], axis=2), rtol=1e-3, atol=1e-3)
+    assert recall(indices, exact) > 0.95
+
+    same, _ = nearest_neighbors(X, 15, method="nndescent", random_state=0, n_jobs=2)
+    assert np.array_equal(same, indices)
+
+def test_nn_descent_recall_floor():
+    Y = (4 * rng.randn(20, 30))[rng.randint(0, 20, 4000)] + rng.randn(4000, 30)
+    exact, _ = exact_neighbors(Y, 10)
+    assert recall(nn_descent(Y, 10, random_state=0)[0], exact) > 0.9
+    # samples larger than the neighbor lists are capped
+    assert recall(nn_descent(Y, 10, sample_size=16, random_state=0)[0], exact) > 0.95
+
+def test_auto_is_exact():
+    indices, distances = nearest_neighbors(X, 10)
+    exact, exact_distances = exact_neighbors(X, 10)
+    assert np.allclose(distances, exact_distances)
@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from polyseq.raster import aggregate_rows, point_counts, point_majority, point_means, row_bins
+
+np.random.seed(0)
+
+x, y = np.random.rand(2, 1000)
+codes = (x > 0.5).astype(int)
+
+
+def test_point_images():
+    counts, extent = point_counts(x, y, (4, 5))
+    assert counts.sum() == 1000
+    assert extent == (x.min(), x.max(), y.min(), y.max())
+    expected, _, _ = np.histogram2d(y, x, bins=(4, 5), range=[extent[2:], extent[:2]])
+    np.testing.assert_array_equal(counts, expected)
+
+    means, _ = point_means(x, y, x, (4, 5))
+    assert np.all((means[:, :2] < 0.5) & (means[:, 3:] > 0.5))
+
+    majority, _ = point_majority(x, y, codes, 2, (4, 2))
+    np.testing.assert_array_equal(majority, [[0, 1]] * 4)
+
+
+def test_row_bins_respect_labels():
+    bins, starts = row_bins(10, 4, labels=[0, 0, 0, 1, 1, 1, 1, 1, 1, 2])
+    np.testing.assert_array_equal(bins, [0, 0, 0, 1, 1, 1, 2, 2, 2, 3])
+    np.testing.assert_array_equal(starts, [0, 3, 6, 9])
+
+    # more runs than bins: adjacent runs are merged, never more bins
+    labels = np.random.randint(0, 3, 1000)
+    bins, starts = row_bins(1000, 10, labels=labels)
+    assert bins.max() < 10 and starts.shape[0] == bins.max() + 1
+    assert np.all(np.diff(bins) >= 0) and np.all(np.diff(starts) > 0)
+    assert set(starts) <= set(np.flatnonzero(np.diff(labels)) + 1) | {0}
+
+
+def test_aggregate_rows():
+    matrix = np.random.rand(100, 3)
+    labels = np.repeat([0, 1], [30, 70])
+    for data in [matrix, csr_matrix(matrix)]:
+        reduced, starts = aggregate_rows(data, 10, labels)
+        assert reduced.shape == (10, 3)
+        np.testing.assert_allclose(reduced[0], matrix[:10].mean(axis=0))
+        assert 30 in starts
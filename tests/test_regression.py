@@ -0,0 +1,38 @@
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+import polyseq as pseq
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+
+np.random.seed(0)
+
+first = ExpressionMatrix(np.random.poisson(2, (300, 40)).astype(float))
+second = ExpressionMatrix(np.random.poisson(3, (200, 40)).astype(float))
+data = pseq.functions.concat(first, second)
+total = data.values.sum(axis=1)
+
+
+def _expected(design):
+    residuals = data.values - LinearRegression().fit(design, data.values).predict(design)
+    return (residuals - residuals.mean(axis=0)) / residuals.std(axis=0, ddof=1)
+
+
+def test_regress_matches_least_squares():
+    zscores = pseq.regress(data, total, chunk_size=7, n_processes=2, dtype=np.float64)
+    np.testing.assert_allclose(zscores.values, _expected(total[:, None]), atol=1e-10)
+    assert list(zscores.index.names) == ["sample", "cell"]
+
+
+def test_regress_categorical():
+    design = np.column_stack([total, data.index.get_level_values("sample") == 1])
+    expected = _expected(design)
+    for matrix in [data, SparseExpressionMatrix(data.values, index=data.index, columns=data.columns)]:
+        zscores = pseq.regress(matrix, total, categorical="sample", chunk_size=16)
+        assert zscores.values.dtype == np.float32
+        np.testing.assert_allclose(zscores.values, expected, atol=1e-4)
+
+
+def test_regress_out():
+    out = np.empty(data.shape, dtype=np.float32)
+    zscores = pseq.regress(data, total, out=out)
+    assert np.shares_memory(zscores.values, out)
@@ -0,0 +1,41 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from polyseq.expression_matrix import ExpressionMatrix, SparseExpressionMatrix
+from polyseq.summary import RELATIVE_ERROR, _counted_stats, summarize, summary_stats
+
+np.random.seed(0)
+
+counts = np.random.poisson(0.7, (301, 57)).astype(float)
+
+
+def test_summarize_matches_flattened():
+    flat = counts.ravel()
+    expected = {
+        'umis': flat,
+        'umis above 1': flat[flat >= 2],
+        'umis per cell': counts.sum(axis=1),
+        'genes expressed': (counts >= 2).sum(axis=1),
+        'umis per gene': counts.sum(axis=0),
+        'cells expressing': (counts > 2).sum(axis=0),
+    }
+    for data in [ExpressionMatrix(counts), SparseExpressionMatrix(csr_matrix(counts)), counts]:
+        result = summarize(data, umi_threshold=2, plot=False, chunk_size=50)
+        assert list(result.index) == list(expected)
+        for name, values in expected.items():
+            stats = [np.min(values), np.max(values), np.mean(values), np.median(values)]
+            assert list(result.loc[name]) == [int(np.round(s)) for s in stats]
+
+
+def test_summary_stats_bounded_for_floats():
+    scaled = np.log1p(counts) * np.random.lognormal(0, 1, counts.shape) - 0.5 * (counts == 3)
+    summary = summary_stats(SparseExpressionMatrix(csr_matrix(scaled)), chunk_size=50)
+    values, n = summary['values'], summary['counts']
+    assert n.sum() == scaled.size
+    assert values.shape[0] < np.unique(scaled).shape[0] / 2
+    assert values[0] == scaled.min() and values[-1] == scaled.max()
+    above = values > 0
+    median = _counted_stats(values[above], n[above])['median']
+    expected = np.median(scaled[scaled > 0])
+    assert abs(median - expected) <= RELATIVE_ERROR * expected
+    np.testing.assert_allclose((values * n).sum() / n.sum(), scaled.mean(), rtol=RELATIVE_ERROR)
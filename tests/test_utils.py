@@ -0,0 +1,127 @@
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from polyseq.utils import cluster_arg_sort, expand_tree, get_pool, parallelize, InlinePool, WorkerPool
+
+
+np.random.seed(0)
+X = np.random.rand(200, 30)
+
+def column_sums(arr, start, stop):
+    return arr[start:stop].sum(axis=0)
+
+def dict_column_sums(arrays, start, stop):
+    return column_sums(arrays["x"], start, stop)
+
+def pid(_):
+    import os
+    return os.getpid()
+
+def fail(_):
+    raise ValueError("boom")
+
+def fail_or_die(i):
+    import os
+    import time
+    if i == 0:
+        raise ValueError("boom")
+    time.sleep(0.5)
+    os._exit(1)
+
+def die(_):
+    import os
+    os._exit(1)
+
+def test_parallelize():
+    args = [(X, i, i + 10) for i in range(0, 200, 10)]
+    results = parallelize(column_sums, args, 2)
+    assert results.shape == (20, 30)
+    assert np.allclose(results.sum(axis=0), X.sum(axis=0))
+
+def test_pool_reused_and_shared():
+    pool = get_pool(2)
+    pids = set(pool.map(pid, [(i,) for i in range(8)]))
+    assert get_pool(2) is pool
+    assert set(pool.map(pid, [(i,) for i in range(8)])) <= {w.pid for w in pool._workers}
+    assert pids <= {w.pid for w in pool._workers}
+
+    spec = pool.share(X, order='F')
+    try:
+        results = pool.map(dict_column_sums, [({"x": spec}, i, i + 50) for i in range(0, 200, 50)])
+    finally:
+        pool.release(spec)
+    assert np.allclose(np.sum(results, axis=0), X.sum(axis=0))
+    assert not pool._shared
+
+def test_pool_errors():
+    pool = get_pool(2)
+    with pytest.raises(RuntimeError, match="boom"):
+        pool.map(fail, [(i,) for i in range(4)])
+    assert pool.map(pid, [(0,)])
+
+    # a worker dying while the rest of a failed call is drained
+    with WorkerPool(2) as pool:
+        with pytest.raises(RuntimeError, match="died"):
+            pool.map(fail_or_die, [(0,), (1,)])
+
+    # the error reaches callers that release their arrays in `finally`
+    with WorkerPool(2) as pool:
+        spec = pool.share(X)
+        with pytest.raises(RuntimeError, match="died"):
+            try:
+                pool.map(die, [(spec,)])
+            finally:
+                pool.release(spec)
+
+def test_inline_pool():
+    pool = get_pool(1)
+    assert isinstance(pool, InlinePool)
+    arr = pool.share(X, order='F')
+    assert arr.flags.f_contiguous
+    assert np.allclose(pool.map(column_sums, [(arr, 0, 200)])[0], X.sum(axis=0))
+
+
+def test_expand_tree_iterative():
+    # a maximally deep chain: ((((0, 1), 2), 3), ...)
+    n = 5000
+    children = np.array([[0, 1]] + [[n + i - 1, i + 1] for i in range(1, n - 1)])
+    np.testing.assert_array_equal(expand_tree(children), np.arange(n))
+
+
+def test_cluster_arg_sort_centroid():
+    rng = np.random.RandomState(0)
+    labels = rng.randint(0, 5, 3000)
+    data = 5 * rng.randn(5, 80)[labels] + rng.randn(3000, 80)
+    for clusters in [None, labels]:
+        order = cluster_arg_sort(data, method="centroid", clusters=clusters, n_clusters=5)
+        np.testing.assert_array_equal(np.sort(order), np.arange(3000))
+        # each cluster is one contiguous run
+        assert (np.diff(labels[order]) != 0).sum() == 4
+
+
+def test_shared_memory_no_tracker_warnings():
+    # the warnings come from resource trackers at interpreter exit, so the
+    # pool runs in a fresh process; once with the tracker started before the
+    # pool and once without
+    code = """
+import subprocess
+import sys
+
+import numpy as np
+from multiprocessing import resource_tracker
+from polyseq.clustering import cluster_sweep, gap_statistic
+if {}:
+    resource_tracker.ensure_running()
+np.random.seed(0)
+X = np.vstack([np.random.randn(100, 4) + 5 * i for i in range(3)])
+cluster_sweep(X, resolutions=(0.5, 1.0), n_neighbors=(10,), n_processes=2)
+gap_statistic(X, n_samples=4, cutoff=4, n_processes=2)
+"""
+    for tracker_first in [False, True]:
+        run = subprocess.run([sys.executable, "-c", code.format(tracker_first)],
+                             capture_output=True, text=True, timeout=600)
+        assert run.returncode == 0, run.stderr
+        assert "resource_tracker" not in run.stderr and "Traceback" not in run.stderr